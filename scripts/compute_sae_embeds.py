@@ -6,7 +6,6 @@ from datasets import load_dataset
 
 from src.interp_embed.dataset_analysis import Dataset
 from src.interp_embed.sae.local_sae import LocalSAE
-from src.interp_embed.utils.helpers import safe_load_pkl
 from src.utils.path import build_dataset_filepath
 
 logging.basicConfig(
@@ -29,10 +28,10 @@ def main(args: Namespace):
     )
 
     if output_path.exists():
-        params = safe_load_pkl(output_path)
+        saved_dataset = Dataset.load_from_file(output_path, device="cpu")
 
         # Count the number of successfully completed samples
-        num_rows = sum(1 for row in params["rows"] if row is not None)
+        num_rows = len(saved_dataset.filter_na_rows())
 
         if num_rows == len(df):
             logging.info(
@@ -0,0 +1,354 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .storage import Vocabulary, _decode_strings, _encode_strings
+
+# SAE metadata that does not change the activations, so it is left out of cache keys
+CACHE_IGNORED_METADATA = ("device", "max_retries", "base_delay", "max_concurrency")
+# Number of hits whose last-used time is kept in memory before it is written to the database
+TOUCH_FLUSH_SIZE = 256
+
+
+class BlobCache:
+    def __init__(self, path, max_bytes=10 * 1024**3):
+        """
+        Persistent key-value store of binary blobs in a SQLite database, bounded in size by
+        evicting the least recently used entries. Lookups through each instance are counted in `hits`
+        and `misses`.
+
+        Hits update the last-used time of their entry in memory. The updates are written in one
+        transaction with the next `put`, every TOUCH_FLUSH_SIZE hits, or on `flush`/`close`, so
+        lookups do not each wait for a write to the database.
+
+        :param path: Path of the SQLite database file (created if missing)
+        :param max_bytes: Maximum total size of the stored blobs
+        """
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._touched = dict()  # key -> last-used time not written yet
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "last_used INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+        )
+        self._connection.commit()
+        (self._clock,) = self._connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM entries"
+        ).fetchone()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get(self, key, count=True):
+        """
+        The blob stored under `key`, or None. A hit marks the entry as recently used.
+
+        :param count: Whether to count the lookup in `hits`/`misses`
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += count
+                return None
+            self.hits += count
+            self._touched[key] = self._tick()
+            if len(self._touched) >= TOUCH_FLUSH_SIZE:
+                self._write_touched()
+                self._connection.commit()
+            return bytes(row[0])
+
+    def _write_touched(self):
+        self._connection.executemany(
+            "UPDATE entries SET last_used = ? WHERE key = ?",
+            [(last_used, key) for key, last_used in self._touched.items()],
+        )
+        self._touched = dict()
+
+    def flush(self):
+        """
+        Write the last-used times of the entries hit since the last write.
+        """
+        with self._lock:
+            if self._touched:
+                self._write_touched()
+                self._connection.commit()
+
+    def __contains__(self, key):
+        with self._lock:
+            return (
+                self._connection.execute(
+                    "SELECT 1 FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                is not None
+            )
+
+    def put(self, key, value):
+        """
+        Store `value` (bytes) under `key`, then evict the least recently used entries until the
+        cache fits in `max_bytes`.
+        """
+        with self._lock:
+            # Eviction below sees the entries hit since the last write
+            self._write_touched()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), len(value), self._tick()),
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        (total,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM entries ORDER BY last_used"
+        ):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def size(self):
+        """
+        Total size in bytes of the stored blobs.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM entries"
+            ).fetchone()
+            return count
+
+    def clear(self):
+        with self._lock:
+            self._touched = dict()
+            self._connection.execute("DELETE FROM entries")
+            self._connection.commit()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}({self.path!r}, hits={self.hits}, misses={self.misses})"
+        )
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _strip_metadata(metadata):
+    if isinstance(metadata, dict):
+        return {
+            key: _strip_metadata(value)
+            for key, value in metadata.items()
+            if key not in CACHE_IGNORED_METADATA
+        }
+    return metadata
+
+
+class ActivationCache:
+    def __init__(self, path, max_bytes=10 * 1024**3):
+        """
+        Persistent cache of the encoded rows of documents, keyed by a SHA-256 hash of the SAE
+        metadata and the document text. The metadata fixes the model, SAE, chat formatting and
+        pruning, so equal keys mean equal activations; settings that do not change them (see
+        `CACHE_IGNORED_METADATA`) are left out of the key.
+
+        Each entry holds the token activations, aggregates and tokens of one document. Token ids are
+        stored without their vocabulary, which is stored once per SAE.
+
+        :param path: Path of the SQLite database file (created if missing)
+        :param max_bytes: Maximum total size of the cache, enforced by least-recently-used eviction
+        """
+        self.blobs = BlobCache(path, max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._vocabularies = dict()  # vocabulary key -> Vocabulary stored or loaded
+
+    @staticmethod
+    def sae_key(sae_metadata):
+        """
+        Hash of the SAE metadata identifying the activations it produces.
+        """
+        return _hash(
+            json.dumps(_strip_metadata(sae_metadata), sort_keys=True, default=str)
+        )
+
+    def _vocabulary(self, sae_key):
+        key = f"{sae_key}:vocabulary"
+        if key not in self._vocabularies:
+            blob = self.blobs.get(key, count=False)
+            if blob is None:
+                return None
+            with np.load(io.BytesIO(blob)) as arrays:
+                self._vocabularies[key] = Vocabulary(
+                    string_bytes=arrays["vocab_bytes"],
+                    string_offsets=arrays["vocab_offsets"],
+                )
+        return self._vocabularies[key]
+
+    def _store_vocabulary(self, sae_key, vocabulary):
+        key = f"{sae_key}:vocabulary"
+        stored = self._vocabularies.get(key)
+        if stored is not None and stored.same_table(vocabulary) and key in self.blobs:
+            # Compare the tables once; later puts with the same object skip the comparison
+            self._vocabularies[key] = vocabulary
+            return
+        vocab_bytes, vocab_offsets = vocabulary.to_arrays()
+        self.blobs.put(
+            key, _to_bytes({"vocab_bytes": vocab_bytes, "vocab_offsets": vocab_offsets})
+        )
+        self._vocabularies[key] = vocabulary
+
+    def get(self, sae_key, text):
+        """
+        The cached (token activations csr_matrix, aggregate dictionary, tokens) of `text`, in the
+        form `EncodePipeline.run` returns rows, or None on a miss.
+        """
+        blob = self.blobs.get(_hash(sae_key, text), count=False)
+        if blob is None:
+            self.misses += 1
+            return None
+        with np.load(io.BytesIO(blob)) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+        shape = tuple(arrays["shape"])
+        matrix = lambda name, n_rows: csr_matrix(
+            (arrays[f"{name}_data"], arrays[f"{name}_indices"], arrays[f"{name}_indptr"]),
+            shape=(n_rows, shape[1]),
+        )
+        aggregates = {
+            name: matrix(name, 1) for name in arrays["aggregate_names"].tolist()
+        }
+        if "token_ids" in arrays:
+            vocabulary = self._vocabulary(sae_key)
+            if vocabulary is None:  # Evicted: the ids cannot be decoded
+                self.misses += 1
+                return None
+            tokens = (arrays["token_ids"], vocabulary)
+        else:
+            tokens = _decode_strings(arrays["token_bytes"], arrays["token_offsets"])
+        self.hits += 1
+        return matrix("activations", shape[0]), aggregates, tokens
+
+    def put(self, sae_key, text, result):
+        """
+        Cache `result`, a (token activations csr_matrix, aggregate dictionary, tokens) tuple.
+        """
+        activations, aggregates, tokens = result
+        activations = csr_matrix(activations)
+        arrays = {
+            "shape": np.array(activations.shape),
+            "aggregate_names": np.array(sorted(aggregates)),
+        }
+        matrices = {
+            name: csr_matrix(aggregate) for name, aggregate in aggregates.items()
+        }
+        matrices["activations"] = activations
+        for name, matrix in matrices.items():
+            arrays[f"{name}_data"] = matrix.data
+            arrays[f"{name}_indices"] = matrix.indices
+            arrays[f"{name}_indptr"] = matrix.indptr
+        if isinstance(tokens, tuple):
+            token_ids, vocabulary = tokens
+            self._store_vocabulary(sae_key, vocabulary)
+            arrays["token_ids"] = np.asarray(token_ids, dtype=np.int32)
+        else:
+            arrays["token_bytes"], arrays["token_offsets"] = _encode_strings(tokens)
+        self.blobs.put(_hash(sae_key, text), _to_bytes(arrays))
+
+    def __repr__(self):
+        return f"ActivationCache({self.blobs.path!r}, hits={self.hits}, misses={self.misses})"
+
+
+class LLMResponseCache:
+    def __init__(self, path, max_bytes=1024**3, ttl=None):
+        """
+        Persistent cache of LLM responses, keyed by a SHA-256 hash of the endpoint and of the request
+        (model, messages and decoding parameters). Responses are stored as JSON.
+
+        :param path: Path of the SQLite database file (created if missing)
+        :param max_bytes: Maximum total size of the cache, enforced by least-recently-used eviction
+        :param ttl: Number of seconds after which a response is stale and requested again, or None to
+            keep responses until they are evicted
+        """
+        self.blobs = BlobCache(path, max_bytes=max_bytes)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def request_key(request, endpoint=""):
+        """
+        Hash of the request parameters (a dictionary of the arguments of the completion call) and of
+        the endpoint they are sent to.
+        """
+        return _hash(endpoint, json.dumps(request, sort_keys=True, default=str))
+
+    def get(self, key):
+        """
+        The cached response (a JSON-compatible dictionary) under `key`, or None on a miss or if the
+        response is older than `ttl`.
+        """
+        blob = self.blobs.get(key, count=False)
+        if blob is not None:
+            entry = json.loads(blob)
+            if self.ttl is None or time.time() - entry["created"] <= self.ttl:
+                self.hits += 1
+                return entry["response"]
+        self.misses += 1
+        return None
+
+    def put(self, key, response):
+        """
+        Cache `response`, a JSON-compatible dictionary.
+        """
+        entry = {"created": time.time(), "response": response}
+        self.blobs.put(key, json.dumps(entry).encode("utf-8"))
+
+    def __repr__(self):
+        return f"LLMResponseCache({self.blobs.path!r}, hits={self.hits}, misses={self.misses})"
+
+
+def _to_bytes(arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
@@ -1,22 +1,46 @@
 import asyncio
+import functools
 import json
-import math
+import multiprocessing
+import os
+import queue
 import random
+import tempfile
 import uuid
 
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix, vstack
+from scipy.sparse import coo_matrix, csr_matrix, diags
 from tqdm.auto import tqdm
 
-from .llm.prompts import build_labeling_prompt, build_scoring_prompt
+from .llm.prompts import (
+    build_batch_scoring_prompt,
+    build_labeling_prompt,
+    build_scoring_prompt,
+)
 from .llm.utils import (
     call_async_llm,
     extract_json_from_response,
     get_llm_client,
 )
+from .cache import ActivationCache
+from .feature_index import FeatureIndex
+from .minhash import MinHashIndex
 from .sae.load_sae import load_sae_from_metadata
+from .sae import pipeline as encode_pipeline
+from .sae.pipeline import EncodePipeline, encode_shard, plan_batches
+from .storage import (
+    AGGREGATE_NAMES,
+    CHECKPOINT_LOG_DIR,
+    ActivationStore,
+    CheckpointLog,
+    aggregate_row,
+    count_active_tokens,
+    reorder_csr_rows,
+    stack_csr_rows,
+)
 from .utils.data_models import (
+    BatchScoringResponse,
     FeatureLabelResponse,
     SingleSampleScoringResponse,
 )
@@ -26,12 +50,15 @@ from .utils.helpers import (
     highlight_activations_as_string,
     log_tqdm_message,
     safe_load_pkl,
+    safe_save_dir,
     safe_save_pkl,
     truncate_chat_template_activations,
     truncate_chat_template_tokens,
+    wilson_interval,
 )
 
 SAMPLE_TRUNCATION_LENGTH = 100
+DATASET_METADATA_FILE = "dataset.pkl"
 
 
 class Dataset:
@@ -47,6 +74,11 @@ class Dataset:
         save_path=None,
         save_every_batch=5,
         batch_size=8,
+        max_tokens=None,
+        low_memory=False,
+        num_workers=1,
+        devices=None,
+        activation_cache=None,
     ):
         """
         Initialize a Dataset instance. Computes feature activations over the column marked by with `field`
@@ -57,6 +89,13 @@ class Dataset:
         :param field: Field name containing the text data
         :param feature_activations: Optional pre-computed feature activations. If None, will compute them. Maps sae id to a sparse matrix.
         :param save_path: Optional file path to save dataset feature activations when computing. Allows for recovery if dataset creation fails.
+        :param save_every_batch: Number of batches per checkpoint log segment when `save_path` is set
+        :param batch_size: Number of documents per batch when computing activations
+        :param max_tokens: Optional token budget per batch. If set, documents are grouped by tokenized length and each batch holds as many documents as fit in the budget once padded (`batch_size` is then ignored)
+        :param low_memory: If True, computed rows are packed into one shared columnar store (the memory-mapped checkpoint when `save_path` is set) instead of keeping one set of objects per row
+        :param num_workers: Number of worker processes encoding shards of the rows in parallel, each with its own copy of the SAE loaded from `sae.metadata()`
+        :param devices: Optional list of devices for the workers (worker i uses `devices[i % len(devices)]`). By default workers use the device in the SAE metadata
+        :param activation_cache: Optional ActivationCache. Rows of documents already encoded with the same SAE settings are read from it instead of being encoded, and newly encoded rows are added to it
         """
         if isinstance(data, pd.DataFrame):
             data_list = data.to_dict(orient="records")
@@ -77,34 +116,80 @@ class Dataset:
         self.num_documents = len(self.dataset)
         self.field = field
         self.sae = sae
+        self.low_memory = low_memory
+        self.activation_cache = activation_cache
+        self._latents_cache = dict()
+        self._feature_index_cache = dict()
         self.rows = rows or [None] * self.num_documents  # Initialize rows with None
-        self.token_count = compute_token_count(self.rows)
+        self.token_count = (
+            self.rows.token_count()
+            if isinstance(self.rows, StoredRows)
+            else compute_token_count(self.rows)
+        )
+        self.encode_stats = None  # PipelineStats of the last activation computation
 
         document_list = [row[field] for row in data_list]
         # Preprocessing on document list
 
         # Compute feature activations on the document list
         if compute_activations:
-            self._compute_latents(save_path, save_every_batch, batch_size=batch_size)
+            self._compute_latents(
+                save_path,
+                save_every_batch,
+                batch_size=batch_size,
+                max_tokens=max_tokens,
+                num_workers=num_workers,
+                devices=devices,
+            )
 
-    def _compute_latents(self, save_path=None, save_every_batch=5, batch_size=8):
+    def _compute_latents(
+        self,
+        save_path=None,
+        save_every_batch=5,
+        batch_size=8,
+        max_tokens=None,
+        queue_size=2,
+        num_workers=1,
+        devices=None,
+    ):
 
         data_as_dict = self.dataset.to_dict(orient="records")
         document_list = [row[self.field] for row in data_as_dict]
 
         # Find remaining work to do
-        selected_document_indices = []
-        for row_id in range(len(self.rows)):
-            if self.rows[row_id] == None:
-                selected_document_indices.append(row_id)
+        selected_document_indices = np.where(~self._valid_row_mask())[0].tolist()
+        num_selected = len(selected_document_indices)
+        if self.activation_cache is not None and num_selected > 0:
+            selected_document_indices = self._load_cached_rows(
+                selected_document_indices, document_list, data_as_dict
+            )
 
         if len(selected_document_indices) == 0:
+            if num_selected > 0:
+                self._finish_computation(save_path)
+            elif save_path and os.path.isdir(os.path.join(save_path, CHECKPOINT_LOG_DIR)):
+                self.save_to_file(save_path)  # Compact rows left in the checkpoint log
             return
 
         print(
             f"Found {len(selected_document_indices)} rows with empty or incomplete feature activations"
         )
 
+        if num_workers > 1:
+            self._compute_latents_sharded(
+                selected_document_indices,
+                document_list,
+                save_path,
+                save_every_batch=save_every_batch,
+                batch_size=batch_size,
+                max_tokens=max_tokens,
+                queue_size=queue_size,
+                num_workers=num_workers,
+                devices=devices,
+            )
+            self._finish_computation(save_path)
+            return
+
         if not self.sae.is_loaded():
             self.sae.load()
 
@@ -112,93 +197,364 @@ class Dataset:
             self._feature_labels or self.sae.feature_labels() or dict()
         )
 
-        pbar = tqdm(
-            range(math.ceil(len(selected_document_indices) / batch_size)),
-            desc="Computing latents",
+        # With `max_tokens`, documents of similar length are batched together so little of the
+        # budget goes to padding, and the token ids used for planning are passed to the pipeline
+        batch_positions, token_ids = plan_batches(
+            self.sae,
+            [document_list[ind] for ind in selected_document_indices],
+            batch_size,
+            max_tokens,
+        )
+        batch_indices = [
+            [selected_document_indices[position] for position in positions]
+            for positions in batch_positions
+        ]
+        batches = (
+            (
+                i,
+                [document_list[ind] for ind in indices],
+                None
+                if token_ids is None
+                else [token_ids[position] for position in batch_positions[i]],
+            )
+            for i, indices in enumerate(batch_indices)
         )
-        for i in pbar:
-            selected_documents = [
-                document_list[ind]
-                for ind in selected_document_indices[
-                    batch_size * i : batch_size * (i + 1)
-                ]
-            ]
-            try:
-                # Compute latents for the batch of documents
-                batch_activations = self.sae.encode(selected_documents)
-
-                # Tokenize the documents
-                tokenized_documents = self.sae.tokenize(selected_documents)
 
-                # Update the successful token count
-                self.token_count += sum(
-                    [
-                        activations.shape[0]
-                        for activations in batch_activations
-                        if activations is not None
-                    ]
-                )
-            except Exception as e:
-                log_tqdm_message(f"ERROR (batch {i}): {e}")
-                batch_activations, tokenized_documents = [None] * len(
-                    selected_documents
-                ), None
-
-            for j, batch_activation in enumerate(batch_activations):
-                doc_index = selected_document_indices[batch_size * i + j]
-                if batch_activation != None:
-                    new_row = DatasetRow(
-                        row=data_as_dict[doc_index],
-                        tokenized_document=tokenized_documents[j],
-                        field=self.field,
-                        activations=batch_activation,
+        # After the first checkpoint saves the dataset, computed rows are appended to a log inside
+        # it, so checkpoint cost does not grow with the size of the dataset. The log is compacted
+        # into the dataset when computation finishes.
+        checkpoint_log = (
+            CheckpointLog(os.path.join(save_path, CHECKPOINT_LOG_DIR))
+            if save_path
+            else None
+        )
+        unsaved_indices = []
+
+        sae_key = ActivationCache.sae_key(self.sae.metadata())
+
+        # Tokenization, the forward pass and CSR conversion overlap in separate threads
+        pipeline = EncodePipeline(self.sae, queue_size=queue_size)
+        pbar = tqdm(total=len(batch_indices), desc="Computing latents")
+        for i, batch_results, error in pipeline.run(batches):
+            if error is not None:
+                log_tqdm_message(f"ERROR (batch {i}): {error}")
+                batch_results = [None] * len(batch_indices[i])
+
+            for doc_index, result in zip(batch_indices[i], batch_results):
+                if result is not None:
+                    self.rows[doc_index] = self._row_from_result(
+                        data_as_dict[doc_index], result
+                    )
+                    # Update the successful token count
+                    self.token_count += self.rows[doc_index].n_tokens
+                    unsaved_indices.append(doc_index)
+                    if self.activation_cache is not None:
+                        self.activation_cache.put(
+                            sae_key, document_list[doc_index], result
+                        )
+            self._invalidate_caches()
+            if checkpoint_log and (i + 1) % save_every_batch == 0 and unsaved_indices:
+                if not os.path.isdir(save_path):
+                    self.save_to_file(save_path)
+                else:
+                    checkpoint_log.append(
+                        unsaved_indices,
+                        [_row_part(self.rows[ind]) for ind in unsaved_indices],
+                        self.d_sae(),
                     )
-                    self.rows[doc_index] = new_row
-            if save_path and (i + 1) % save_every_batch == 0:
-                self.save_to_file(save_path)
+                unsaved_indices = []
+            pbar.update(1)
             pbar.set_description(f"Computing latents \u2022 {self.token_count} tokens")
+        pbar.close()
+        self.encode_stats = pipeline.stats
+        log_tqdm_message(f"Encoding throughput: {pipeline.stats}")
         self.sae.destroy()  # Remove the language model and SAE from memory
+        self._finish_computation(save_path)
+
+    def _compute_latents_sharded(
+        self,
+        selected_document_indices,
+        document_list,
+        save_path=None,
+        save_every_batch=5,
+        batch_size=8,
+        max_tokens=None,
+        queue_size=2,
+        num_workers=2,
+        devices=None,
+    ):
+        """
+        Encode the rows at `selected_document_indices` in `num_workers` processes. Worker i takes
+        every `num_workers`-th row starting at i and appends its results to its own shard of the
+        checkpoint log (inside `save_path`, or a temporary directory), from which the rows are
+        merged back in dataset order. If a worker crashes, only the rows of its shard that were not
+        logged are left empty, and resuming computes just those.
+        """
+        if not self.sae.is_loaded():
+            self.sae.load_feature_labels()  # The SAE itself is only loaded by the workers
+        self._feature_labels = (
+            self._feature_labels or self.sae.feature_labels() or dict()
+        )
+        if save_path and not os.path.isdir(save_path):
+            self.save_to_file(save_path)  # Shard logs are written inside the saved dataset
+
+        sae_metadata = self.sae.metadata()
+        shards = [
+            selected_document_indices[shard_id::num_workers]
+            for shard_id in range(num_workers)
+        ]
+        context = multiprocessing.get_context(encode_pipeline.SHARD_START_METHOD)
+        progress = context.Queue()
+        with tempfile.TemporaryDirectory() as tmp_path:
+            log_directory = (
+                os.path.join(save_path, CHECKPOINT_LOG_DIR) if save_path else tmp_path
+            )
+            workers = {
+                shard_id: context.Process(
+                    target=encode_shard,
+                    args=(
+                        shard_id,
+                        sae_metadata,
+                        devices[shard_id % len(devices)] if devices else None,
+                        indices,
+                        [document_list[ind] for ind in indices],
+                        log_directory,
+                        progress,
+                    ),
+                    kwargs=dict(
+                        batch_size=batch_size,
+                        max_tokens=max_tokens,
+                        save_every_batch=save_every_batch,
+                        queue_size=queue_size,
+                    ),
+                )
+                for shard_id, indices in enumerate(shards)
+                if indices
+            }
+            for worker in workers.values():
+                worker.start()
+
+            pbar = tqdm(total=len(selected_document_indices), desc="Computing latents")
+            computed_tokens = 0
+            while any(worker.is_alive() for worker in workers.values()) or not (
+                progress.empty()
+            ):
+                try:
+                    shard_id, num_documents, num_tokens, error = progress.get(
+                        timeout=0.1
+                    )
+                except queue.Empty:
+                    continue
+                if error is not None:
+                    log_tqdm_message(f"ERROR (shard {shard_id}): {error}")
+                computed_tokens += num_tokens
+                pbar.update(num_documents)
+                pbar.set_description(
+                    f"Computing latents \u2022 {self.token_count + computed_tokens} tokens"
+                )
+            pbar.close()
+            for shard_id, worker in workers.items():
+                worker.join()
+                if worker.exitcode != 0:
+                    log_tqdm_message(
+                        f"ERROR (shard {shard_id}): worker exited with code {worker.exitcode}"
+                    )
+
+            # Merge the rows of every shard; segments of earlier runs were replayed on load
+            self.token_count += _replay_checkpoint_log(
+                self.rows,
+                CheckpointLog(log_directory),
+                self.dataset,
+                self.field,
+                indices=selected_document_indices,
+            )
+        self._invalidate_caches()
+
+        if self.activation_cache is not None:
+            sae_key = ActivationCache.sae_key(sae_metadata)
+            for ind in selected_document_indices:
+                if self.rows[ind] is not None:
+                    self.activation_cache.put(
+                        sae_key, document_list[ind], _row_part(self.rows[ind])
+                    )
+
+    def _row_from_result(self, row, result):
+        # DatasetRow from an (activations, aggregates, tokens) result of the encode pipeline
+        activations, aggregate_activations, tokens = result
+        token_ids, vocabulary = tokens if isinstance(tokens, tuple) else (None, None)
+        return DatasetRow(
+            row=row,
+            tokenized_document=None if token_ids is not None else tokens,
+            field=self.field,
+            activations=activations,
+            aggregate_activations=aggregate_activations,
+            token_ids=token_ids,
+            vocabulary=vocabulary,
+        )
+
+    def _load_cached_rows(self, indices, document_list, data_as_dict):
+        """
+        Assign the rows at `indices` whose documents are in the activation cache.
+
+        :return: Indices of the rows that were not found
+        """
+        sae_key = ActivationCache.sae_key(self.sae.metadata())
+        missing = []
+        for ind in indices:
+            result = self.activation_cache.get(sae_key, document_list[ind])
+            if result is None:
+                missing.append(ind)
+                continue
+            self.rows[ind] = self._row_from_result(data_as_dict[ind], result)
+            self.token_count += self.rows[ind].n_tokens
+        self._invalidate_caches()
+        log_tqdm_message(
+            f"Activation cache: {len(indices) - len(missing)} of {len(indices)} rows found"
+        )
+        return missing
+
+    def _finish_computation(self, save_path=None):
         if save_path:
             self.save_to_file(save_path)
+        if self.low_memory:
+            self._compact_rows(save_path)
+
+    def _activation_store(self, dtype=np.float32):
+        """
+        ActivationStore holding the activations of all rows.
+        """
+        if (
+            isinstance(self.rows, StoredRows)
+            and self.rows.is_unmodified_store()
+            and self.rows.store.token_activations.dtype == dtype
+        ):
+            return self.rows.store
+        elif isinstance(self.rows, StoredRows):
+            row_parts = self.rows.row_parts()
+            truncate_chat_template = self.rows.truncate_chat_template()
+        else:
+            row_parts = [_row_part(row) for row in self.rows]
+            truncate_chat_template = [
+                row is not None and row.truncate_chat_template for row in self.rows
+            ]
+        return ActivationStore.from_rows(
+            row_parts,
+            self.d_sae(),
+            dtype=dtype,
+            truncate_chat_template=truncate_chat_template,
+        )
+
+    def _compact_rows(self, file_path=None):
+        """
+        Replace the rows by views into one shared ActivationStore: the memory-mapped store saved
+        at `file_path` if given, otherwise one built in memory.
+        """
+        store = (
+            ActivationStore.load(file_path) if file_path else self._activation_store()
+        )
+        self.rows = StoredRows(store, self.dataset, field=self.field)
+        self._invalidate_caches()
 
     def save_to_file(self, file_path=None, dtype=np.float32):
         """
-        Save the Dataset parameters to a file.
+        Save the Dataset to a directory in a columnar format.
 
-        :param file_path: Path to the file where the parameters will be saved
+        Token-level activations are stored as one concatenated CSR matrix (data/indices/indptr .npy
+        files) indexed by per-row token offsets, and each aggregate ("max", "sum") as one
+        document-by-feature CSR matrix. The DataFrame and dataset metadata go in `dataset.pkl`.
+
+        :param file_path: Path to the directory where the dataset will be saved
+        :param dtype: Data type for storing activation values
         """
-        file_path = file_path or f"dataset_{self.id}.pkl"
+        file_path = file_path or f"dataset_{self.id}"
+        store = self._activation_store(dtype)
 
-        # Save only the essential parameters, keeping activations in sparse format
-        save_dict = {
+        metadata = {
             "dataset": self.dataset,
-            "rows": [
-                row.latents("all", compress=True).astype(dtype) if row else None
-                for row in self.rows
-            ],  # Keep as csr_matrix
-            "aggregate_activations": [
-                dict_astype(row.aggregate_activations, dtype) if row else None
-                for row in self.rows
-            ],
-            "tokenized_documents": [
-                row.tokenized_document if row else None for row in self.rows
-            ],
             "field": self.field,
             "dataset_description": self.dataset_description,
             "id": self.id,
             "sae_metadata": self.sae.metadata(),
             "feature_labels": self.feature_labels(),
         }
-        safe_save_pkl(save_dict, file_path)
+        with safe_save_dir(file_path) as tmp_path:
+            store.save(tmp_path)
+            safe_save_pkl(metadata, os.path.join(tmp_path, DATASET_METADATA_FILE))
 
     @classmethod
-    def load_from_file(cls, file_path, resume=False, batch_size=8, device="cuda:0"):
+    def load_from_file(
+        cls,
+        file_path,
+        resume=False,
+        batch_size=8,
+        device="cuda:0",
+        max_tokens=None,
+        num_workers=1,
+        devices=None,
+        activation_cache=None,
+    ):
         """
-        Load a Dataset from saved parameters.
-
-        :param file_path: Path to the file containing the saved parameters
+        Load a Dataset saved with `save_to_file`. Activations are memory-mapped, so loading does not
+        read them from disk; rows are built on first access. Pickle files written by older versions
+        are also supported.
+
+        :param file_path: Path to the saved dataset directory (or legacy pickle file)
+        :param resume: Whether to compute activations for rows that are missing them
+        :param batch_size: Batch size for resumed computation
+        :param max_tokens: Optional token budget per batch for resumed computation
+        :param num_workers: Number of worker processes for resumed computation
+        :param devices: Optional list of devices for the workers
+        :param activation_cache: Optional ActivationCache for resumed computation
         :return: Dataset instance
         """
+        if not os.path.isdir(file_path):
+            return cls._load_from_pickle(
+                file_path,
+                resume=resume,
+                batch_size=batch_size,
+                device=device,
+                max_tokens=max_tokens,
+                num_workers=num_workers,
+                devices=devices,
+                activation_cache=activation_cache,
+            )
+
+        params = safe_load_pkl(os.path.join(file_path, DATASET_METADATA_FILE))
+        store = ActivationStore.load(file_path)
+        rows = StoredRows(store, params["dataset"], field=params["field"])
+
+        # Replay rows checkpointed by an interrupted computation
+        _replay_checkpoint_log(
+            rows,
+            CheckpointLog(os.path.join(file_path, CHECKPOINT_LOG_DIR)),
+            params["dataset"],
+            params["field"],
+        )
+        return cls._from_saved_params(
+            params,
+            rows,
+            file_path,
+            resume=resume,
+            batch_size=batch_size,
+            device=device,
+            max_tokens=max_tokens,
+            num_workers=num_workers,
+            devices=devices,
+            activation_cache=activation_cache,
+        )
+
+    @classmethod
+    def _load_from_pickle(
+        cls,
+        file_path,
+        resume=False,
+        batch_size=8,
+        device="cuda:0",
+        max_tokens=None,
+        num_workers=1,
+        devices=None,
+        activation_cache=None,
+    ):
         params = safe_load_pkl(file_path)
 
         # Create DatasetRow objects from the saved activations (already in sparse format)
@@ -216,7 +572,33 @@ class Dataset:
                         aggregate_activations=params["aggregate_activations"][i],
                     )
                 )
+        return cls._from_saved_params(
+            params,
+            rows,
+            file_path,
+            resume=resume,
+            batch_size=batch_size,
+            device=device,
+            max_tokens=max_tokens,
+            num_workers=num_workers,
+            devices=devices,
+            activation_cache=activation_cache,
+        )
 
+    @classmethod
+    def _from_saved_params(
+        cls,
+        params,
+        rows,
+        file_path,
+        resume=False,
+        batch_size=8,
+        device="cuda:0",
+        max_tokens=None,
+        num_workers=1,
+        devices=None,
+        activation_cache=None,
+    ):
         # Create and return the Dataset
         sae = load_sae_from_metadata(params["sae_metadata"])
         sae.set_device(device)
@@ -230,6 +612,10 @@ class Dataset:
             compute_activations=resume,
             feature_labels=params["feature_labels"],
             batch_size=batch_size,
+            max_tokens=max_tokens,
+            num_workers=num_workers,
+            devices=devices,
+            activation_cache=activation_cache,
         )
         dataset.id = params["id"]
         return dataset
@@ -237,6 +623,27 @@ class Dataset:
     def feature_labels(self):
         return {int(key): value for key, value in self._feature_labels.items()}
 
+    def d_sae(self):
+        """
+        Number of SAE features, or 4096 if no latents have been computed.
+        """
+        if isinstance(self.rows, StoredRows):
+            return self.rows.d_sae()
+        for row in self.rows:
+            if row is not None:
+                return row.latents("all", compress=True).shape[1]
+        return 4096
+
+    def _valid_row_mask(self):
+        if isinstance(self.rows, StoredRows):
+            return self.rows.valid_mask()
+        return np.array([row is not None for row in self.rows], dtype=bool)
+
+    def _take_rows(self, indices):
+        if isinstance(self.rows, StoredRows):
+            return self.rows[indices]
+        return [self.rows[i] for i in indices]
+
     def latents(self, aggregation_method="max", compress=False, activated_threshold=0):
         """
         Get the feature activations for all samples.
@@ -247,11 +654,7 @@ class Dataset:
         if self.num_documents == 0:
             return None
 
-        d_sae = 4096  # default SAE dimension if no latents have been computed
-        for row in self.rows:
-            if row is not None:
-                d_sae = row.latents(compress=True).shape[1]
-                break
+        d_sae = self.d_sae()
 
         if aggregation_method == "all":
             all_activations = []
@@ -270,35 +673,127 @@ class Dataset:
                 else all_activations
             )
 
-        all_feature_activations = []
-        if aggregation_method in ["max", "mean", "sum", "binarize", "count"]:
-            for row in self.rows:
-                if row is not None:
-                    all_feature_activations.append(
-                        row.latents(
-                            aggregation_method,
-                            compress=True,
-                            activated_threshold=activated_threshold,
-                        )
-                    )
-                else:
-                    all_feature_activations.append(
-                        np.full(d_sae, np.nan)
-                        if not compress
-                        else csr_matrix(np.full(d_sae, np.nan))
-                    )
-        else:
+        if aggregation_method not in ["max", "mean", "sum", "binarize", "count"]:
             raise ValueError(
                 f"Unsupported aggregation method for feature activations: {aggregation_method}"
             )
 
-        all_feature_activations_NF = vstack(all_feature_activations)
+        # The document x feature matrix is built once per aggregation method and reused until
+        # rows change. The cached matrix is shared between calls, so don't modify it in place.
+        self._sync_caches()
+        cache_key = (
+            aggregation_method,
+            (
+                activated_threshold
+                if aggregation_method in ["binarize", "count"]
+                else None
+            ),
+        )
+        if cache_key not in self._latents_cache:
+            self._latents_cache[cache_key] = self._aggregate_latents(
+                aggregation_method, activated_threshold
+            )
+        all_feature_activations_NF = self._latents_cache[cache_key]
         return (
             all_feature_activations_NF
             if compress
             else all_feature_activations_NF.toarray()
         )
 
+    @property
+    def rows(self):
+        """
+        The DatasetRow of each document (None if it has no activations), as a StoredRows or a
+        RowList. Both count their changes in `version`, so assigning `dataset.rows[i]` invalidates
+        the cached latents and indices.
+        """
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows):
+        self._rows = rows if isinstance(rows, (StoredRows, RowList)) else RowList(rows)
+        self._invalidate_caches()
+
+    def _invalidate_caches(self):
+        self._latents_cache.clear()
+        self._feature_index_cache.clear()
+        self._cached_rows_version = self.rows.version
+
+    def _sync_caches(self):
+        if self.rows.version != self._cached_rows_version:
+            self._invalidate_caches()
+
+    def _aggregate_latents(self, aggregation_method, activated_threshold=0):
+        """
+        Build the (num_documents, d_sae) CSR matrix for an aggregation method in one vectorized pass
+        over the valid rows. Rows without activations are filled with NaN.
+        """
+        valid = self._valid_row_mask()
+        if aggregation_method in ["max", "sum"]:
+            latents = self._valid_aggregate(aggregation_method)
+        elif aggregation_method == "mean":
+            latents = self._valid_aggregate("sum")
+            n_tokens = self._valid_num_tokens()
+            latents = (diags(1.0 / n_tokens) @ latents).astype(latents.dtype)
+        elif aggregation_method == "binarize":
+            latents = self._valid_aggregate("max").copy()
+            latents.data = (latents.data > activated_threshold).astype(
+                latents.data.dtype
+            )
+        else:
+            latents = self._valid_token_counts(activated_threshold)
+
+        if valid.all():
+            return csr_matrix(latents)
+
+        # Place the valid rows and fill the others with NaN
+        latents = latents.tocoo()
+        dtype = latents.dtype if latents.dtype.kind == "f" else np.float32
+        d_sae = latents.shape[1]
+        invalid_indices = np.where(~valid)[0]
+        rows = np.concatenate(
+            [np.where(valid)[0][latents.row], np.repeat(invalid_indices, d_sae)]
+        )
+        cols = np.concatenate(
+            [latents.col, np.tile(np.arange(d_sae), len(invalid_indices))]
+        )
+        data = np.concatenate(
+            [
+                latents.data.astype(dtype),
+                np.full(len(invalid_indices) * d_sae, np.nan, dtype=dtype),
+            ]
+        )
+        return coo_matrix((data, (rows, cols)), shape=(len(valid), d_sae)).tocsr()
+
+    def _valid_rows(self):
+        return [row for row in self.rows if row is not None]
+
+    def _valid_aggregate(self, name):
+        if isinstance(self.rows, StoredRows):
+            return self.rows.valid_aggregate(name)
+        return stack_csr_rows(
+            [
+                aggregate_row(row.activations, row.aggregate_activations, name)
+                for row in self._valid_rows()
+            ],
+            self.d_sae(),
+        )
+
+    def _valid_num_tokens(self):
+        if isinstance(self.rows, StoredRows):
+            return self.rows.valid_num_tokens()
+        return np.array([row.n_tokens for row in self._valid_rows()])
+
+    def _valid_token_counts(self, activated_threshold=0):
+        if isinstance(self.rows, StoredRows):
+            return self.rows.valid_token_counts(activated_threshold)
+        rows = self._valid_rows()
+        token_activations = stack_csr_rows(
+            [row.activations for row in rows], self.d_sae()
+        )
+        row_offsets = np.concatenate([[0], np.cumsum([row.n_tokens for row in rows])])
+        return count_active_tokens(token_activations, row_offsets, activated_threshold)
+
     def top_documents_for_feature(
         self,
         feature,
@@ -308,167 +803,432 @@ class Dataset:
         include_nonactive_samples=False,
         include_active_samples=True,
     ):
-        latents = self.latents(aggregation_method=aggregation_type)[:, feature]
-        valid_mask = np.ones(latents.shape[0], dtype=bool)
-        valid_mask[np.isnan(latents)] = False
-        if not include_active_samples:
-            valid_mask[latents > 0] = False
-        if not include_nonactive_samples:
-            valid_mask[latents == 0] = False
-        valid_indices = np.where(valid_mask)[0]
-        if select_top:
-            selected_indices = (
-                np.argpartition(latents[valid_indices], -k)[-k:]
-                if len(valid_indices) > k
-                else valid_indices
+        """
+        Token activation strings of the k documents with the highest (or lowest) activation for a
+        feature. Uses the dataset's inverted feature index, so the activation matrix is never
+        densified.
+        """
+        selected_indices = self.feature_index(aggregation_type).select(
+            feature,
+            k,
+            select_top=select_top,
+            include_active_samples=include_active_samples,
+            include_nonactive_samples=include_nonactive_samples,
+        )
+        return [self.rows[ind].token_activations(feature) for ind in selected_indices]
+
+    def top_documents_for_features(
+        self,
+        features,
+        aggregation_type="max",
+        k=10,
+        select_top=True,
+        include_nonactive_samples=False,
+        include_active_samples=True,
+    ):
+        """
+        Batched `top_documents_for_feature`: token activation strings of the top (or bottom) k
+        documents for every feature in `features`, selected in one vectorized pass over the
+        feature index. Rows shared between features are only looked up once.
+
+        :return: Dictionary mapping each feature to its list of token activation strings
+        """
+        features = [int(feature) for feature in features]
+        selected = self.feature_index(aggregation_type).select_many(
+            features,
+            k,
+            select_top=select_top,
+            include_active_samples=include_active_samples,
+            include_nonactive_samples=include_nonactive_samples,
+        )
+        rows = {
+            ind: self.rows[ind]
+            for ind in np.unique(np.concatenate(selected + [np.array([], dtype=int)]))
+        }
+        return {
+            feature: [rows[ind].token_activations(feature) for ind in indices]
+            for feature, indices in zip(features, selected)
+        }
+
+    def feature_index(self, aggregation_type="max"):
+        """
+        Inverted index from feature to the documents activating it, sorted by activation. Built once
+        per aggregation type and cached until rows change.
+        """
+        self._sync_caches()
+        if aggregation_type not in self._feature_index_cache:
+            self._feature_index_cache[aggregation_type] = FeatureIndex.from_latents(
+                self.latents(aggregation_type, compress=True), self._valid_row_mask()
             )
-        else:
-            selected_indices = (
-                np.argpartition(latents[valid_indices], k)[:k]
-                if len(valid_indices) > k
-                else valid_indices
+        return self._feature_index_cache[aggregation_type]
+
+    def minhash_index(self, num_perm=128, bands=32):
+        """
+        MinHash/LSH index over the set of active features of each document (see MinHashIndex).
+        Built once per configuration and cached until rows change.
+        """
+        cache_key = ("minhash", num_perm, bands)
+        self._sync_caches()
+        if cache_key not in self._feature_index_cache:
+            self._feature_index_cache[cache_key] = MinHashIndex.from_latents(
+                self.latents("binarize", compress=True), num_perm=num_perm, bands=bands
             )
+        return self._feature_index_cache[cache_key]
+
+    def similar_documents(self, idx, k=10, num_perm=128, bands=32):
+        """
+        Documents whose sets of active features are most similar (by Jaccard similarity) to that
+        of document `idx`. Only documents sharing an LSH bucket with it are compared, so similar
+        documents may be missed when their similarity is low.
 
+        :param idx: Index of the query document
+        :param k: Maximum number of documents to return
+        :return: List of (document index, Jaccard similarity), by decreasing similarity
+        """
+        documents, similarities = self.minhash_index(num_perm, bands).similar(idx, k)
         return [
-            self.rows[ind].token_activations(feature)
-            for ind in valid_indices[selected_indices]
+            (int(document), float(similarity))
+            for document, similarity in zip(documents, similarities)
         ]
 
-    async def score_feature(
-        self,
-        feature,
-        label,
-        model="google/gemini-2.5-flash",
-        positive_dataset=None,
-        negative_dataset=None,
-        k=10,
-    ):
-        positive_dataset, negative_dataset = (
-            positive_dataset or self,
-            negative_dataset or self,
+    def near_duplicates(self, threshold=0.9, num_perm=128, bands=32):
+        """
+        Pairs of documents whose sets of active features have a Jaccard similarity of at least
+        `threshold`. With the default 32 bands of 4 signature rows, pairs above 0.8 similarity are
+        found with probability over 99.9%; for lower thresholds, use more bands of fewer rows (e.g.
+        `bands=64`).
+
+        :param threshold: Minimum Jaccard similarity
+        :return: List of (document index, document index, Jaccard similarity), by decreasing
+            similarity
+        """
+        left, right, similarities = self.minhash_index(num_perm, bands).near_duplicates(
+            threshold
         )
+        return [
+            (int(i), int(j), float(similarity))
+            for i, j, similarity in zip(left, right, similarities)
+        ]
 
-        # Select k indices randomly from 0 to 3k
-        superset_positive_samples = positive_dataset.top_documents_for_feature(
-            feature, select_top=True, k=3 * k
-        )
-        indices = (
-            random.sample(list(range(len(superset_positive_samples))), k)
-            if len(superset_positive_samples) > k
-            else list(range(len(superset_positive_samples)))
-        )
-        positive_samples = [superset_positive_samples[i] for i in indices]
+    def _draw_feature_samples(self, features, k, positive_dataset, negative_dataset):
+        """
+        For each feature, k documents drawn at random from the 3k documents of `positive_dataset`
+        that activate it most, and k from the first 3k documents of `negative_dataset` that do not
+        activate it, as token activation strings. The candidates of all features are selected in
+        one pass over the feature indices, and only the drawn documents are formatted.
 
-        superset_negative_samples = negative_dataset.top_documents_for_feature(
-            feature,
+        :return: Dictionary mapping each feature to (positive samples, negative samples)
+        """
+        features = [int(feature) for feature in features]
+        positive_candidates = positive_dataset.feature_index().select_many(
+            features, 3 * k, select_top=True
+        )
+        negative_candidates = negative_dataset.feature_index().select_many(
+            features,
+            3 * k,
             select_top=False,
-            k=3 * k,
             include_nonactive_samples=True,
             include_active_samples=False,
         )
-        indices = (
-            random.sample(list(range(len(superset_negative_samples))), k)
-            if len(superset_negative_samples) > k
-            else list(range(len(superset_negative_samples)))
-        )
-        negative_samples = [superset_negative_samples[i] for i in indices]
 
-        positive_prompts = [
-            build_scoring_prompt(label, positive_sample, sample_type="positive")
-            for positive_sample in positive_samples
-        ]
-        negative_prompts = [
-            build_scoring_prompt(label, negative_sample, sample_type="negative")
-            for negative_sample in negative_samples
-        ]
+        def draw(candidates):
+            candidates = candidates.tolist()
+            return random.sample(candidates, k) if len(candidates) > k else candidates
 
-        # Call API on all prompts in parallel
+        return {
+            feature: (
+                [positive_dataset.rows[ind].token_activations(feature) for ind in draw(positive)],
+                [negative_dataset.rows[ind].token_activations(feature) for ind in draw(negative)],
+            )
+            for feature, positive, negative in zip(
+                features, positive_candidates, negative_candidates
+            )
+        }
+
+    def _scoring_requests(
+        self,
+        label,
+        positive_samples,
+        negative_samples,
+        model,
+        batch_size=1,
+        use_cache=True,
+        max_concurrency=None,
+    ):
+        """
+        Scoring requests for the samples, as (samples, coroutine) pairs where `samples` lists the
+        (sample type, sample index) of each sample scored by the request. The positive and negative
+        samples are interleaved, so requests released in order by the rate limiter cover both sides
+        evenly. With a `batch_size` above 1, up to `batch_size` samples share one request and its
+        copy of the instructions.
+        """
         llm_client = get_llm_client(
             is_openai_model=model.startswith("openai/"), is_async=True
         )
-        positive_tasks = [
-            call_async_llm(
-                client=llm_client,
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-            )
-            for prompt in positive_prompts
+        samples = {"positive": positive_samples, "negative": negative_samples}
+        order = [
+            (sample_type, index)
+            for index in range(max(len(positive_samples), len(negative_samples)))
+            for sample_type, type_samples in samples.items()
+            if index < len(type_samples)
         ]
-        negative_tasks = [
-            call_async_llm(
-                client=llm_client,
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
+        requests = []
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            if len(batch) == 1:
+                ((sample_type, index),) = batch
+                prompt = build_scoring_prompt(
+                    label, samples[sample_type][index], sample_type=sample_type
+                )
+            else:
+                prompt = build_batch_scoring_prompt(
+                    label,
+                    [samples[sample_type][index] for sample_type, index in batch],
+                    [sample_type for sample_type, _ in batch],
+                )
+            requests.append(
+                (
+                    batch,
+                    call_async_llm(
+                        client=llm_client,
+                        model=model,
+                        messages=[{"role": "user", "content": prompt}],
+                        use_cache=use_cache,
+                        validate=functools.partial(
+                            self._validate_scoring_response, n_samples=len(batch)
+                        ),
+                        max_concurrency=max_concurrency,
+                    ),
+                )
+            )
+        return requests
+
+    @staticmethod
+    def _parse_scoring_response(response, n_samples=1):
+        """
+        The SingleSampleScoringResponse of each of the `n_samples` samples scored by an LLM
+        response (a batch if `n_samples` is above 1). Samples whose score cannot be parsed get the
+        exception raised instead.
+        """
+        try:
+            content = response.choices[0].message.content
+
+            # Extract JSON from response
+            json_str = extract_json_from_response(content)
+            response_data = json.loads(json_str)
+            if n_samples == 1:
+                return [SingleSampleScoringResponse(**response_data)]
+            scores = {
+                score.id: score for score in BatchScoringResponse(**response_data).scores
+            }
+        except Exception as e:
+            return [e] * n_samples
+        return [
+            SingleSampleScoringResponse(
+                score=scores[i].score, explanation=scores[i].explanation
             )
-            for prompt in negative_prompts
+            if i in scores
+            else KeyError(f"No score for sample {i} of the batch")
+            for i in range(n_samples)
         ]
 
-        positive_responses = await asyncio.gather(*positive_tasks)
-        negative_responses = await asyncio.gather(*negative_tasks)
+    @staticmethod
+    def _validate_scoring_response(response, n_samples=1):
+        """
+        Raise the first error parsing the scores of an LLM response, so that responses missing
+        scores are not cached.
+        """
+        for result in Dataset._parse_scoring_response(response, n_samples):
+            if isinstance(result, Exception):
+                raise result
+
+    @staticmethod
+    def _parse_labeling_response(response):
+        content = response.choices[0].message.content
+
+        # Extract JSON from response
+        json_str = extract_json_from_response(content)
+        response_data = json.loads(json_str)
+        return FeatureLabelResponse(**response_data)
+
+    async def _score_samples(
+        self,
+        label,
+        positive_samples,
+        negative_samples,
+        model,
+        batch_size=1,
+        use_cache=True,
+        max_concurrency=None,
+    ):
+        requests = self._scoring_requests(
+            label,
+            positive_samples,
+            negative_samples,
+            model,
+            batch_size=batch_size,
+            use_cache=use_cache,
+            max_concurrency=max_concurrency,
+        )
+
+        # Call API on the positive and negative prompts at once
+        responses = await asyncio.gather(*(request for _, request in requests))
+        results = {"positive": [None] * len(positive_samples)}
+        results["negative"] = [None] * len(negative_samples)
+        for (batch, _), response in zip(requests, responses):
+            for (sample_type, index), result in zip(
+                batch, self._parse_scoring_response(response, len(batch))
+            ):
+                results[sample_type][index] = result
 
         tally = 0
         total = 0
-        results = []
-        for response in positive_responses + negative_responses:
-            try:
-                content = response.choices[0].message.content
-
-                # Extract JSON from response
-                json_str = extract_json_from_response(content)
-                response_data = json.loads(json_str)
-                scored_response = SingleSampleScoringResponse(**response_data)
-                results.append(scored_response)
-                tally += scored_response.score
+        for result in results["positive"] + results["negative"]:
+            if isinstance(result, SingleSampleScoringResponse):
+                tally += result.score
                 total += 1
-            except Exception as e:
-                results.append(e)
 
         return {
             "score": tally / total if total > 0 else 0,
             "total_count": total,
-            "responses": results,
+            "responses": results["positive"] + results["negative"],
             "positive_samples": positive_samples,
             "negative_samples": negative_samples,
         }
 
-    async def label_feature(
+    async def score_feature(
         self,
         feature,
+        label,
         model="google/gemini-2.5-flash",
-        label_and_score=None,
         positive_dataset=None,
         negative_dataset=None,
-        k=20,
+        k=10,
+        batch_size=1,
+        use_cache=True,
     ):
         positive_dataset, negative_dataset = (
             positive_dataset or self,
             negative_dataset or self,
         )
-
-        superset_positive_samples = positive_dataset.top_documents_for_feature(
-            feature, select_top=True, k=3 * k
-        )
-        indices = (
-            random.sample(list(range(len(superset_positive_samples))), k)
-            if len(superset_positive_samples) > k
-            else list(range(len(superset_positive_samples)))
+        positive_samples, negative_samples = self._draw_feature_samples(
+            [feature], k, positive_dataset, negative_dataset
+        )[int(feature)]
+        return await self._score_samples(
+            label,
+            positive_samples,
+            negative_samples,
+            model,
+            batch_size=batch_size,
+            use_cache=use_cache,
         )
-        positive_samples = [superset_positive_samples[i] for i in indices]
 
-        superset_negative_samples = negative_dataset.top_documents_for_feature(
-            feature,
-            select_top=False,
-            k=3 * k,
-            include_nonactive_samples=True,
-            include_active_samples=False,
-        )
-        indices = (
-            random.sample(list(range(len(superset_negative_samples))), k)
-            if len(superset_negative_samples) > k
-            else list(range(len(superset_negative_samples)))
+    async def score_feature_stream(
+        self,
+        feature,
+        label,
+        model="google/gemini-2.5-flash",
+        positive_dataset=None,
+        negative_dataset=None,
+        k=10,
+        threshold=None,
+        confidence=0.95,
+        min_count=4,
+        batch_size=1,
+        use_cache=True,
+    ):
+        """
+        Score a label as `score_feature` does, yielding each sample's score as its response
+        arrives. All requests are sent at once; each yielded dictionary holds the sample's
+        `sample_type` ("positive" or "negative"), `index`, `sample` and `response` (a
+        SingleSampleScoringResponse, or the exception raised requesting or parsing it), and the
+        running `score`, `total_count` and Wilson confidence interval `ci_low`/`ci_high`.
+
+        With a `threshold`, the stream stops early, and the outstanding requests are cancelled,
+        once at least `min_count` samples are scored and the interval lies entirely above or below
+        the threshold, so clearly good or bad labels do not use all 2k requests. The last yielded
+        dictionary then has `stopped_early` set. With a `batch_size` above 1, the samples scored by
+        one request are yielded together when it completes.
+
+        :param threshold: Score the label is compared against, or None to score every sample
+        :param confidence: Confidence level of the interval
+        :param min_count: Minimum number of scored samples before stopping early
+        """
+        positive_dataset, negative_dataset = (
+            positive_dataset or self,
+            negative_dataset or self,
         )
-        negative_samples = [superset_negative_samples[i] for i in indices]
+        positive_samples, negative_samples = self._draw_feature_samples(
+            [feature], k, positive_dataset, negative_dataset
+        )[int(feature)]
+        samples = {"positive": positive_samples, "negative": negative_samples}
+        tasks = {
+            asyncio.ensure_future(request): (order, batch)
+            for order, (batch, request) in enumerate(
+                self._scoring_requests(
+                    label,
+                    positive_samples,
+                    negative_samples,
+                    model,
+                    batch_size=batch_size,
+                    use_cache=use_cache,
+                )
+            )
+        }
 
+        tally = 0
+        total = 0
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Yield in request order when several responses arrive together
+                for task in sorted(done, key=lambda task: tasks[task][0]):
+                    _, batch = tasks[task]
+                    if task.exception() is not None:
+                        responses = [task.exception()] * len(batch)
+                    else:
+                        responses = self._parse_scoring_response(
+                            task.result(), len(batch)
+                        )
+                    for (sample_type, index), response in zip(batch, responses):
+                        if isinstance(response, SingleSampleScoringResponse):
+                            tally += response.score
+                            total += 1
+                        ci_low, ci_high = wilson_interval(tally, total, confidence)
+                        stopped_early = (
+                            threshold is not None
+                            and total >= min_count
+                            and (ci_low > threshold or ci_high < threshold)
+                        )
+                        yield {
+                            "sample_type": sample_type,
+                            "index": index,
+                            "sample": samples[sample_type][index],
+                            "response": response,
+                            "score": tally / total if total > 0 else 0,
+                            "total_count": total,
+                            "ci_low": ci_low,
+                            "ci_high": ci_high,
+                            "stopped_early": stopped_early,
+                        }
+                        if stopped_early:
+                            return
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _label_samples(
+        self,
+        positive_samples,
+        negative_samples,
+        model,
+        label_and_score=None,
+        use_cache=True,
+        max_concurrency=None,
+    ):
         labeling_prompt = build_labeling_prompt(
             positive_samples, negative_samples, label_and_score=label_and_score
         )
@@ -479,20 +1239,197 @@ class Dataset:
             client=llm_client,
             model=model,
             messages=[{"role": "user", "content": labeling_prompt}],
+            use_cache=use_cache,
+            validate=self._parse_labeling_response,
+            max_concurrency=max_concurrency,
         )
 
         # Process LLM response
         try:
-            content = response.choices[0].message.content
-
-            # Extract JSON from response
-            json_str = extract_json_from_response(content)
-            response_data = json.loads(json_str)
-            feature_label = FeatureLabelResponse(**response_data)
-            return feature_label
+            return self._parse_labeling_response(response)
         except Exception as e:
             print(f"Failed to process LLM response: {e}")
 
+    async def label_feature(
+        self,
+        feature,
+        model="google/gemini-2.5-flash",
+        label_and_score=None,
+        positive_dataset=None,
+        negative_dataset=None,
+        k=20,
+        use_cache=True,
+    ):
+        positive_dataset, negative_dataset = (
+            positive_dataset or self,
+            negative_dataset or self,
+        )
+        positive_samples, negative_samples = self._draw_feature_samples(
+            [feature], k, positive_dataset, negative_dataset
+        )[int(feature)]
+        return await self._label_samples(
+            positive_samples,
+            negative_samples,
+            model,
+            label_and_score=label_and_score,
+            use_cache=use_cache,
+        )
+
+    async def label_features(
+        self,
+        features=None,
+        model="google/gemini-2.5-flash",
+        k=20,
+        score_k=10,
+        max_concurrency=32,
+        checkpoint_path=None,
+        positive_dataset=None,
+        negative_dataset=None,
+        chunk_size=None,
+        score_batch_size=1,
+        use_cache=True,
+    ):
+        """
+        Label and score many features concurrently, as `label_feature` followed by `score_feature`
+        with the new label. Labels are written to the dataset's feature labels as they complete.
+
+        Samples are drawn for a chunk of features at a time in one vectorized pass, and the next
+        chunk is drawn while the previous one is still being labeled, so throughput is bounded by
+        the LLM rate limits (see `interp_embed.llm.rate_limit`) rather than by sample selection.
+
+        Each labeled feature is appended to the JSONL file at `checkpoint_path`. When the file
+        already exists, the features it holds are loaded instead of labeled again, so an
+        interrupted run resumes where it stopped. Features whose labeling failed are not recorded
+        and are retried by the next run.
+
+        :param features: Features to label; defaults to every feature that activates on at least
+            one document of the positive dataset
+        :param k: Number of positive and negative samples shown to the labeling model
+        :param score_k: Number of positive and negative samples used to score the label
+        :param max_concurrency: Maximum number of LLM requests in flight, shared with the other
+            callers of the model's endpoint (see `RateLimiter.set_max_concurrency`)
+        :param checkpoint_path: Path of the JSONL checkpoint file, or None for no checkpoint
+        :param chunk_size: Number of features whose samples are drawn at once (defaults to
+            4 * max_concurrency)
+        :param score_batch_size: Number of samples scored per request (see `score_feature`)
+        :return: DataFrame with one row per labeled feature and the columns feature, label,
+            brief_description, detailed_explanation, score and total_count
+        """
+        positive_dataset, negative_dataset = (
+            positive_dataset or self,
+            negative_dataset or self,
+        )
+        if features is None:
+            features = np.flatnonzero(np.diff(positive_dataset.feature_index().indptr))
+        features = list(dict.fromkeys(int(feature) for feature in features))
+        chunk_size = chunk_size or 4 * max_concurrency
+
+        records = dict()
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records[record["feature"]] = record
+        for feature, record in records.items():
+            self._feature_labels[feature] = record["label"]
+        pending = [feature for feature in features if feature not in records]
+
+        async def label_and_score(feature, label_samples, score_samples):
+            try:
+                response = await self._label_samples(
+                    *label_samples,
+                    model,
+                    use_cache=use_cache,
+                    max_concurrency=max_concurrency,
+                )
+                if response is None:
+                    return feature, None
+                result = await self._score_samples(
+                    response.label,
+                    *score_samples,
+                    model,
+                    batch_size=score_batch_size,
+                    use_cache=use_cache,
+                    max_concurrency=max_concurrency,
+                )
+            except Exception as e:
+                log_tqdm_message(f"Failed to label feature {feature}: {e}")
+                return feature, None
+            return feature, {
+                "feature": feature,
+                "label": response.label,
+                "brief_description": response.brief_description,
+                "detailed_explanation": response.detailed_explanation,
+                "score": result["score"],
+                "total_count": result["total_count"],
+            }
+
+        checkpoint = (
+            open(checkpoint_path, "a") if checkpoint_path is not None else None
+        )
+        progress = tqdm(total=len(pending), desc="Labeling features")
+        tasks = set()
+
+        def finish(done):
+            for task in done:
+                feature, record = task.result()
+                progress.update(1)
+                if record is None:
+                    continue
+                records[feature] = record
+                self._feature_labels[feature] = record["label"]
+                if checkpoint is not None:
+                    checkpoint.write(json.dumps(record) + "\n")
+                    checkpoint.flush()
+
+        try:
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start : start + chunk_size]
+                label_samples = self._draw_feature_samples(
+                    chunk, k, positive_dataset, negative_dataset
+                )
+                score_samples = self._draw_feature_samples(
+                    chunk, score_k, positive_dataset, negative_dataset
+                )
+                tasks.update(
+                    asyncio.ensure_future(
+                        label_and_score(
+                            feature, label_samples[feature], score_samples[feature]
+                        )
+                    )
+                    for feature in chunk
+                )
+                # Draw the next chunk once fewer than a chunk of features are left
+                while len(tasks) >= chunk_size:
+                    done, tasks = await asyncio.wait(
+                        tasks, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    finish(done)
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                finish(done)
+        finally:
+            for task in tasks:
+                task.cancel()
+            progress.close()
+            if checkpoint is not None:
+                checkpoint.close()
+
+        return pd.DataFrame(
+            [records[feature] for feature in features if feature in records],
+            columns=[
+                "feature",
+                "label",
+                "brief_description",
+                "detailed_explanation",
+                "score",
+                "total_count",
+            ],
+        )
+
     def token_activations(self, feature):
         return [row.token_activations(feature) for row in self.rows]
 
@@ -515,9 +1452,9 @@ class Dataset:
         Sort data samples by specified features and activation type.
 
         """
-        feature_activations_DF = self.latents(aggregation_type)
+        feature_activations_DF = self.latents(aggregation_type, compress=True)
 
-        selected_feature_activations = feature_activations_DF[:, features]
+        selected_feature_activations = feature_activations_DF[:, features].toarray()
         feature_labels = self.feature_labels()
         top_features = []
         irrelevant_samples = []
@@ -570,9 +1507,7 @@ class Dataset:
         )  # TODO: columns of dataset rows won't be updated.
 
     def filter_na_rows(self):
-        selected_indices = [
-            ind for ind in range(len(self.rows)) if self.rows[ind] is not None
-        ]
+        selected_indices = np.where(self._valid_row_mask())[0]
         return self[selected_indices]
 
     def dataset_rows(self):
@@ -614,7 +1549,7 @@ class Dataset:
             + f"{' ' * 2}rows=[\n"
             + "\n".join(rows)
             + "\n  ]"
-            + f"{' ' * 2}na_rows={len([row for row in self.rows if row is None])}"
+            + f"{' ' * 2}na_rows={int((~self._valid_row_mask()).sum())}"
             + "\n)"
         )
 
@@ -652,7 +1587,7 @@ class Dataset:
                     if isinstance(index, pd.Series)
                     else np.where(index)[0]
                 )
-                selected_activations = [self.rows[i] for i in true_indices]
+                selected_activations = self._take_rows(true_indices)
                 new_dataset = Dataset(
                     selected_data,
                     sae=self.sae,
@@ -665,7 +1600,7 @@ class Dataset:
                 return new_dataset
             elif isinstance(index, np.ndarray) and index.dtype == int:
                 selected_data = self.dataset.iloc[index]
-                selected_activations = [self.rows[i] for i in index]
+                selected_activations = self._take_rows(index)
                 new_dataset = Dataset(
                     selected_data,
                     sae=self.sae,
@@ -683,7 +1618,57 @@ class Dataset:
         return iter(self.rows)
 
 
+def _replay_checkpoint_log(rows, checkpoint_log, dataset, field, indices=None):
+    """
+    Assign the rows stored in `checkpoint_log` (only those at `indices`, if given) into `rows`.
+
+    :return: Number of tokens in the assigned rows
+    """
+    wanted = None if indices is None else set(indices)
+    num_tokens = 0
+    for segment_indices, segment in checkpoint_log.segments():
+        for position, index in enumerate(segment_indices.tolist()):
+            if wanted is not None and index not in wanted:
+                continue
+            rows[index] = DatasetRow(
+                row=dataset.iloc[index].to_dict(),
+                tokenized_document=None,
+                field=field,
+                activations=segment.row_activations(position),
+                aggregate_activations=segment.row_aggregates(position),
+                token_ids=segment.row_token_ids(position),
+                vocabulary=segment.vocabulary,
+            )
+            num_tokens += rows[index].n_tokens
+    return num_tokens
+
+
+def _row_part(row):
+    # A row in the form `ActivationStore.from_rows` takes
+    if row is None:
+        return None
+    return (
+        row.latents("all", compress=True),
+        row.aggregate_activations,
+        row._token_part(),
+    )
+
+
 class DatasetRow:
+    __slots__ = (
+        "field",
+        "truncate_chat_template",
+        "_row",
+        "_tokens",
+        "_vocabulary",
+        "_activations",
+        "_aggregates",
+        "_store",
+        "_position",
+        "_records",
+        "_overlays",
+    )
+
     def __init__(
         self,
         row,
@@ -693,15 +1678,26 @@ class DatasetRow:
         aggregate_activations=None,
         field="text",
         low_memory=False,
+        token_ids=None,
+        vocabulary=None,
     ):
         """
         Initialize a DatasetRow instance.
 
         :param sample: Dictionary containing the text sample
         :param activations: Optional precomputed token activations (compressed sparse matrix)
-        :param aggregate_activations: Optional precomputed aggregate activations (dense matrix)
+        :param aggregate_activations: Optional precomputed aggregate activations (sparse matrices)
         :param field: Field in the sample dictionary that contains the text
+        :param low_memory: If True, aggregate activations are not kept; `latents` computes them
+            from the token activations when needed
+        :param token_ids: Optional token ids to keep instead of `tokenized_document` (pass None for
+            it); token strings are then looked up in `vocabulary` when needed
+        :param vocabulary: Vocabulary that `token_ids` index into
         """
+        if tokenized_document is None:
+            assert (
+                token_ids is not None and vocabulary is not None
+            ), "token_ids and vocabulary are required without tokenized_document"
         assert isinstance(
             row, dict
         ), f"sample must be a dictionary. Found type {type(row)}"
@@ -709,35 +1705,128 @@ class DatasetRow:
             activations, csr_matrix
         ), f"activations must be a scipy.sparse.csr_matrix. Found type {type(activations)}"
         assert field in row, f"field {field} not found in row"
+        n_tokens = len(
+            tokenized_document if tokenized_document is not None else token_ids
+        )
         assert (
-            len(tokenized_document) == activations.shape[0]
-        ), f"Number of tokens must match number of feature activation vectors, {len(tokenized_document)} != {activations.shape[0]}"
-        assert len(tokenized_document) > 0, "Empty documents not allowed!"
-        self.data = row[field]
+            n_tokens == activations.shape[0]
+        ), f"Number of tokens must match number of feature activation vectors, {n_tokens} != {activations.shape[0]}"
+        assert n_tokens > 0, "Empty documents not allowed!"
         self.field = field
-        self.row = row
-        self.tokenized_document = tokenized_document
-        self.aggregate_activations = dict()
-        self.activations = activations
         self.truncate_chat_template = truncate_chat_template
+        self._row = row
+        if tokenized_document is not None:
+            self._tokens, self._vocabulary = tokenized_document, None
+        else:
+            self._tokens, self._vocabulary = np.asarray(token_ids, dtype=np.int32), vocabulary
+        self._activations = activations
+        self._store = self._position = self._records = self._overlays = None
+
+        if low_memory:
+            self._aggregates = None
+        elif aggregate_activations is None:
+            self._aggregates = {
+                name: self._compute_aggregate(name) for name in AGGREGATE_NAMES
+            }
+        else:
+            self._aggregates = aggregate_activations
 
-        if not low_memory and aggregate_activations is None:
-            truncated_activations = (
-                truncate_chat_template_activations(
-                    activations.toarray(), remove_eot_token=True
-                )
-                if truncate_chat_template
-                else activations.toarray()
-            )
-            self.aggregate_activations["max"] = csr_matrix(
-                truncated_activations.max(axis=0)
+    @classmethod
+    def from_store(cls, store, position, records, field="text", overlays=None):
+        """
+        Row backed by row `position` of an ActivationStore and of the `records` dataframe. It keeps
+        no activations or tokens of its own: each is read from the shared buffers of the store when
+        accessed. Its record is only turned into a dictionary when `row` is first accessed.
+
+        :param overlays: Dictionary mapping store positions to the record dictionaries already
+            materialized, shared by the views of the same store so that changes made to `row`
+            are seen by all of them
+        """
+        row = cls.__new__(cls)
+        row.field = field
+        row.truncate_chat_template = bool(store.truncate_chat_template[position])
+        row._row = row._tokens = row._vocabulary = None
+        row._activations = row._aggregates = None
+        row._store = store
+        row._position = position
+        row._records = records
+        row._overlays = dict() if overlays is None else overlays
+        return row
+
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = self._overlays.get(self._position)
+        if self._row is None:
+            self._row = self._records.iloc[self._position].to_dict()
+            self._overlays[self._position] = self._row
+        return self._row
+
+    @property
+    def data(self):
+        if self._row is not None:
+            return self._row[self.field]
+        return self._records[self.field].iloc[self._position]
+
+    @property
+    def tokenized_document(self):
+        """
+        Token strings of the document, decoded through the vocabulary if the row keeps token ids.
+        """
+        if self._store is not None:
+            return self._store.row_tokens(self._position)
+        if self._vocabulary is not None:
+            return self._vocabulary.decode(self._tokens)
+        return self._tokens
+
+    def _token_part(self):
+        # Tokens in the form `ActivationStore.from_rows` takes, without decoding token ids
+        if self._store is not None:
+            return (
+                self._store.row_token_ids(self._position),
+                self._store.vocabulary,
             )
-            self.aggregate_activations["sum"] = csr_matrix(
-                truncated_activations.sum(axis=0)
+        if self._vocabulary is not None:
+            return (self._tokens, self._vocabulary)
+        return self._tokens
+
+    @property
+    def activations(self):
+        if self._activations is not None:
+            return self._activations
+        return self._store.row_activations(self._position)
+
+    @property
+    def aggregate_activations(self):
+        """
+        Precomputed aggregates ("max", "sum"), or an empty dictionary for low-memory rows.
+        """
+        if self._aggregates is not None:
+            return self._aggregates
+        if self._store is not None:
+            return self._store.row_aggregates(self._position)
+        return dict()
+
+    @property
+    def n_tokens(self):
+        if self._store is not None:
+            return int(
+                self._store.row_offsets[self._position + 1]
+                - self._store.row_offsets[self._position]
             )
-        elif not low_memory:
-            self.aggregate_activations = aggregate_activations
-        self.n_tokens = activations.shape[0]
+        return self._activations.shape[0]
+
+    def _compute_aggregate(self, name):
+        activations = (
+            truncate_chat_template_activations(self.activations, remove_eot_token=True)
+            if self.truncate_chat_template
+            else self.activations
+        )
+        return aggregate_row(activations, None, name)
+
+    def _aggregate(self, name):
+        aggregates = self.aggregate_activations
+        return aggregates[name] if name in aggregates else self._compute_aggregate(name)
 
     def row_record(self):
         return self.row
@@ -747,12 +1836,18 @@ class DatasetRow:
             latents = self.activations
         elif activation_type in ["mean", "max", "sum", "binarize", "count"]:
             if activation_type == "mean":
-                latents = self.aggregate_activations["sum"] / self.n_tokens
+                latents = self._aggregate("sum") / self.n_tokens
             elif activation_type == "binarize":
-                latents = self.aggregate_activations["max"].copy()
+                latents = self._aggregate("max").copy()
                 latents.data = (latents.data > activated_threshold).astype(
                     latents.data.dtype
                 )
+            elif (
+                activation_type == "count"
+                and activated_threshold == 0
+                and "count" in self.aggregate_activations
+            ):
+                latents = self.aggregate_activations["count"]
             elif activation_type == "count":
                 all_activations = self.activations.copy()
                 all_activations.data = (
@@ -760,7 +1855,7 @@ class DatasetRow:
                 ).astype(all_activations.data.dtype)
                 latents = csr_matrix(all_activations.getnnz(axis=0))
             else:
-                latents = self.aggregate_activations[activation_type]
+                latents = self._aggregate(activation_type)
         else:
             raise ValueError(
                 f"Unsupported activation aggregation method: {activation_type}"
@@ -776,13 +1871,13 @@ class DatasetRow:
             if self.truncate_chat_template
             else self.tokenized_document
         )
-        feature_activations = (
-            truncate_chat_template_activations(self.latents("all"))
+        # Slice the feature's column out of the sparse matrix instead of densifying every feature
+        feature_activations = self.activations[:, [feature]].toarray().ravel()
+        activations = (
+            truncate_chat_template_activations(feature_activations)
             if self.truncate_chat_template
-            else self.latents("all")
+            else feature_activations
         )
-
-        activations = feature_activations[:, feature]
         if as_string:
             return highlight_activations_as_string(
                 tokens, activations, left_marker, right_marker
@@ -804,3 +1899,232 @@ class DatasetRow:
         )
         text = text.replace("\n", "\\n")
         return f"DatasetRow('{text}')"
+
+
+def _counts_version(method):
+    def mutate(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+
+    return mutate
+
+
+class RowList(list):
+    """
+    List of DatasetRow objects that counts its changes in `version`, so the Dataset holding it
+    knows when its cached latents are stale.
+    """
+
+    version = 0
+
+    __setitem__ = _counts_version(list.__setitem__)
+    __delitem__ = _counts_version(list.__delitem__)
+    __iadd__ = _counts_version(list.__iadd__)
+    __imul__ = _counts_version(list.__imul__)
+    append = _counts_version(list.append)
+    extend = _counts_version(list.extend)
+    insert = _counts_version(list.insert)
+    pop = _counts_version(list.pop)
+    remove = _counts_version(list.remove)
+    clear = _counts_version(list.clear)
+    sort = _counts_version(list.sort)
+    reverse = _counts_version(list.reverse)
+
+
+class StoredRows:
+    def __init__(
+        self, store, records, field="text", positions=None, _assigned=None, _overlays=None
+    ):
+        """
+        List-like sequence of DatasetRow objects backed by an ActivationStore. Rows are lightweight
+        views into the store (see `DatasetRow.from_store`), so opening a saved dataset does not
+        read its activations and iterating over it does not accumulate per-row copies.
+
+        :param store: ActivationStore holding the activations
+        :param records: Pandas dataframe aligned with the rows of the store
+        :param field: Field name containing the text data
+        :param positions: Optional store row index for each element of this sequence. Subsets and
+            slices of a StoredRows share the store instead of copying it.
+        """
+        self.store = store
+        self.records = records
+        self.field = field
+        self.positions = (
+            np.arange(store.num_rows) if positions is None else np.asarray(positions)
+        )
+        # Rows assigned after loading (e.g. when resuming), keyed by store position. A subset
+        # starts from the assignments of its parent and copies them on its first assignment,
+        # so assigning into one does not change the other.
+        self._assigned = dict() if _assigned is None else _assigned
+        self._copy_on_write = _assigned is not None
+        # Record dictionaries of the store-backed rows, materialized on first access and shared
+        # with subsets, as a list and its slices share their row objects
+        self._overlays = dict() if _overlays is None else _overlays
+        self.version = 0
+
+    def _row(self, position):
+        if position in self._assigned:
+            return self._assigned[position]
+        if not self.store.valid[position]:
+            return None
+        # Store-backed rows are cheap views, so they are not cached
+        return DatasetRow.from_store(
+            self.store, position, self.records, field=self.field, overlays=self._overlays
+        )
+
+    def _assigned_mask(self):
+        return np.isin(self.positions, list(self._assigned))
+
+    def d_sae(self):
+        """
+        Number of SAE features. A store without any valid row (e.g. saved before activations were
+        computed) does not know it, so it is then taken from an assigned row.
+        """
+        if np.any(self.store.valid):
+            return self.store.d_sae
+        for row in self._assigned.values():
+            if row is not None:
+                return row.activations.shape[1]
+        return self.store.d_sae
+
+    def valid_mask(self):
+        mask = np.asarray(self.store.valid)[self.positions]
+        for i in np.where(self._assigned_mask())[0]:
+            mask[i] = self._assigned[self.positions[i]] is not None
+        return mask
+
+    def token_count(self):
+        assigned = self._assigned_mask()
+        stored = np.asarray(self.store.valid)[self.positions] & ~assigned
+        count = int(self.store.num_tokens()[self.positions][stored].sum())
+        return count + compute_token_count(
+            [self._assigned[position] for position in self.positions[assigned]]
+        )
+
+    def is_unmodified_store(self):
+        """
+        True if this sequence is exactly the rows of the store, with none reassigned.
+        """
+        return (
+            len(self.positions) == self.store.num_rows
+            and np.array_equal(self.positions, np.arange(self.store.num_rows))
+            and not self._assigned_mask().any()
+        )
+
+    def _valid_parts(self):
+        valid = self.valid_mask()
+        assigned = self._assigned_mask() & valid
+        return valid & ~assigned, assigned
+
+    def _valid_order(self, stored, assigned):
+        # Position of each stored / assigned row among the valid rows
+        valid_rank = np.cumsum(stored | assigned) - 1
+        return valid_rank[stored], valid_rank[assigned]
+
+    def valid_aggregate(self, name):
+        """
+        (num_valid_rows, d_sae) CSR aggregate `name` of the valid rows, in order. Rows read from the
+        store are selected with one fancy-indexing operation.
+        """
+        stored, assigned = self._valid_parts()
+        stored_latents = self.store.aggregate(name)[self.positions[stored]]
+        if not assigned.any():
+            return stored_latents
+        assigned_latents = stack_csr_rows(
+            [
+                aggregate_row(row.activations, row.aggregate_activations, name)
+                for row in (self._assigned[p] for p in self.positions[assigned])
+            ],
+            self.d_sae(),
+            dtype=stored_latents.dtype,
+        )
+        if not stored.any():
+            return assigned_latents
+        return reorder_csr_rows(
+            [stored_latents, assigned_latents], self._valid_order(stored, assigned)
+        )
+
+    def valid_num_tokens(self):
+        stored, assigned = self._valid_parts()
+        n_tokens = np.asarray(self.store.num_tokens())[self.positions]
+        for i in np.where(assigned)[0]:
+            n_tokens[i] = self._assigned[self.positions[i]].n_tokens
+        return n_tokens[stored | assigned]
+
+    def valid_token_counts(self, activated_threshold=0):
+        stored, assigned = self._valid_parts()
+        stored_counts = count_active_tokens(
+            self.store.token_activations, self.store.row_offsets, activated_threshold
+        )[self.positions[stored]]
+        if not assigned.any():
+            return stored_counts
+        rows = [self._assigned[p] for p in self.positions[assigned]]
+        assigned_counts = count_active_tokens(
+            stack_csr_rows([row.activations for row in rows], self.d_sae()),
+            np.concatenate([[0], np.cumsum([row.n_tokens for row in rows])]),
+            activated_threshold,
+        )
+        if not stored.any():
+            return assigned_counts
+        return reorder_csr_rows(
+            [stored_counts, assigned_counts], self._valid_order(stored, assigned)
+        )
+
+    def row_parts(self):
+        """
+        Per-row (activations, aggregates, tokens) tuples for `ActivationStore.from_rows`, read
+        straight from the store without building DatasetRow objects.
+        """
+        parts = []
+        for position in self.positions:
+            if position in self._assigned:
+                parts.append(_row_part(self._assigned[position]))
+            elif self.store.valid[position]:
+                parts.append(
+                    (
+                        self.store.row_activations(position),
+                        self.store.row_aggregates(position),
+                        (self.store.row_token_ids(position), self.store.vocabulary),
+                    )
+                )
+            else:
+                parts.append(None)
+        return parts
+
+    def truncate_chat_template(self):
+        """
+        The `truncate_chat_template` setting of each row, for `ActivationStore.from_rows`.
+        """
+        flags = np.asarray(self.store.truncate_chat_template)[self.positions]
+        for i in np.where(self._assigned_mask())[0]:
+            row = self._assigned[self.positions[i]]
+            flags[i] = row is not None and row.truncate_chat_template
+        return flags
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self._row(position)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._row(self.positions[index])
+        # Both sides copy the shared assignments before changing them
+        self._copy_on_write = True
+        return StoredRows(
+            self.store,
+            self.records,
+            field=self.field,
+            positions=self.positions[index],
+            _assigned=self._assigned,
+            _overlays=self._overlays,
+        )
+
+    def __setitem__(self, index, row):
+        if self._copy_on_write:
+            self._assigned = dict(self._assigned)
+            self._copy_on_write = False
+        self._assigned[self.positions[index]] = row
+        self.version += 1
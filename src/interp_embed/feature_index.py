@@ -0,0 +1,178 @@
+import numpy as np
+
+
+class FeatureIndex:
+    def __init__(self, indptr, documents, activations, documents_by_id, valid_documents):
+        """
+        Inverted index from each SAE feature to the documents that activate it.
+
+        The postings of feature f are `documents[indptr[f]:indptr[f + 1]]`, sorted by decreasing
+        activation (`activations` holds the matching values). `documents_by_id` holds the same
+        postings sorted by document index, which is used to find documents that do not activate a
+        feature without scanning the dataset.
+
+        :param indptr: Array of shape (d_sae + 1,) delimiting the postings of each feature
+        :param documents: Document indices of all postings, sorted by activation within a feature
+        :param activations: Activation values matching `documents`
+        :param documents_by_id: Document indices of all postings, sorted by index within a feature
+        :param valid_documents: Sorted indices of the documents that have activations
+        """
+        self.indptr = indptr
+        self.documents = documents
+        self.activations = activations
+        self.documents_by_id = documents_by_id
+        self.valid_documents = valid_documents
+
+    @classmethod
+    def from_latents(cls, latents, valid):
+        """
+        Build the index from a (num_documents, d_sae) CSR matrix of aggregated activations. Only
+        positive activations of valid documents become postings.
+
+        :param latents: csr_matrix of aggregated activations
+        :param valid: Boolean array marking the documents that have activations
+        """
+        valid_documents = np.where(valid)[0]
+        by_feature = latents[valid_documents].tocsc()
+        by_feature.sort_indices()
+
+        features = np.repeat(
+            np.arange(by_feature.shape[1]), np.diff(by_feature.indptr)
+        )
+        active = by_feature.data > 0
+        features = features[active]
+        documents_by_id = valid_documents[by_feature.indices[active]]
+        activations = by_feature.data[active]
+
+        order = np.lexsort((-activations, features))
+        indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(features, minlength=by_feature.shape[1]))]
+        )
+        return cls(
+            indptr=indptr,
+            documents=documents_by_id[order],
+            activations=activations[order],
+            documents_by_id=documents_by_id,
+            valid_documents=valid_documents,
+        )
+
+    @property
+    def d_sae(self):
+        return len(self.indptr) - 1
+
+    def postings(self, feature):
+        """
+        Documents activating `feature` and their activations, sorted by decreasing activation.
+        """
+        start, end = self.indptr[feature], self.indptr[feature + 1]
+        return self.documents[start:end], self.activations[start:end]
+
+    def top(self, feature, k):
+        start, end = self.indptr[feature], self.indptr[feature + 1]
+        return self.documents[start : min(start + k, end)]
+
+    def bottom(self, feature, k):
+        """
+        The k active documents with the lowest activation, in increasing order.
+        """
+        start, end = self.indptr[feature], self.indptr[feature + 1]
+        return self.documents[max(end - k, start) : end][::-1]
+
+    def inactive(self, feature, k):
+        """
+        The first k valid documents (by index) that do not activate `feature`.
+        """
+        start, end = self.indptr[feature], self.indptr[feature + 1]
+        active = self.documents_by_id[start:end]
+        # At most len(active) of the first k + len(active) valid documents can be active
+        candidates = self.valid_documents[: k + len(active)]
+        positions = np.searchsorted(active, candidates)
+        is_active = (positions < len(active)) & (
+            active[np.minimum(positions, len(active) - 1)] == candidates
+            if len(active) > 0
+            else False
+        )
+        return candidates[~is_active][:k]
+
+    def _gather(self, starts, counts, reverse=False):
+        """
+        Concatenate the postings ranges [starts[i], starts[i] + counts[i]) in one vectorized
+        operation, optionally reversing each range, and split them per range.
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        range_starts = np.cumsum(counts) - counts
+        within = np.arange(counts.sum()) - np.repeat(range_starts, counts)
+        if reverse:
+            within = np.repeat(counts, counts) - 1 - within
+        gathered = self.documents[np.repeat(starts, counts) + within]
+        return np.split(gathered, np.cumsum(counts)[:-1])
+
+    def select_many(
+        self,
+        features,
+        k,
+        select_top=True,
+        include_active_samples=True,
+        include_nonactive_samples=False,
+    ):
+        """
+        Batched `select`: one array of document indices per feature in `features`. The active
+        documents of all features are gathered from the sorted postings in one vectorized pass;
+        inactive documents are only looked up for features that need them.
+        """
+        features = np.asarray(features, dtype=np.int64)
+        starts, ends = self.indptr[features], self.indptr[features + 1]
+        n_active = ends - starts
+        empty = np.array([], dtype=int)
+
+        if select_top:
+            counts = np.minimum(k, n_active) if include_active_samples else 0 * n_active
+            selected = self._gather(starts, counts)
+            if include_nonactive_samples:
+                selected = [
+                    (
+                        np.concatenate(
+                            [documents, self.inactive(feature, k - len(documents))]
+                        )
+                        if len(documents) < k
+                        else documents
+                    )
+                    for feature, documents in zip(features, selected)
+                ]
+        else:
+            inactive = [
+                self.inactive(feature, k) if include_nonactive_samples else empty
+                for feature in features
+            ]
+            remaining = k - np.array([len(documents) for documents in inactive])
+            counts = (
+                np.minimum(remaining, n_active)
+                if include_active_samples
+                else 0 * n_active
+            )
+            lowest = self._gather(ends - counts, counts, reverse=True)
+            selected = [
+                np.concatenate([documents, bottom])
+                for documents, bottom in zip(inactive, lowest)
+            ]
+        return [documents.astype(int) for documents in selected]
+
+    def select(
+        self,
+        feature,
+        k,
+        select_top=True,
+        include_active_samples=True,
+        include_nonactive_samples=False,
+    ):
+        """
+        Indices of the k documents with the highest (or lowest) activation for `feature` among the
+        allowed candidates. Inactive documents rank below every active document.
+        """
+        return self.select_many(
+            [feature],
+            k,
+            select_top=select_top,
+            include_active_samples=include_active_samples,
+            include_nonactive_samples=include_nonactive_samples,
+        )[0]
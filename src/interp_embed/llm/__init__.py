@@ -1,2 +1,3 @@
 from .utils import *
 from .prompts import *
+from .rate_limit import *
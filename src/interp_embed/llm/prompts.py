@@ -61,6 +61,54 @@ Make sure your response is valid JSON that can be parsed directly. Keep the expl
     return prompt
 
 
+def build_batch_scoring_prompt(
+    feature_description: str,
+    samples: List[str],
+    sample_types: List[str],
+    explanation: bool = True,
+) -> str:
+    """Build prompt for scoring several samples in one request, each as in build_scoring_prompt."""
+    sample_sections = "\n".join(
+        f"""SAMPLE {i} ({sample_type.upper()}):
+{sample}
+"""
+        for i, (sample, sample_type) in enumerate(zip(samples, sample_types))
+    )
+    prompt = f"""You are an expert at evaluating sparse autoencoder feature descriptions. You will be scoring how accurate the feature description is for each of {len(samples)} document samples. Some descriptions are poor; some are good.
+
+You are given a feature description and numbered samples. Each sample is either POSITIVE (the feature activated on it, on the tokens surrounded by << >> markers) or NEGATIVE (the feature did not activate on it, so theoretically, there shouldn't be tokens in it that align with the feature). Score each sample independently of the others.
+
+IMPORTANT NOTES:
+1. The << >> markers indicate where the feature activated, but you should NOT restrict your understanding to just those marked tokens. Look at the context NEAR the marked tokens as well - the tokens near the marked tokens often provide crucial information about what the feature is detecting.
+2. The feature may be responding to a pattern or concept that spans both the context tokens AND the marked tokens together.
+3. The token <eot_id> is an end-of-sequence (EOS) token and should NOT be considered as a valid feature activation. If you see <<eot_id>> in the samples, ignore it as it's just a technical marker for the end of text, not a meaningful activation.
+4. You shouldn't be trying to infer what the feature description should be from the marked tokens; rather, you should use the feature description to score the samples.
+5. If a POSITIVE sample has no tokens marked with << >> markers, score whether the feature SHOULD have activated based on the feature description.
+
+FEATURE DESCRIPTION:
+"{feature_description}"
+
+{sample_sections}
+Your task, for each POSITIVE sample:
+- Score 1 if the property described by the feature description is clearly present in the marked tokens and their context. If there are many marked tokens, at least some should clearly align with the feature description to be scored as a 1.
+- Score 0 if the property described by the feature description is not clearly present in the sample at the marked tokens.
+
+For each NEGATIVE sample:
+- Score 1 if there are no tokens in the sample that align with the feature description.
+- Score 0 if there ARE tokens in the sample that align with the feature description.
+
+If the feature description is not even a valid semantic or linguistic property (ex. "feature_#"), mark every sample 0.
+
+Return your answer as a JSON object with exactly one field, "scores": a JSON array with one object per sample, in sample order, each with exactly these fields:
+- "id": <the sample number>
+{"- 'explanation': '<brief explanation for the score, focusing on how the context and marked tokens together show the difference between samples>'" if explanation else ""}
+- "score": <0 or 1>
+
+Make sure your response is valid JSON that can be parsed directly. Keep each explanation brief (1-2 sentences).
+"""
+    return prompt
+
+
 def build_labeling_prompt(
     positive_samples: List[str],
     negative_samples: List[str],
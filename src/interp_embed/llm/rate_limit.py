@@ -0,0 +1,193 @@
+import asyncio
+import collections
+import time
+from typing import Dict, Optional
+
+# Completion tokens assumed for a request without max_tokens, until its usage is known
+DEFAULT_COMPLETION_TOKENS = 1024
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        """
+        Token bucket refilled at `per_minute` units per minute, holding at most `burst` units (a
+        minute's worth by default). Reservations may overdraw the bucket; the caller then waits until
+        the debt is refilled, so concurrent callers are served in order without a lock.
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute if burst is None else burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` units and return the number of seconds to wait before using them.
+        """
+        self._refill()
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount: float):
+        """
+        Return `amount` units to the bucket (or take them, if negative), e.g. once the actual usage of
+        a reservation is known.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial: Optional[int] = None, minimum: int = 1, maximum: int = 256, backoff: float = 0.5,
+                 cooldown: float = 1.0):
+        """
+        Concurrency limit adjusted by additive increase, multiplicative decrease (AIMD): each successful
+        request raises the limit by 1 / limit (about one more slot per round of requests), and a
+        rate-limited request multiplies it by `backoff`. Decreases are at most once per `cooldown`
+        seconds, so a burst of rate-limit errors from one round counts once.
+
+        The limit starts at `initial`, or at `maximum` if None, so it only drops below the maximum once
+        the endpoint answers with rate-limit errors.
+        """
+        self.limit = float(maximum if initial is None else min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = float("-inf")
+        self._waiters = collections.deque()
+
+    def set_maximum(self, maximum: int):
+        """
+        Change the largest limit. A limit that has not backed off from the old maximum moves to the new
+        one; a lower limit is kept, within the new maximum.
+        """
+        if maximum == self.maximum:
+            return
+        if self.limit >= self.maximum:
+            self.limit = float(maximum)
+        self.maximum = maximum
+        self.limit = max(self.minimum, min(self.limit, maximum))
+        self._wake()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self, rate_limited: bool = False):
+        self.in_flight -= 1
+        if rate_limited:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._last_decrease = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            # Waiters of an event loop that has since closed (e.g. a previous asyncio.run) are dropped
+            if not waiter.done() and not waiter.get_loop().is_closed():
+                waiter.set_result(None)
+                free -= 1
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_concurrency: int = 256, initial_concurrency: Optional[int] = None):
+        """
+        Limits of the requests sent to one endpoint: token buckets for requests and tokens per minute
+        (None for no limit) and an adaptive concurrency limit between 1 and `max_concurrency`, starting
+        at `initial_concurrency` (`max_concurrency` if None).
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, maximum=max_concurrency)
+        self.rate_limited = 0
+
+    def set_max_concurrency(self, max_concurrency: int):
+        """
+        Cap the requests in flight to the endpoint at `max_concurrency`, e.g. the concurrency a caller
+        was configured with.
+        """
+        self.concurrency.set_maximum(max_concurrency)
+
+    async def acquire(self, estimated_tokens: int):
+        """
+        Wait for a concurrency slot and for the request and `estimated_tokens` to fit in the buckets.
+        Every acquire must be followed by a release.
+        """
+        await self.concurrency.acquire()
+        try:
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(estimated_tokens))
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.concurrency.release()
+            raise
+
+    def release(self, estimated_tokens: int, used_tokens: Optional[int] = None, rate_limited: bool = False):
+        """
+        Free the slot of a request, correct the token bucket with the `used_tokens` reported by the
+        response, and back off if the request was rate limited.
+        """
+        if self.tokens is not None and used_tokens is not None:
+            self.tokens.adjust(estimated_tokens - used_tokens)
+        self.rate_limited += rate_limited
+        self.concurrency.release(rate_limited)
+
+    def __repr__(self):
+        return (f"RateLimiter(concurrency={self.concurrency.limit:.1f}, in_flight={self.concurrency.in_flight}, "
+                f"rate_limited={self.rate_limited})")
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(endpoint: str) -> RateLimiter:
+    """
+    The process-wide rate limiter of an endpoint (the base URL of a client), created with default
+    limits on first use.
+    """
+    if endpoint not in _limiters:
+        _limiters[endpoint] = RateLimiter()
+    return _limiters[endpoint]
+
+
+def set_rate_limits(endpoint: str, requests_per_minute: Optional[float] = None,
+                    tokens_per_minute: Optional[float] = None, max_concurrency: int = 256,
+                    initial_concurrency: Optional[int] = None) -> RateLimiter:
+    """
+    Replace the rate limiter of an endpoint, e.g. with the requests and tokens per minute of the
+    provider's plan.
+    """
+    _limiters[endpoint] = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrency, initial_concurrency)
+    return _limiters[endpoint]
+
+
+def estimate_tokens(request: dict) -> int:
+    """
+    Rough number of tokens of a completion request: about 4 characters per prompt token, plus its
+    max_tokens.
+    """
+    prompt_characters = sum(len(str(message.get("content", ""))) for message in request.get("messages", []))
+    return prompt_characters // 4 + (request.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
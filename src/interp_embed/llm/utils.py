@@ -1,20 +1,24 @@
-from openai import OpenAI, AsyncOpenAI
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+import asyncio
 import os
+import random
+import weakref
 from typing import Union
 import json
-from typing import List, Dict, Optional, Any  # Added missing imports
+from typing import List, Dict, Optional, Any, Callable  # Added missing imports
+from openai.types.chat import ChatCompletion
 
-def get_llm_client(is_openai_model: bool = False, is_async: bool = False) -> Union[OpenAI, AsyncOpenAI]:
-    """
-    Get the appropriate LLM client based on the model name.
+from ..cache import LLMResponseCache
+from .rate_limit import estimate_tokens, get_rate_limiter
 
-    Args:
-        model: Model identifier (e.g., "gpt-4o", "google/gemini-2.5-flash", "openai/o3-mini")
-        is_async: Whether to return an async client
+# Retries of requests failing with rate-limit, connection or server errors (clients from
+# get_llm_client do not retry by themselves, so rate-limit errors reach the limiter)
+LLM_MAX_RETRIES = 6
+_sync_clients = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {is_openai_model: client}
 
-    Returns:
-        OpenAI or AsyncOpenAI client configured for the appropriate service
-    """
+
+def _new_llm_client(is_openai_model: bool, is_async: bool) -> Union[OpenAI, AsyncOpenAI]:
     openai_api_key = os.getenv("OPENAI_API_KEY")
     openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
     openrouter_url = "https://openrouter.ai/api/v1"
@@ -23,7 +27,7 @@ def get_llm_client(is_openai_model: bool = False, is_async: bool = False) -> Uni
         # Use OpenAI directly
         assert openai_api_key is not None, "OPENAI_API_KEY is not set"
         if is_async:
-            return AsyncOpenAI(api_key=openai_api_key)
+            return AsyncOpenAI(api_key=openai_api_key, max_retries=0)
         else:
             return OpenAI(api_key=openai_api_key)
     else:
@@ -32,7 +36,8 @@ def get_llm_client(is_openai_model: bool = False, is_async: bool = False) -> Uni
         if is_async:
             return AsyncOpenAI(
                 base_url=openrouter_url,
-                api_key=openrouter_api_key
+                api_key=openrouter_api_key,
+                max_retries=0,
             )
         else:
             return OpenAI(
@@ -40,43 +45,192 @@ def get_llm_client(is_openai_model: bool = False, is_async: bool = False) -> Uni
                 api_key=openrouter_api_key
             )
 
+
+class _LoopPooledClient:
+    def __init__(self, is_openai_model: bool):
+        """
+        Async client requested outside of an event loop (e.g. in a constructor). Its attributes are looked
+        up, when used, on the pooled client of the running event loop, so it shares that loop's
+        connections; outside of a loop they come from a client of its own.
+        """
+        self.is_openai_model = is_openai_model
+        self._unpooled = _new_llm_client(is_openai_model, is_async=True)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return getattr(self._unpooled, name)
+        return getattr(get_llm_client(self.is_openai_model, is_async=True), name)
+
+
+def get_llm_client(is_openai_model: bool = False, is_async: bool = False) -> Union[OpenAI, AsyncOpenAI]:
+    """
+    Get the appropriate LLM client based on the model name.
+
+    Clients are pooled, so their HTTP connections are reused across calls. An async client's connections
+    belong to an event loop, so async clients are shared within the running event loop. Outside of one, a
+    proxy is returned that uses the pooled client of whichever loop is running when it makes a request.
+
+    Args:
+        model: Model identifier (e.g., "gpt-4o", "google/gemini-2.5-flash", "openai/o3-mini")
+        is_async: Whether to return an async client
+
+    Returns:
+        OpenAI or AsyncOpenAI client configured for the appropriate service
+    """
+    if not is_async:
+        if is_openai_model not in _sync_clients:
+            _sync_clients[is_openai_model] = _new_llm_client(is_openai_model, is_async)
+        return _sync_clients[is_openai_model]
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _LoopPooledClient(is_openai_model)
+    clients = _async_clients.setdefault(loop, {})
+    if is_openai_model not in clients:
+        clients[is_openai_model] = _new_llm_client(is_openai_model, is_async)
+    return clients[is_openai_model]
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying: the server's Retry-After if given, else jittered exponential backoff."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 60.0)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 60.0) * (0.5 + random.random())
+
+# Path of the shared LLM response cache; set to "off" (or "0", "false", "none") to disable it
+LLM_CACHE_ENV = "INTERP_EMBED_LLM_CACHE"
+DEFAULT_LLM_CACHE_PATH = "~/.cache/interp_embed/llm_responses.sqlite"
+_UNSET = object()
+_llm_cache = _UNSET
+
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """
+    The LLM response cache shared by all `call_async_llm` calls, or None if caching is disabled. It is
+    opened on first use at the path in the INTERP_EMBED_LLM_CACHE environment variable, or at
+    DEFAULT_LLM_CACHE_PATH.
+    """
+    global _llm_cache
+    if _llm_cache is _UNSET:
+        path = os.getenv(LLM_CACHE_ENV, DEFAULT_LLM_CACHE_PATH)
+        _llm_cache = (
+            None if path.strip().lower() in ["", "0", "off", "false", "none"] else LLMResponseCache(path)
+        )
+    return _llm_cache
+
+
+def set_llm_cache(cache: Optional[LLMResponseCache]):
+    """
+    Replace the shared LLM response cache (e.g. to change its path, size or TTL), or disable caching
+    with None.
+    """
+    global _llm_cache
+    _llm_cache = cache
+
+
 async def call_async_llm(
     client: AsyncOpenAI,
     model: str,
     messages: List[Dict[str, str]],
     max_tokens: Optional[int] = None,
+    use_cache: bool = True,
+    validate: Optional[Callable[[ChatCompletion], Any]] = None,
+    max_concurrency: Optional[int] = None,
     **kwargs
 ):
+    """
+    Call the chat completions endpoint of `client`. Responses are cached in the shared LLM response
+    cache (see `get_llm_cache`), keyed by the endpoint, model, messages and decoding parameters, so
+    repeated requests are answered from disk.
+
+    Requests wait for the rate limiter of the endpoint (see `rate_limit.set_rate_limits`), which caps
+    requests and tokens per minute and adapts the number of concurrent requests: it backs off when the
+    endpoint answers with rate-limit errors, which are retried.
+
+    Args:
+        use_cache: Whether to look up and store the response in the cache
+        validate: Function parsing the response, which raises if the response is unusable. Such
+            responses (and responses without content) are returned but not cached, and cached ones
+            are requested again, so a retry does not get the same bad response back
+        max_concurrency: Concurrency the caller was configured with. It becomes the maximum number of
+            requests in flight to the endpoint (see `RateLimiter.set_max_concurrency`), shared by all
+            callers, instead of a separate cap of the caller's own
+    """
     is_openai_model = model.startswith("openai/")
     if is_openai_model:
         model = model[7:]
 
     is_reasoning_model = model in ["o3-mini", "o4-mini", "o3", "o3-pro", "o1-preview", "o1", "o3-pro"]
     if is_reasoning_model:
-        response = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            **kwargs
-        )
+        request = dict(model=model, messages=messages, **kwargs)
     elif is_openai_model:
-        response = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            **kwargs
-        )
+        request = dict(model=model, messages=messages, max_tokens=max_tokens, **kwargs)
     else:
         # Ensure a default temperature if not provided in kwargs for non-OpenAI non-reasoning models
         temperature = kwargs.get("temperature", 0.01)
-        response = await client.chat.completions.create(
+        request = dict(
             model=model,
             messages=messages,
             max_tokens=max_tokens,
             temperature=temperature,
             **{k: v for k, v in kwargs.items() if k != "temperature"}
         )
+
+    cache = get_llm_cache() if use_cache else None
+    if cache is not None:
+        key = cache.request_key(request, endpoint=str(client.base_url))
+        cached = cache.get(key)
+        if cached is not None:
+            response = ChatCompletion.model_validate(cached)
+            if _is_valid(response, validate):
+                return response
+
+    # Every request to an endpoint goes through its process-wide limiter
+    limiter = get_rate_limiter(str(client.base_url))
+    if max_concurrency is not None:
+        limiter.set_max_concurrency(max_concurrency)
+    estimated_tokens = estimate_tokens(request)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await limiter.acquire(estimated_tokens)
+        try:
+            response = await client.chat.completions.create(**request)
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            limiter.release(estimated_tokens, rate_limited=isinstance(e, RateLimitError))
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            await asyncio.sleep(_retry_delay(e, attempt))
+            continue
+        except BaseException:
+            limiter.release(estimated_tokens)
+            raise
+        usage = getattr(response, "usage", None)
+        limiter.release(estimated_tokens, used_tokens=usage.total_tokens if usage is not None else None)
+        break
+
+    if cache is not None and _is_valid(response, validate):
+        cache.put(key, response.model_dump(mode="json"))
     return response
 
+
+def _is_valid(response: ChatCompletion, validate: Optional[Callable[[ChatCompletion], Any]]) -> bool:
+    # Responses without content are never worth caching, whatever the caller parses
+    if not response.choices or not response.choices[0].message.content:
+        return False
+    if validate is None:
+        return True
+    try:
+        validate(response)
+    except Exception:
+        return False
+    return True
+
 def extract_json_from_response(content: str) -> str:
     """
     Extract JSON from LLM response content, handling markdown code blocks.
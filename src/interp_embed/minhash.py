@@ -0,0 +1,191 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+MERSENNE_PRIME = np.uint64((1 << 31) - 1)  # (a * x + b) stays below 2^64 for x < 2^31
+_HASH_CHUNK = 1 << 22  # Number of (feature, permutation) hashes computed at once
+
+
+class MinHashIndex:
+    def __init__(self, binary, signatures, keys, rows_per_band):
+        """
+        MinHash signatures of the feature sets of documents, with a locality-sensitive hashing
+        (LSH) index that groups documents whose signatures agree on a whole band.
+
+        Two documents with Jaccard similarity s share a bucket in at least one of the b bands with
+        probability 1 - (1 - s^r)^b, where r is `rows_per_band`, so similar documents are found by
+        looking only at the documents that share a bucket. Candidates are then ranked by their
+        exact Jaccard similarity.
+
+        :param binary: (num_documents, d_sae) binary CSR matrix of document feature sets
+        :param signatures: (num_documents, num_perm) MinHash signatures
+        :param keys: (bands, num_documents) bucket key of each document in each band
+        :param rows_per_band: Number of signature values hashed together in one band
+        """
+        self.binary = binary
+        self.signatures = signatures
+        self.keys = keys
+        self.rows_per_band = rows_per_band
+        self.set_sizes = np.diff(binary.indptr)
+
+        # Per band, the indexed documents sorted by key, so a bucket is a contiguous run
+        indexed = np.flatnonzero(self.set_sizes > 0)
+        self.band_orders = [
+            indexed[np.argsort(band_keys[indexed], kind="stable")] for band_keys in keys
+        ]
+        self.band_keys = [
+            band_keys[order] for band_keys, order in zip(keys, self.band_orders)
+        ]
+
+    @classmethod
+    def from_latents(cls, latents, num_perm=128, bands=32, seed=0):
+        """
+        Build the index from a (num_documents, d_sae) CSR matrix; a document's set is the features
+        with a positive value. Documents without active features are not indexed.
+
+        :param num_perm: Number of hash permutations in a signature
+        :param bands: Number of LSH bands (must divide `num_perm`)
+        """
+        if num_perm % bands != 0:
+            raise ValueError(f"bands ({bands}) must divide num_perm ({num_perm})")
+        binary = csr_matrix(latents > 0, dtype=np.float32)
+        binary.eliminate_zeros()
+        binary.sort_indices()
+
+        rng = np.random.default_rng(seed)
+        a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        signatures = _minhash_signatures(binary, a, b)
+
+        rows_per_band = num_perm // bands
+        multipliers = rng.integers(1, 1 << 63, size=rows_per_band, dtype=np.uint64) | 1
+        # Wrapping uint64 arithmetic mixes the values of a band into one key; collisions only add
+        # candidates, which are verified exactly
+        keys = (
+            signatures.reshape(len(signatures), bands, rows_per_band) * multipliers
+        ).sum(axis=2, dtype=np.uint64)
+        return cls(binary, signatures, keys.T.copy(), rows_per_band)
+
+    @property
+    def num_documents(self):
+        return self.binary.shape[0]
+
+    def candidates(self, document):
+        """
+        Documents sharing at least one LSH bucket with `document` (excluding itself).
+        """
+        if self.set_sizes[document] == 0:
+            return np.array([], dtype=np.int64)
+        buckets = []
+        for band_keys, sorted_keys, order in zip(
+            self.keys, self.band_keys, self.band_orders
+        ):
+            key = band_keys[document]
+            start = np.searchsorted(sorted_keys, key)
+            end = np.searchsorted(sorted_keys, key, side="right")
+            buckets.append(order[start:end])
+        candidates = np.unique(np.concatenate(buckets))
+        return candidates[candidates != document]
+
+    def jaccard(self, left, right):
+        """
+        Exact Jaccard similarity of the document pairs (left[i], right[i]).
+        """
+        left, right = np.asarray(left), np.asarray(right)
+        intersection = np.asarray(
+            self.binary[left].multiply(self.binary[right]).sum(axis=1)
+        ).ravel()
+        union = self.set_sizes[left] + self.set_sizes[right] - intersection
+        return np.divide(
+            intersection, union, out=np.zeros(len(left)), where=union > 0
+        )
+
+    def similar(self, document, k=10):
+        """
+        Up to k documents most similar to `document` among its LSH candidates.
+
+        :return: Tuple of (document indices, Jaccard similarities), by decreasing similarity
+        """
+        candidates = self.candidates(document)
+        similarities = self.jaccard(np.full(len(candidates), document), candidates)
+        order = np.lexsort((candidates, -similarities))[:k]
+        return candidates[order], similarities[order]
+
+    def near_duplicates(self, threshold=0.9):
+        """
+        All pairs of documents that share an LSH bucket and have a Jaccard similarity of at least
+        `threshold`.
+
+        :return: Tuple of (left indices, right indices, similarities) with left < right, by
+            decreasing similarity
+        """
+        pairs = []
+        for keys, order in zip(self.band_keys, self.band_orders):
+            # Buckets with more than one document, as runs of equal keys
+            boundaries = np.flatnonzero(np.diff(keys)) + 1
+            starts = np.concatenate([[0], boundaries])
+            sizes = np.diff(np.concatenate([starts, [len(keys)]]))
+            starts, sizes = starts[sizes > 1], sizes[sizes > 1]
+            if len(starts) == 0:
+                continue
+            # Every pair (i, j), i < j, within each bucket
+            n_pairs = sizes * (sizes - 1) // 2
+            bucket = np.repeat(np.arange(len(starts)), n_pairs)
+            rank = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+            i, j = _pair_from_rank(rank, sizes[bucket])
+            left, right = order[starts[bucket] + i], order[starts[bucket] + j]
+            pairs.append(
+                np.minimum(left, right) * self.num_documents + np.maximum(left, right)
+            )
+        if not pairs:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, np.array([])
+        pairs = np.unique(np.concatenate(pairs))
+        left, right = pairs // self.num_documents, pairs % self.num_documents
+        similarities = self.jaccard(left, right)
+        keep = similarities >= threshold
+        left, right, similarities = left[keep], right[keep], similarities[keep]
+        order = np.argsort(-similarities, kind="stable")
+        return left[order], right[order], similarities[order]
+
+
+def _pair_from_rank(rank, size):
+    """
+    The rank-th pair (i, j), i < j, of range(size) in lexicographic order, elementwise.
+    """
+    # Pairs starting at i occupy ranks [i * size - i * (i + 1) / 2, ...); invert the quadratic
+    remaining = size * (size - 1) // 2 - 1 - rank
+    i_from_end = ((np.sqrt(8 * remaining + 1) - 1) // 2).astype(np.int64)
+    i = size - 2 - i_from_end
+    j = rank - (i * size - i * (i + 1) // 2) + i + 1
+    return i, j
+
+
+def _minhash_signatures(binary, a, b):
+    """
+    (num_documents, num_perm) MinHash signatures: for each permutation h(x) = (a * x + b) mod p,
+    the minimum hash over the features of each document. Rows are processed in chunks so at most
+    `_HASH_CHUNK` hashes are held at once. Documents without features get the maximum value.
+    """
+    num_documents, num_perm = binary.shape[0], len(a)
+    signatures = np.full((num_documents, num_perm), MERSENNE_PRIME, dtype=np.uint64)
+    indptr = binary.indptr
+    chunk_nnz = max(1, _HASH_CHUNK // num_perm)
+    start = 0
+    while start < num_documents:
+        # Extend the chunk until it holds `chunk_nnz` features (at least one row)
+        end = max(
+            start + 1,
+            int(np.searchsorted(indptr, indptr[start] + chunk_nnz, side="right")) - 1,
+        )
+        end = min(end, num_documents)
+        rows = np.arange(start, end)
+        counts = np.diff(indptr[start : end + 1])
+        rows = rows[counts > 0]
+        if len(rows) > 0:
+            features = binary.indices[indptr[start] : indptr[end]].astype(np.uint64)
+            hashes = (features[:, None] * a[None, :] + b[None, :]) % MERSENNE_PRIME
+            signatures[rows] = np.minimum.reduceat(
+                hashes, indptr[rows] - indptr[start], axis=0
+            )
+        start = end
+    return signatures
@@ -1,19 +1,113 @@
+from abc import ABC, abstractmethod
+
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, diags, issparse
 from sklearn.cluster import SpectralClustering
 
 
+def _jaccard_blocks(binary, rows, cols, row_sz, block_size=2048):
+    """
+    Yield (block of `rows`, CSR Jaccard similarities of the block against `cols`) without forming
+    the full len(rows) x len(cols) matrix. Only pairs sharing a feature get an entry.
+    """
+    right = binary[cols].T.tocsc()
+    for start in range(0, len(rows), block_size):
+        block = rows[start : start + block_size]
+        inter = (binary[block] @ right).tocsr()
+        inter.sort_indices()
+        block_rows = np.repeat(np.arange(len(block)), np.diff(inter.indptr))
+        union = row_sz[block][block_rows] + row_sz[cols][inter.indices] - inter.data
+        yield block, csr_matrix(
+            (inter.data / union, inter.indices, inter.indptr), shape=inter.shape
+        )
+
+
+def knn_jaccard_graph(binary, n_neighbors, block_size=2048):
+    """
+    Sparse, symmetric k-nearest-neighbour affinity graph of the rows of a binary CSR matrix under
+    Jaccard similarity. Row blocks are multiplied against the whole matrix, so memory is bounded
+    by `block_size` x n_documents instead of n_documents^2.
+
+    binary: (n_documents, n_features) binary CSR matrix
+    n_neighbors: number of most similar documents kept per document
+    block_size: number of documents compared per sparse matmul
+
+    Returns:
+        (n_documents, n_documents) CSR affinity matrix, the elementwise max of the kNN graph and
+        its transpose
+    """
+    n = binary.shape[0]
+    row_sz = np.asarray(binary.sum(1)).ravel()
+    all_rows = np.arange(n)
+    rows, cols, values = [], [], []
+    for block, jaccard in _jaccard_blocks(binary, all_rows, all_rows, row_sz, block_size):
+        block_rows = block[np.repeat(np.arange(len(block)), np.diff(jaccard.indptr))]
+        keep = block_rows != jaccard.indices  # No self loops
+        block_rows, block_cols, data = (
+            block_rows[keep],
+            jaccard.indices[keep],
+            jaccard.data[keep],
+        )
+        # Rank the neighbours of each row by decreasing similarity and keep the first k
+        order = np.lexsort((-data, block_rows))
+        block_rows, block_cols, data = block_rows[order], block_cols[order], data[order]
+        starts = np.searchsorted(block_rows, block_rows, side="left")
+        top = np.arange(len(block_rows)) - starts < n_neighbors
+        rows.append(block_rows[top])
+        cols.append(block_cols[top])
+        values.append(data[top])
+
+    knn = csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n, n),
+    )
+    return knn.maximum(knn.T).tocsr()
+
+
+def in_cluster_affinity(aff, labels):
+    """
+    Mean affinity of each document to the other documents of its cluster, from the row sums of
+    the affinity matrix restricted to pairs within a cluster. A sparse (k-nearest-neighbour)
+    matrix is summed over its stored entries in O(nnz), so pairs that are not neighbours count as
+    0; a dense matrix is summed over the diagonal blocks of the clusters.
+    """
+    sizes = np.bincount(labels)
+    if issparse(aff):
+        aff = aff.tocoo()
+        same = (labels[aff.row] == labels[aff.col]) & (aff.row != aff.col)
+        sums = np.bincount(aff.row[same], weights=aff.data[same], minlength=len(labels))
+    else:
+        sums = np.zeros(len(labels))
+        for c in np.flatnonzero(sizes > 1):
+            idx = np.where(labels == c)[0]
+            block = aff[np.ix_(idx, idx)]
+            np.fill_diagonal(block, 0)
+            sums[idx] = block.sum(1)
+    others = sizes[labels] - 1
+    return np.divide(sums, others, out=np.zeros(len(labels)), where=others > 0)
+
+
 def compute_clusters(
     dataset,
     n_clusters,
     active_features=None,
     top_n=5,
+    n_neighbors=None,
+    block_size=2048,
+    contrast="binary",
 ):
     """
     dataset: Dataset object
     n_clusters: number of clusters
     active_features: list of feature indices to filter down to before clustering
     top_n: number of top features to consider
+    n_neighbors: if set, cluster a sparse k-nearest-neighbour Jaccard graph with this many
+        neighbours per document instead of the dense n_documents x n_documents affinity matrix,
+        so memory grows linearly with the number of documents. Scores then average a document's
+        affinities to its neighbours in its cluster, counting the other documents as 0
+    block_size: number of documents compared per sparse matmul in the k-nearest-neighbour mode
+    contrast: distinctive features compare the fraction of documents activating each feature in
+        and out of the cluster ("binary"), or its mean activation ("magnitude")
 
     Returns:
         Dictionary mapping cluster IDs to cluster info:
@@ -31,7 +125,10 @@ def compute_clusters(
             }
         }
     """
-    activations = dataset.latents()  # (n_documents, n_features)
+    if contrast not in ["binary", "magnitude"]:
+        raise ValueError(f"Unsupported contrast: {contrast}")
+
+    activations = dataset.latents(compress=True)  # (n_documents, n_features) CSR
     feature_labels = dataset.feature_labels()
 
     filtered = (
@@ -40,9 +137,14 @@ def compute_clusters(
 
     # --- Jaccard affinity ---
     bin_csr = csr_matrix(filtered > 0, dtype=np.int32)
-    inter = bin_csr @ bin_csr.T
-    row_sz = inter.diagonal()
-    aff = np.array(np.nan_to_num(inter.toarray() / (row_sz[:, None] + row_sz - inter)))
+    if n_neighbors is None:
+        inter = bin_csr @ bin_csr.T
+        row_sz = inter.diagonal()
+        aff = np.array(
+            np.nan_to_num(inter.toarray() / (row_sz[:, None] + row_sz - inter))
+        )
+    else:
+        aff = knn_jaccard_graph(bin_csr, n_neighbors, block_size=block_size)
 
     # --- Spectral clustering ---
     labels = SpectralClustering(
@@ -52,52 +154,419 @@ def compute_clusters(
     ).fit_predict(aff)
 
     # --- In-cluster affinity scores ---
-    np.fill_diagonal(aff, 0)
-    probs = np.zeros(len(aff))
-    for c in np.unique(labels):
-        idx = np.where(labels == c)[0]
-        if idx.size > 1:
-            probs[idx] = aff[np.ix_(idx, idx)].sum(1) / (idx.size - 1)
+    probs = in_cluster_affinity(aff, labels)
 
     # --- Distinctive features ---
-    def map_feat(i):
-        return int(active_features[i]) if active_features is not None else int(i)
+    distinctive = None
+    if feature_labels is not None:
+        values = _contrast_values(filtered, contrast)
+        sums, sizes = _cluster_sums(values, labels, n_clusters)
+        clusters, diffs = _feature_contrasts(sums, sizes)
+        distinctive = _distinctive_features(
+            clusters, diffs, feature_labels, active_features, top_n
+        )
+
+    return _cluster_results(labels, probs, distinctive, top_n)
+
+
+
+def compute_clusters_streaming(
+    dataset,
+    n_clusters,
+    active_features=None,
+    top_n=5,
+    method="kmeans",
+    weighting="tfidf",
+    aggregation_method="max",
+    block_size=4096,
+    n_epochs=3,
+    random_state=42,
+    contrast="binary",
+):
+    """
+    Cluster documents by streaming row blocks of the aggregate CSR matrix, for datasets too large
+    for compute_clusters. Besides the dataset's sparse aggregate matrix and the block being
+    processed (sliced by rows before its columns are filtered), memory holds only the centroids and
+    per-cluster feature sums (n_clusters x n_features). Centroids are seeded from sparse products
+    over a sample of at most 2048 documents.
+
+    dataset: Dataset object
+    n_clusters: number of clusters
+    active_features: list of feature indices to filter down to before clustering
+    top_n: number of top features to consider
+    method: "kmeans" for mini-batch spherical k-means (cosine similarity), or "kmodes" for
+        streaming k-modes over binarized features (Jaccard similarity)
+    weighting: for "kmeans", "tfidf" to weight activations by inverse document frequency, or
+        "binary" to cluster binarized features
+    aggregation_method: aggregation of the activations clustered by "kmeans" with "tfidf"
+    block_size: number of documents per block
+    n_epochs: number of passes over the blocks used to fit the centroids
+    random_state: seed of the initialization and of the block order
+    contrast: "binary" or "magnitude", as in compute_clusters
+
+    Returns:
+        Same structure as compute_clusters. Scores are the similarity of each document to the
+        centroid of its cluster (cosine for "kmeans", Jaccard for "kmodes").
+    """
+    if method not in ["kmeans", "kmodes"]:
+        raise ValueError(f"Unsupported clustering method: {method}")
+    if weighting not in ["tfidf", "binary"]:
+        raise ValueError(f"Unsupported weighting: {weighting}")
+    if contrast not in ["binary", "magnitude"]:
+        raise ValueError(f"Unsupported contrast: {contrast}")
+
+    activations = dataset.latents(aggregation_method, compress=True)
+    feature_labels = dataset.feature_labels()
+    n_documents = activations.shape[0]
+    n_features = (
+        len(active_features) if active_features is not None else activations.shape[1]
+    )
+    starts = np.arange(0, n_documents, block_size)
+    rng = np.random.default_rng(random_state)
+
+    def filtered(rows):
+        # Slice the rows first, so only the block is copied when filtering columns
+        block = activations[rows]
+        return block[:, active_features] if active_features is not None else block
+
+    def binary_block(rows):
+        block = csr_matrix(filtered(rows) > 0, dtype=np.float64)
+        block.eliminate_zeros()
+        return block
+
+    # --- Feature weights (one pass) ---
+    idf = None
+    if method == "kmeans" and weighting == "tfidf":
+        df = np.zeros(n_features)
+        for start in starts:
+            df += np.asarray(binary_block(slice(start, start + block_size)).sum(0)).ravel()
+        idf = np.log((1 + n_documents) / (1 + df)) + 1
 
+    def block_vectors(rows):
+        if method == "kmodes" or idf is None:
+            block = binary_block(rows)
+        else:
+            block = csr_matrix(filtered(rows), dtype=np.float64)
+            block.data = np.nan_to_num(block.data)  # Rows without activations
+            block = block @ diags(idf)
+        if method == "kmeans":
+            norms = np.sqrt(np.asarray(block.multiply(block).sum(1)).ravel())
+            block = diags(1 / np.where(norms > 0, norms, 1)) @ block
+        return csr_matrix(block)
+
+    engine = (
+        _MiniBatchKMeans(n_clusters) if method == "kmeans" else _StreamingKModes(n_clusters)
+    )
+
+    # --- Fit ---
+    # Seed on a uniform sample, since consecutive documents are often similar
+    sample = np.sort(rng.choice(n_documents, min(n_documents, 2048), replace=False))
+    engine.initialize(block_vectors(sample), rng)
+    for _ in range(n_epochs):
+        engine.start_epoch()
+        for start in rng.permutation(starts):
+            engine.partial_fit(block_vectors(slice(start, start + block_size)))
+
+    # --- Assign documents and sum features per cluster (one pass) ---
+    labels = np.zeros(n_documents, dtype=np.int64)
+    probs = np.zeros(n_documents)
+    cluster_sums = np.zeros((n_clusters, n_features))
+    for start in starts:
+        rows = slice(start, start + block_size)
+        block_labels, block_scores = engine.assign(block_vectors(rows))
+        labels[rows] = block_labels
+        probs[rows] = block_scores
+        cluster_sums += _cluster_sums(
+            _contrast_values(filtered(rows), contrast), block_labels, n_clusters
+        )[0]
+
+    # --- Distinctive features ---
     distinctive = None
     if feature_labels is not None:
-        distinctive = {}
-        binary = (filtered > 0).astype(float)
-        valid = labels != -1
-
-        for c in sorted(set(labels[valid])):
-            in_c = labels == c
-            out_c = valid & ~in_c
-            diffs = binary[in_c].mean(0) - binary[out_c].mean(0)
-
-            order = np.argsort(diffs)
-            top = order[-top_n:][::-1]
-            bot = order[:top_n]
-
-            def build(indices):
-                out = []
-                for i in indices:
-                    orig = map_feat(i)
-                    label = (
-                        feature_labels[orig]
-                        if orig in feature_labels
-                        else f"feature_{orig}"
-                    )
-                    out.append((orig, label, float(diffs[i])))
-                return out
-
-            distinctive[c] = {
-                "positive": build(top),
-                "negative": build(bot),
-            }
+        clusters, diffs = _feature_contrasts(
+            cluster_sums, np.bincount(labels, minlength=n_clusters)
+        )
+        distinctive = _distinctive_features(
+            clusters, diffs, feature_labels, active_features, top_n
+        )
+
+    return _cluster_results(labels, probs, distinctive, top_n)
+
+
+def _one_hot(labels, n_clusters):
+    # (n_clusters, len(labels)) sparse indicator of the cluster of each document
+    return csr_matrix(
+        (np.ones(len(labels)), (labels, np.arange(len(labels)))),
+        shape=(n_clusters, len(labels)),
+    )
+
+
+def _dense(product):
+    return product.toarray() if issparse(product) else np.asarray(product)
+
+
+def _kmeans_plus_plus(similarity, k, rng):
+    """
+    Indices of k seeds chosen by greedy k-means++ from a (n, n) similarity matrix, with distance
+    1 - similarity: each seed is the best of 2 + log(k) candidates sampled proportionally to
+    their distance to the nearest seed.
+    """
+    n = similarity.shape[0]
+    n_trials = 2 + int(np.log(k))
+    seeds = [int(rng.integers(n))]
+    distance = np.clip(1 - similarity[seeds[0]], 0, None)
+    for _ in range(1, k):
+        if distance.sum() <= 0:
+            candidates = rng.integers(n, size=n_trials)
+        else:
+            candidates = rng.choice(n, size=n_trials, p=distance / distance.sum())
+        # Distances to the nearest seed if each candidate were added
+        trials = np.minimum(distance[None, :], np.clip(1 - similarity[candidates], 0, None))
+        best = int(trials.sum(1).argmin())
+        seeds.append(int(candidates[best]))
+        distance = trials[best]
+    return seeds
+
+
+class _StreamingClusterer(ABC):
+    """
+    Centroid-based clustering fitted one block of documents at a time. Subclasses define the
+    similarity of documents to centroids and how centroids summarize their documents.
+    """
+
+    def __init__(self, n_clusters):
+        self.n_clusters = n_clusters
+        self.centroids = None
+        self.sample_sizes = None
+
+    @abstractmethod
+    def similarity(self, block, centroids):
+        """
+        (len(block), len(centroids)) dense similarities of the rows of a CSR block to centroids,
+        given as a dense array or as a CSR matrix (e.g. documents of a sample).
+        """
+
+    @abstractmethod
+    def centroids_of(self, block, labels, previous):
+        """
+        Centroids of the documents of `block` assigned to each cluster (`previous` if none).
+        """
+
+    @abstractmethod
+    def partial_fit(self, block):
+        """
+        Update the centroids with a block of documents.
+        """
+
+    def initialize(self, sample, rng, n_init=3, n_iter=5):
+        """
+        Seed centroids with greedy k-means++ on a sample of documents and refine them with a few full
+        passes over it, keeping the best of `n_init` seedings.
+        """
+        # Sparse-by-sparse, so only the (n_sample, n_sample) result is dense
+        pairwise = self.similarity(sample, sample)
+        best_score = -np.inf
+        for _ in range(n_init):
+            centroids = sample[_kmeans_plus_plus(pairwise, self.n_clusters, rng)].toarray()
+            for _ in range(n_iter):
+                labels = self.similarity(sample, centroids).argmax(1)
+                centroids = self.centroids_of(sample, labels, centroids)
+            similarity = self.similarity(sample, centroids)
+            if similarity.max(1).sum() > best_score:
+                best_score, self.centroids = similarity.max(1).sum(), centroids
+                # Number of sample documents each centroid summarizes
+                self.sample_sizes = np.bincount(
+                    similarity.argmax(1), minlength=self.n_clusters
+                )
+
+    def start_epoch(self):
+        pass
+
+    def assign(self, block):
+        similarity = self.similarity(block, self.centroids)
+        labels = similarity.argmax(1)
+        return labels, similarity[np.arange(len(labels)), labels]
+
+
+class _MiniBatchKMeans(_StreamingClusterer):
+    """
+    Mini-batch spherical k-means (Sculley, 2010) over L2-normalized rows: each block moves the
+    centroids towards the mean of their assigned documents with a per-centroid learning rate of
+    (documents in block) / (documents seen), and centroids are renormalized.
+    """
+
+    def __init__(self, n_clusters):
+        super().__init__(n_clusters)
+        self.seen = np.zeros(n_clusters)
+
+    def initialize(self, sample, rng, n_init=3, n_iter=5):
+        super().initialize(sample, rng, n_init=n_init, n_iter=n_iter)
+        # The initial centroids count as averages of their sample documents, so a first block of
+        # similar documents (e.g. from a sorted dataset) does not replace them entirely
+        self.seen = self.sample_sizes.astype(float)
+
+    def similarity(self, block, centroids):
+        return _dense(block @ centroids.T)
+
+    def centroids_of(self, block, labels, previous):
+        counts = np.bincount(labels, minlength=self.n_clusters)
+        sums = (_one_hot(labels, self.n_clusters) @ block).toarray()
+        centroids = np.where(counts[:, None] > 0, sums, previous)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        return centroids / np.where(norms > 0, norms, 1)
+
+    def partial_fit(self, block):
+        labels, scores = self.assign(block)
+        counts = np.bincount(labels, minlength=self.n_clusters)
+        sums = (_one_hot(labels, self.n_clusters) @ block).toarray()
+        self.seen += counts
+        moved = counts > 0
+        rate = counts[moved] / self.seen[moved]
+        self.centroids[moved] += rate[:, None] * (
+            sums[moved] / counts[moved, None] - self.centroids[moved]
+        )
+        # Centroids that never received a document restart at the worst-fitting documents
+        empty = np.flatnonzero(self.seen == 0)
+        if len(empty) > 0:
+            worst = np.argsort(scores)[: len(empty)]
+            self.centroids[empty[: len(worst)]] = block[worst].toarray()
+        norms = np.linalg.norm(self.centroids, axis=1, keepdims=True)
+        self.centroids /= np.where(norms > 0, norms, 1)
+
+
+class _StreamingKModes(_StreamingClusterer):
+    """
+    Streaming k-modes over binary feature sets with Jaccard similarity. The mode of a cluster is
+    the set of features active in at least half of the documents assigned to it during the
+    current epoch (or its most frequent feature if there is none).
+    """
+
+    def __init__(self, n_clusters):
+        super().__init__(n_clusters)
+        self.counts = None
+        self.sizes = None
+
+    def similarity(self, block, centroids):
+        inter = _dense(block @ centroids.T)
+        union = (
+            np.asarray(block.sum(1)).reshape(-1, 1)
+            + np.asarray(centroids.sum(1)).reshape(1, -1)
+            - inter
+        )
+        return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+    def _modes(self, counts, sizes, previous):
+        modes = previous.copy()
+        for c in np.flatnonzero(sizes):
+            frequency = counts[c] / sizes[c]
+            mode = frequency >= 0.5
+            if not mode.any():
+                mode[frequency.argmax()] = True
+            modes[c] = mode
+        return modes
+
+    def centroids_of(self, block, labels, previous):
+        counts = (_one_hot(labels, self.n_clusters) @ block).toarray()
+        return self._modes(
+            counts, np.bincount(labels, minlength=self.n_clusters), previous
+        )
 
-    # --- Cluster examples ---
+    def start_epoch(self):
+        self.counts = np.zeros_like(self.centroids)
+        self.sizes = np.zeros(self.n_clusters)
+
+    def partial_fit(self, block):
+        labels, _ = self.assign(block)
+        self.counts += (_one_hot(labels, self.n_clusters) @ block).toarray()
+        self.sizes += np.bincount(labels, minlength=self.n_clusters)
+        self.centroids = self._modes(self.counts, self.sizes, self.centroids)
+
+
+def _contrast_values(activations, contrast="binary"):
+    """
+    Values of a CSR block of activations averaged by the distinctive-feature contrasts: 1 for
+    active features ("binary") or the activation itself ("magnitude").
+    """
+    if contrast == "binary":
+        values = csr_matrix(activations > 0, dtype=np.float64)
+    else:
+        values = csr_matrix(activations, dtype=np.float64)
+        values.data = np.nan_to_num(values.data)  # Rows without activations
+    values.eliminate_zeros()
+    return values
+
+
+def _cluster_sums(values, labels, n_clusters):
+    """
+    Per-cluster feature sums of a CSR matrix as one sparse product of the cluster indicator
+    matrix and `values`. Documents labelled -1 are left out.
+
+    Returns:
+        Tuple of the (n_clusters, n_features) sums and the size of each cluster
+    """
+    valid = labels != -1
+    if not valid.all():
+        values, labels = values[valid], labels[valid]
+    sums = (_one_hot(labels, n_clusters) @ values).toarray()
+    return sums, np.bincount(labels, minlength=n_clusters)
+
+
+def _feature_contrasts(sums, sizes):
+    """
+    Difference, per feature, between the mean value in each cluster and outside of it. The
+    out-of-cluster sums are the totals minus the cluster's own.
+
+    Returns:
+        Tuple of the non-empty clusters and their (n_clusters, n_features) differences
+    """
+    clusters = np.flatnonzero(sizes)
+    sums, sizes = sums[clusters], sizes[clusters, None]
+    outside = sizes.sum() - sizes
+    with np.errstate(invalid="ignore", divide="ignore"):
+        diffs = sums / sizes - (sums.sum(0) - sums) / outside
+    return clusters, diffs
+
+
+def _distinctive_features(clusters, diffs, feature_labels, active_features=None, top_n=5):
+    """
+    clusters: cluster of each row of `diffs`
+    diffs: (n_clusters, n_features) per-cluster contrasts of the (filtered) features
+
+    Returns:
+        Dictionary mapping each cluster to its top_n 'positive' and 'negative' features
+    """
+    n_features = diffs.shape[1]
+    # One argsort per row, as the per-cluster loop did, so tied features keep their order
+    order = np.argsort(diffs, axis=1)
+    top = order[:, ::-1][:, :top_n]
+    bot = order[:, :top_n]
+    original = (
+        np.asarray(active_features) if active_features is not None else np.arange(n_features)
+    )
+
+    def build(row, indices):
+        out = []
+        for i in indices:
+            orig = int(original[i])
+            label = (
+                feature_labels[orig] if orig in feature_labels else f"feature_{orig}"
+            )
+            out.append((orig, label, float(diffs[row, i])))
+        return out
+
+    return {
+        c: {"positive": build(row, top[row]), "negative": build(row, bot[row])}
+        for row, c in enumerate(clusters.tolist())
+    }
+
+
+def _cluster_results(labels, probs, distinctive, top_n=5):
+    """
+    Result dictionary of the clustering functions: the examples of each cluster sorted by their
+    score in `probs`, and the cluster's distinctive features.
+    """
     results = {}
-    doc_ids = np.arange(len(activations))
+    doc_ids = np.arange(len(labels))
     valid_clusters = sorted(set(labels) - {-1})
 
     for c in valid_clusters:
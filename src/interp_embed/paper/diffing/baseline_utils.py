@@ -267,3 +267,14 @@ def format_statistics_output(stats: Dict[str, Any]) -> str:
             lines.append(f"{key}: {value}")
 
     return "\n".join(lines)
+
+
+def parse_response_json(response) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Extract JSON from the content of an LLM chat completion (see extract_json_from_response). Passed
+    as `validate` to call_async_llm, so responses without valid JSON are not cached.
+
+    Raises:
+        ValueError: If no valid JSON could be extracted
+    """
+    return extract_json_from_response(response.choices[0].message.content)
@@ -34,6 +34,7 @@ from pathlib import Path
 from baseline_utils import (
     create_query_prompt,
     extract_json_from_response,
+    parse_response_json,
 )
 from interp_embed.llm.utils import get_llm_client, call_async_llm
 from hypothesis_verifier import HypothesisVerifier
@@ -124,7 +125,8 @@ Return your analysis as a JSON array of difference objects.
                 prompt, model_a_response, model_b_responses, both_directions
             )
 
-            response = await call_async_llm(self.client, self.model, [{"role": "user", "content": analysis_prompt}])
+            response = await call_async_llm(self.client, self.model, [{"role": "user", "content": analysis_prompt}], validate=parse_response_json,
+                                            max_concurrency=self.max_concurrency)
 
             self.tokens_used += response.usage.total_tokens
 
@@ -178,47 +180,45 @@ Return your analysis as a JSON array of difference objects.
             data = data[:max_samples]
 
         # Process each row
-        semaphore = asyncio.Semaphore(self.max_concurrency)
         results = [None] * len(data)
 
         async def process_row(i, row):
-            async with semaphore:
-                prompt_text = row.get('prompt', row.get('question', ''))
-                model_a_response = row.get(model_a_col, '')
-
-                # Get all model B responses
-                model_b_responses = []
-                for col in model_b_cols:
-                    response = row.get(col, '')
-                    if not response:
-                        logger.warning(f"Skipping row {i}: missing data in column {col}")
-                        return (i, None)
-                    model_b_responses.append(response)
-
-                if not model_a_response:
-                    logger.warning(f"Skipping row {i}: missing data in column {model_a_col}")
+            prompt_text = row.get('prompt', row.get('question', ''))
+            model_a_response = row.get(model_a_col, '')
+
+            # Get all model B responses
+            model_b_responses = []
+            for col in model_b_cols:
+                response = row.get(col, '')
+                if not response:
+                    logger.warning(f"Skipping row {i}: missing data in column {col}")
                     return (i, None)
+                model_b_responses.append(response)
 
-                multi_analysis = await self.analyze_multi_comparison(
-                    prompt_text, model_a_response, model_b_responses, both_directions
-                )
+            if not model_a_response:
+                logger.warning(f"Skipping row {i}: missing data in column {model_a_col}")
+                return (i, None)
+
+            multi_analysis = await self.analyze_multi_comparison(
+                prompt_text, model_a_response, model_b_responses, both_directions
+            )
+
+            # Extract structured properties from the analysis
+            if multi_analysis.get('analysis'):
+                properties = self.extract_json_from_response(multi_analysis['analysis'])
+                # Filter for the two types of differences we care about
+                filtered_properties = []
+                for prop in properties:
+                    diff_type = prop.get('difference_type', '')
+                    if both_directions:
+                        if diff_type in ['unique_to_a', 'common_to_all_b']:
+                            filtered_properties.append(prop)
+                    else:
+                        if diff_type == 'unique_to_a':
+                            filtered_properties.append(prop)
+                multi_analysis['properties'] = filtered_properties
 
-                # Extract structured properties from the analysis
-                if multi_analysis.get('analysis'):
-                    properties = self.extract_json_from_response(multi_analysis['analysis'])
-                    # Filter for the two types of differences we care about
-                    filtered_properties = []
-                    for prop in properties:
-                        diff_type = prop.get('difference_type', '')
-                        if both_directions:
-                            if diff_type in ['unique_to_a', 'common_to_all_b']:
-                                filtered_properties.append(prop)
-                        else:
-                            if diff_type == 'unique_to_a':
-                                filtered_properties.append(prop)
-                    multi_analysis['properties'] = filtered_properties
-
-                return (i, multi_analysis)
+            return (i, multi_analysis)
 
         tasks = [
             process_row(i, row)
@@ -343,7 +343,7 @@ Batch data:
 Provide a concise summary of the key patterns relevant to the query."""
 
                 try:
-                    response = await call_async_llm(self.client, self.model, [{"role": "user", "content": summary_prompt}])
+                    response = await call_async_llm(self.client, self.model, [{"role": "user", "content": summary_prompt}], max_concurrency=self.max_concurrency)
 
                     self.tokens_used += response.usage.total_tokens
 
@@ -396,7 +396,8 @@ Provide a concise summary of the key patterns relevant to the query."""
             )
 
         try:
-            response = await call_async_llm(self.client, self.model, [{"role": "user", "content": query_prompt}])
+            response = await call_async_llm(self.client, self.model, [{"role": "user", "content": query_prompt}], validate=parse_response_json,
+                                            max_concurrency=self.max_concurrency)
 
             self.tokens_used += response.usage.total_tokens
 
@@ -44,17 +44,21 @@ from hypothesis_verifier import HypothesisVerifier
 # Import helper functions
 from sae_utils import (
     extract_json_from_response,
+    parse_json_response,
     ensure_prompts_list,
     get_average_score,
     build_gpt4_labeling_prompt,
     build_single_sample_prompt,
+    build_batch_sample_prompt,
     build_hypotheses_prompt,
     build_middle_out_batch_prompt,
     build_middle_out_final_prompt,
     diff_features_multi,
+    select_feature_samples,
     limit_feature_differences,
     FeatureLabelingResponse,
     SingleSampleScoringResponse,
+    BatchScoringResponse,
 )
 
 
@@ -65,19 +69,21 @@ RESULTS_DIR = os.path.join("sae", "generated_hypotheses")
 class HypothesisGenerator:
     """Generates hypotheses about differences between two datasets."""
 
-    def __init__(self, model: str = "google/gemini-2.5-flash", max_concurrency: int = 8):
+    def __init__(self, model: str = "google/gemini-2.5-flash", max_concurrency: int = 8, score_batch_size: int = 1):
+        """
+        :param score_batch_size: Number of sample pairs scored per LLM request (1 for one request per pair)
+        """
         self.model = model
+        self.score_batch_size = score_batch_size
         self.async_client = get_llm_client(is_openai_model = model.startswith("openai/"), is_async=True)
         self.sync_client = get_llm_client(is_openai_model = model.startswith("openai/"), is_async=False)
-        self.sem = asyncio.Semaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
         self.tokens_used = 0
 
-    async def call_llm_async(self, model, messages, max_tokens = None):
-        """Make async LLM API call with semaphore."""
-        async with self.sem:
-            response = await call_async_llm(self.async_client, model, messages, max_tokens = max_tokens)
-
-        return response
+    async def call_llm_async(self, model, messages, max_tokens = None, validate = None):
+        """Make async LLM API call, at most max_concurrency at once; responses `validate` raises on are not cached (see call_async_llm)."""
+        return await call_async_llm(self.async_client, model, messages, max_tokens = max_tokens, validate = validate,
+                                    max_concurrency = self.max_concurrency)
 
     async def label_feature(self, positive_samples: List[str], negative_samples: List[str],
                           prompts: List[str] = None,
@@ -100,7 +106,8 @@ class HypothesisGenerator:
                     },
                     {"role": "user", "content": prompt}
                 ],
-                max_tokens = 10000
+                max_tokens = 10000,
+                validate = lambda response: FeatureLabelingResponse(**parse_json_response(response))
             )
 
             content = response.choices[0].message.content
@@ -134,7 +141,8 @@ class HypothesisGenerator:
                     },
                     {"role": "user", "content": prompt_text}
                 ],
-                max_tokens = 1000
+                max_tokens = 1000,
+                validate = lambda response: SingleSampleScoringResponse(**parse_json_response(response))
             )
             content = response.choices[0].message.content
 
@@ -147,6 +155,46 @@ class HypothesisGenerator:
             print(content)
             return None
 
+    async def score_sample_batch(self, feature_description: str, positive_samples: List[str], negative_samples: List[str],
+                                 prompts: List[str] = None,
+                                 model: str = None) -> List[Optional[SingleSampleScoringResponse]]:
+        """Score several sample pairs against a feature description in one request, as score_single_sample scores one."""
+        if model is None:
+            model = self.model
+
+        prompt_text = build_batch_sample_prompt(feature_description, positive_samples, negative_samples, prompts)
+        content = None
+        try:
+            response = await self.call_llm_async(
+                model=model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "You are an expert at evaluating sparse autoencoder feature descriptions. Always respond with valid JSON."
+                    },
+                    {"role": "user", "content": prompt_text}
+                ],
+                max_tokens = 1000 * len(positive_samples),
+                validate = lambda response: BatchScoringResponse(**parse_json_response(response))
+            )
+
+            content = response.choices[0].message.content
+
+            # Extract JSON from response
+            json_str = extract_json_from_response(content)
+            response_data = json.loads(json_str)
+            scores = {score.id: score for score in BatchScoringResponse(**response_data).scores}
+        except Exception as e:
+            print(f"Error calling LLM API: {e}")
+            print(content)
+            return [None] * len(positive_samples)
+
+        # Drop the ids, so the results have the shape of score_single_sample's
+        return [
+            SingleSampleScoringResponse(score=scores[i].score, explanation=scores[i].explanation) if i in scores else None
+            for i in range(len(positive_samples))
+        ]
+
     async def score_feature_samples(self, feature_description: str, positive_samples: list, negative_samples: list,
                                   prompts: list = None,
                                   model: str = None) -> dict:
@@ -165,11 +213,19 @@ class HypothesisGenerator:
 
         # Create tasks for paired samples
         tasks = []
-        for i in range(n_pairs):
-            prompt = prompts[i] if i < len(prompts) else ""
-            tasks.append(sem_scoring(positive_samples[i], negative_samples[i], prompt))
-
-        results = await asyncio.gather(*tasks)
+        if self.score_batch_size > 1:
+            # Batches of pairs share one request and its copy of the instructions
+            prompts = [prompts[i] if i < len(prompts) else "" for i in range(n_pairs)]
+            for start in range(0, n_pairs, self.score_batch_size):
+                end = min(start + self.score_batch_size, n_pairs)
+                tasks.append(self.score_sample_batch(feature_description, positive_samples[start:end],
+                                                     negative_samples[start:end], prompts[start:end], model=model))
+            results = [r for batch in await asyncio.gather(*tasks) for r in batch]
+        else:
+            for i in range(n_pairs):
+                prompt = prompts[i] if i < len(prompts) else ""
+                tasks.append(sem_scoring(positive_samples[i], negative_samples[i], prompt))
+            results = await asyncio.gather(*tasks)
         results = [r for r in results if r is not None]
 
         # Calculate scores
@@ -184,27 +240,24 @@ class HypothesisGenerator:
             "all_responses": results,
         }
 
-    async def process_feature(self, diff_activations, all_other_activations, difference, feature_id, target_dataset: Dataset, other_datasets: List[Dataset],
-                            threshold: float = 0.75) -> Optional[Tuple]:
-        """Process a single feature for analysis."""
-
-        top_indices = np.argsort(diff_activations)[::-1][:40]
-
-        positive_samples = [row.token_activations(feature_id) for row in target_dataset[top_indices]]
-
-        # Get negative samples from all other datasets
-        negative_samples = []
-        for ind in top_indices:
-            # Shuffle the activations for this index (across datasets)
-            shuffled_activations = all_other_activations[:, ind].copy()
-            other_indices = np.argsort(np.random.shuffle(shuffled_activations)).tolist() # Choose the sample with the lowest activation. If there are multiple at the lowest activation, randomly select one.
-            negative_samples.append(other_datasets[other_indices[0]][ind.item()].token_activations(feature_id))
+    async def process_feature(self, samples, difference, feature_id, target_dataset: Dataset, other_datasets: List[Dataset],
+                            threshold: float = 0.75, prompts: Optional[List[str]] = None) -> Optional[Tuple]:
+        """
+        Process a single feature for analysis.
 
+        :param samples: Tuple of (positive row ids, negative dataset ids, negative row ids) from `select_feature_samples`
+        :param prompts: Prompt column of the target dataset, if it has one
+        """
+        positive_rows, negative_datasets, negative_rows = samples
+        positive_samples = [target_dataset[row].token_activations(feature_id) for row in positive_rows.tolist()]
+        negative_samples = [
+            other_datasets[dataset][row].token_activations(feature_id)
+            for dataset, row in zip(negative_datasets.tolist(), negative_rows.tolist())
+        ]
 
         # Get prompts from target dataset only
-        df_target = target_dataset.pandas()
-        if "prompt" in df_target.columns:
-            prompts = [df_target.iloc[idx]["prompt"] for idx in top_indices]
+        if prompts is not None:
+            prompts = [prompts[row] for row in positive_rows.tolist()]
         else:
             prompts = [""] * len(positive_samples)
 
@@ -253,26 +306,35 @@ class HypothesisGenerator:
                     difference)
 
     async def analyze_feature_differences(self, target_dataset: Dataset, other_datasets: Union[Dataset, List[Dataset]],
-                                        threshold: float = 0.75, min_difference: float = 0.03, batch_size: int = 100, both_directions: bool = True, max_feature_diffs: int = None) -> List[Dict]:
-        """Analyze differences between target dataset and one or more other datasets."""
+                                        threshold: float = 0.75, min_difference: float = 0.03, batch_size: int = 100, both_directions: bool = True, max_feature_diffs: int = None,
+                                        max_q_value: float = None) -> List[Dict]:
+        """
+        Analyze differences between target dataset and one or more other datasets.
+
+        Features are selected by a coverage difference above `min_difference` and, if `max_q_value` is set,
+        an FDR-corrected Fisher exact q-value of at most `max_q_value` (see `diff_features_multi`), so that
+        only significant differences are labeled and scored.
+        """
         # Handle single dataset case
         if isinstance(other_datasets, Dataset):
             other_datasets = [other_datasets]
 
         print("Computing feature differences...")
-        target_activations = target_dataset.latents()
-        all_other_activations = []
-        for other_dataset in other_datasets:
-            all_other_activations.append(other_dataset.latents())
-        all_other_activations = np.stack(all_other_activations, axis=0)
-        diffs = diff_features_multi(target_activations, all_other_activations)
+        target_activations = target_dataset.latents(compress=True)
+        all_other_activations = [other_dataset.latents(compress=True) for other_dataset in other_datasets]
+        diffs = diff_features_multi(target_activations, all_other_activations, significance=max_q_value is not None)
 
         print(diffs.head())
 
         # Filter for significant differences
+        target_significant = diffs["target_diff_others"] > min_difference
+        others_significant = diffs["others_diff_target"] > min_difference
+        if max_q_value is not None:
+            target_significant &= diffs["target_diff_others_q_value"] <= max_q_value
+            others_significant &= diffs["others_diff_target_q_value"] <= max_q_value
         if both_directions:
-            target_diff_others = diffs[diffs["target_diff_others"] > min_difference]
-            others_diff_target = diffs[diffs["others_diff_target"] > min_difference]
+            target_diff_others = diffs[target_significant]
+            others_diff_target = diffs[others_significant]
             # Combine significant differences from both directions into a single DataFrame
             significant_diffs = pd.DataFrame({
                 "feature_id": pd.concat([target_diff_others["feature_id"], others_diff_target["feature_id"]], ignore_index=True),
@@ -280,7 +342,7 @@ class HypothesisGenerator:
             })
         else:
             # Only consider target_diff_others (features that target has but others don't)
-            target_diff_others = diffs[diffs["target_diff_others"] > min_difference]
+            target_diff_others = diffs[target_significant]
             significant_diffs = pd.DataFrame({
                 "feature_id": target_diff_others["feature_id"],
                 "diff_activation": target_diff_others["target_diff_others"]
@@ -296,8 +358,12 @@ class HypothesisGenerator:
         # Process features in batches to control memory usage
         print(f"Processing {len(significant_diffs)} features in batches of {batch_size}...")
 
-        other_activations = all_other_activations.max(axis=0)
-        diff_activations = target_activations - other_activations
+        # Select the samples of all features up front, so each feature task only formats and scores them
+        feature_samples = select_feature_samples(
+            target_activations, all_other_activations, significant_diffs["feature_id"].to_numpy()
+        )
+        df_target = target_dataset.pandas()
+        prompts = df_target["prompt"].tolist() if "prompt" in df_target.columns else None
 
         semaphore = asyncio.Semaphore(batch_size)
         results = [None] * len(significant_diffs)
@@ -306,7 +372,7 @@ class HypothesisGenerator:
             async with semaphore:
                 feature_id = significant_diffs["feature_id"].iloc[i].item()
                 difference = significant_diffs["diff_activation"].iloc[i].item()
-                processed_feature = await self.process_feature(diff_activations[:, feature_id], all_other_activations[:, :, feature_id], difference, feature_id, target_dataset, other_datasets, threshold)
+                processed_feature = await self.process_feature(feature_samples[feature_id], difference, feature_id, target_dataset, other_datasets, threshold, prompts)
                 return i, processed_feature
 
         tasks = [
@@ -410,7 +476,9 @@ class HypothesisGenerator:
                     "temperature": 0.1,
                 }
 
-                response = await self.call_llm_async(model, [{"role": "user", "content": prompt}])
+                # Unparseable hypotheses are not cached, so the next attempt sends a new request
+                validate = None if hypothesis_format == "paragraph" else parse_json_response
+                response = await self.call_llm_async(model, [{"role": "user", "content": prompt}], validate = validate)
 
                 self.tokens_used += response.usage.total_tokens
 
@@ -504,7 +572,7 @@ class HypothesisGenerator:
                                 threshold: float = 0.75, min_difference: float = 0.03,
                                 output_file: str = None, precomputed_features_path: str = None, num_hypotheses: int = 5,
                                 batch_size: int = 100, both_directions: bool = True, use_middle_out: bool = True,
-                                max_feature_diffs: int = None) -> Dict[str, Any]:
+                                max_feature_diffs: int = None, max_q_value: float = None) -> Dict[str, Any]:
         """Main function to generate hypotheses from dataset files or precomputed features.
 
         Args:
@@ -516,6 +584,7 @@ class HypothesisGenerator:
             output_file: Path to output JSON file
             precomputed_features_path: Path to precomputed features CSV
             num_hypotheses: Number of hypotheses to generate
+            max_q_value: Maximum FDR-corrected q-value of the analyzed feature differences (None for no test)
         """
         # Convert single path to list
         if isinstance(dataset2_paths, str):
@@ -544,7 +613,7 @@ class HypothesisGenerator:
             print(f"Number of comparison datasets: {len(other_datasets)}")
 
             # Analyze differences
-            significant_features = await self.analyze_feature_differences(dataset1, other_datasets, threshold, min_difference, batch_size=batch_size, both_directions=both_directions, max_feature_diffs=max_feature_diffs)
+            significant_features = await self.analyze_feature_differences(dataset1, other_datasets, threshold, min_difference, batch_size=batch_size, both_directions=both_directions, max_feature_diffs=max_feature_diffs, max_q_value=max_q_value)
 
         print(f"Found {len(significant_features)} significant features")
 
@@ -690,11 +759,13 @@ async def main():
     parser.add_argument("--load-precomputed", help="Path to precomputed features CSV file (skips feature analysis)")
     parser.add_argument("--num-hypotheses", type=int, default=10, help="Number of hypotheses to generate")
     parser.add_argument("--max-concurrency", type=int, default=100, help="Maximum number of concurrent tasks")
+    parser.add_argument("--score-batch-size", type=int, default=1, help="Number of sample pairs scored per LLM request when scoring feature labels")
     parser.add_argument("--model", type=str, default="google/gemini-2.5-flash", help="LLM model to use for hypothesis generation")
     parser.add_argument("--sae-model", type=str, default="meta-llama/Llama-3.3-70B-Instruct", help="SAE model for tokenization")
     parser.add_argument("--batch-size", type=int, default=20, help="Process features in batches to control memory usage")
     parser.add_argument("--both", action="store_true", default=False,  help="Analyze differences in both directions (target->other and other->target)")
     parser.add_argument("--max-feature-diffs", type=int, default=None, help="Maximum number of feature differences to analyze (None for no limit)")
+    parser.add_argument("--max-q-value", type=float, default=None, help="Only analyze feature differences with an FDR-corrected Fisher exact q-value at most this (None for no test)")
     parser.add_argument("--no-middle-out", action="store_true", help="Disable middle-out approach for large feature sets (may hit token limits)")
     parser.add_argument("--verify-file", type=str, required=False, help="Path to CSV/JSON file containing data to verify hypotheses against (required when --verify is used)")
     parser.add_argument("--verify-judge-model", default="google/gemini-2.5-flash", help="Model to use as judge for verification")
@@ -705,7 +776,8 @@ async def main():
     # Initialize generator
     generator = HypothesisGenerator(
         model=args.model,
-        max_concurrency=args.max_concurrency
+        max_concurrency=args.max_concurrency,
+        score_batch_size=args.score_batch_size
     )
 
     # Generate hypotheses
@@ -722,7 +794,8 @@ async def main():
         args.batch_size,
         args.both,
         use_middle_out,
-        args.max_feature_diffs
+        args.max_feature_diffs,
+        args.max_q_value
     )
 
     # Print number of hypotheses (now a list of dicts in 'differences')
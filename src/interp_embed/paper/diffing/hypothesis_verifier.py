@@ -31,6 +31,13 @@ from dotenv import load_dotenv
 from interp_embed.llm.utils import get_llm_client, call_async_llm
 
 
+def check_judge_format(response_obj) -> None:
+    """Raise if a judge response lacks the REASONING:/ANSWER: sections parsed below, so it is not cached."""
+    content = response_obj.choices[0].message.content or ""
+    if "REASONING:" not in content or content.count("ANSWER:") != 1:
+        raise ValueError("Judge response is not in the REASONING:/ANSWER: format")
+
+
 class HypothesisVerifier:
     """Verifies whether hypotheses apply to LLM responses using an LLM judge."""
 
@@ -131,8 +138,9 @@ class HypothesisVerifier:
         return responses_by_field
 
     async def verify_hypothesis_response(self, hypothesis: Dict[str, Any], response: str,
-                                       hypothesis_idx: int, response_idx: int) -> Dict[str, Any]:
-        """Verify whether a single hypothesis applies to a single response."""
+                                       hypothesis_idx: int, response_idx: int,
+                                       max_concurrency: Optional[int] = None) -> Dict[str, Any]:
+        """Verify whether a single hypothesis applies to a single response, with at most max_concurrency judge requests in flight."""
 
         # Extract hypothesis components
         hypothesis_description = hypothesis.get('description', '')
@@ -168,7 +176,8 @@ Your response:"""
         try:
             start_time = time.time()
 
-            response_obj = await call_async_llm(self.client, self.judge_model, [{"role": "user", "content": prompt}], max_tokens=3000, temperature=0.0)
+            response_obj = await call_async_llm(self.client, self.judge_model, [{"role": "user", "content": prompt}], max_tokens=3000, temperature=0.0,
+                                          validate=check_judge_format, max_concurrency=max_concurrency)
 
             end_time = time.time()
 
@@ -241,14 +250,11 @@ Your response:"""
         print(f"Starting verification of {len(hypotheses)} hypotheses against {len(responses)} responses from {dataset_name}...")
         print(f"Total verification tasks: {len(hypotheses) * len(responses)}")
 
-        # Create semaphore for concurrency control
-        semaphore = asyncio.Semaphore(max_concurrent)
-
         async def bounded_verify(hypothesis: Dict[str, Any], response: str, h_idx: int, r_idx: int, task_idx: int):
-            """Verify with semaphore and preserve task index."""
-            async with semaphore:
-                result = await self.verify_hypothesis_response(hypothesis, response, h_idx, r_idx)
-                return task_idx, result
+            """Verify with at most max_concurrent judge requests in flight and preserve task index."""
+            result = await self.verify_hypothesis_response(hypothesis, response, h_idx, r_idx,
+                                                           max_concurrency=max_concurrent)
+            return task_idx, result
 
         # Create all tasks with their indices
         tasks = []
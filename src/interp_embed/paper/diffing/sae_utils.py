@@ -2,14 +2,17 @@
 """
 Utility functions for SAE hypothesis generation.
 """
-from typing import List, Optional, Dict, Union
+from typing import Any, List, Optional, Dict, Union
 import json
 import os
 from pydantic import BaseModel, Field
 from openai import OpenAI, AsyncOpenAI
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.stats import hypergeom, norm
 from dataclasses import dataclass
+from interp_embed.utils.data_models import BatchSampleScoringResponse, BatchScoringResponse
 # Pydantic models for feature labeling and scoring
 class FeatureLabelingRequest(BaseModel):
     positive_samples: List[str] = Field(
@@ -49,6 +52,7 @@ class SingleSampleScoringResponse(BaseModel):
         ..., description="Explanation for the score."
     )
 
+
 @dataclass
 class Hypothesis:
     """Represents a generated hypothesis about dataset differences."""
@@ -83,6 +87,19 @@ def extract_json_from_response(content: str) -> str:
     return json_str
 
 
+def parse_json_response(response) -> Any:
+    """
+    Parse the JSON in the content of an LLM chat completion.
+
+    Args:
+        response: The chat completion returned by call_async_llm
+
+    Returns:
+        The parsed JSON value
+    """
+    return json.loads(extract_json_from_response(response.choices[0].message.content))
+
+
 def ensure_prompts_list(prompts: Optional[List[str]], samples_length: int) -> List[str]:
     """
     Ensure prompts is a list of the correct length, defaulting to empty strings if None.
@@ -229,6 +246,52 @@ Make sure your response is valid JSON that can be parsed directly. Keep the expl
     return prompt
 
 
+def build_batch_sample_prompt(feature_description: str, positive_samples: List[str], negative_samples: List[str],
+                              prompts: Optional[List[str]] = None) -> str:
+    """Build prompt for scoring several (positive, negative) sample pairs in one request, each as in build_single_sample_prompt."""
+    prompts = ensure_prompts_list(prompts, len(positive_samples))
+
+    pair_sections = ""
+    for i, (positive_sample, negative_sample) in enumerate(zip(positive_samples, negative_samples)):
+        prompt_section = ""
+        if i < len(prompts) and prompts[i]:
+            prompt_section = f"PROMPT (user input that generated the responses):\n{prompts[i]}\n\n"
+        pair_sections += f"""PAIR {i}:
+{prompt_section}POSITIVE SAMPLE (feature activated, << >> marks WHERE it activated):
+{positive_sample}
+
+NEGATIVE SAMPLE (feature did NOT activate, no << >> markers):
+{negative_sample}
+
+"""
+
+    prompt = f"""You are an expert at evaluating sparse autoencoder feature descriptions.
+
+You are given a feature description and {len(positive_samples)} numbered pairs of samples. Each pair has a POSITIVE sample (where the feature activated, with tokens surrounded by << and >>) and a NEGATIVE sample (where the feature did NOT activate, and there should be no << >> markers). Score each pair independently of the others.
+
+IMPORTANT NOTES:
+1. The << >> markers indicate where the feature activated, but you should NOT restrict your understanding to just those marked tokens. Look at the context BEFORE the marked tokens as well - the preceding tokens often provide crucial information about what the feature is detecting.
+2. The feature may be responding to a pattern or concept that spans both the context tokens AND the marked tokens together.
+3. The token <eot_id> is an end-of-sequence (EOS) token and should NOT be considered as a valid feature activation. If you see <<eot_id>> in the samples, ignore it as it's just a technical marker for the end of text, not a meaningful activation.
+4. You shouldn't be trying to infer what the feature description should be from the positive and negative samples; rather, you should use the feature description to evaluate the samples.
+
+Feature description:
+"{feature_description}"
+
+{pair_sections}Your task, for each pair:
+- Evaluate if the feature description accurately describes whether or not the feature activates, considering BOTH the context before the << >> markers AND the marked tokens themselves to understand what triggered the feature
+- Score 1 if the property described by the feature description is clearly present in the positive sample (considering both context and marked tokens) and absent in the negative sample.
+- Score 0 if the property described by the feature description is not clearly present in the positive sample, or if the negative sample also contains the property. If the feature description is not a valid property (ex. "feature_#"), mark 0.
+
+Return your answer as a JSON object with exactly one field, "scores": a JSON array with one object per pair, in pair order, each with exactly these fields:
+- "id": <the pair number>
+- "explanation": "<brief explanation for the score, focusing on how the context and marked tokens together show the difference between samples>"
+- "score": <0 or 1>
+
+Make sure your response is valid JSON that can be parsed directly. Keep each explanation brief (1-2 sentences)."""
+    return prompt
+
+
 def build_middle_out_batch_prompt(batch: List[Dict], query: str, batch_index: int, total_batches: int) -> str:
     """Build prompt for summarizing a batch of features in middle-out approach."""
     prompt = f"""Summarize these feature differences for the query: "{query}"
@@ -403,32 +466,160 @@ def limit_feature_differences(significant_diffs: pd.DataFrame, max_feature_diffs
     return significant_diffs
 
 
-def diff_features_multi(target_activations, other_activations, feature_activation_type="max", min_coverage=0.0, max_coverage=1.0):
+def _pad_rows(matrix, n_rows):
+    """Extend a CSR matrix with empty rows up to n_rows rows."""
+    if matrix.shape[0] == n_rows:
+        return matrix
+    indptr = np.concatenate([matrix.indptr, np.full(n_rows - matrix.shape[0], matrix.indptr[-1])])
+    return csr_matrix((matrix.data, matrix.indices, indptr), shape=(n_rows, matrix.shape[1]))
+
+
+def _canonical(matrix):
+    """CSR matrix without duplicate entries, copied only if needed (activation matrices are shared caches)."""
+    matrix = csr_matrix(matrix)
+    if not matrix.has_canonical_format:
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    return matrix
+
+
+def _nonzero_counts(matrix):
+    """Number of non-zero entries (NaN included) in each column of a CSR matrix."""
+    matrix = _canonical(matrix)
+    return np.bincount(matrix.indices[matrix.data != 0], minlength=matrix.shape[1])
+
+
+def _binary_pattern(rows, features, shape):
+    """Binary CSR matrix with ones at the (sorted) positions (rows[i], features[i])."""
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=shape[0]))])
+    return csr_matrix((np.ones(len(rows), dtype=np.float32), features, indptr), shape=shape)
+
+
+def _max_and_all_nonzero(matrices):
+    """
+    Binary CSR patterns of where the elementwise max of equally shaped CSR matrices is non-zero, and of
+    where all of them are non-zero, as np.max and np.all of the stacked dense arrays (NaN propagates
+    through the max and counts as non-zero).
+
+    Only stored entries are visited: they are grouped by position and reduced, and positions stored in
+    fewer than all matrices also take the implicit zeros into account.
+    """
+    matrices = [_canonical(matrix) for matrix in matrices]
+    shape = matrices[0].shape
+    positions = np.concatenate([
+        np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr)) * shape[1] + matrix.indices
+        for matrix in matrices
+    ])
+    values = np.concatenate([matrix.data for matrix in matrices])
+    order = np.argsort(positions, kind="stable")
+    positions, values = positions[order], values[order]
+    starts = np.flatnonzero(np.concatenate([[True], positions[1:] != positions[:-1]]))
+    if len(starts) == 0:
+        return csr_matrix(shape, dtype=np.float32), csr_matrix(shape, dtype=np.float32)
+    stored = np.diff(np.append(starts, len(positions)))
+    maxes = np.maximum.reduceat(values, starts)
+    maxes = np.where(stored < len(matrices), np.maximum(maxes, 0), maxes)
+    all_nonzero = np.add.reduceat((values != 0).astype(np.int64), starts) == len(matrices)
+    rows, features = np.divmod(positions[starts], shape[1])
+    return (
+        _binary_pattern(rows[maxes != 0], features[maxes != 0], shape),
+        _binary_pattern(rows[all_nonzero], features[all_nonzero], shape),
+    )
+
+
+def _benjamini_hochberg(p_values):
+    """Benjamini-Hochberg adjusted p-values (q-values); NaN entries are left out of the correction."""
+    q_values = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    if len(tested) == 0:
+        return q_values
+    order = tested[np.argsort(p_values[tested], kind="stable")]
+    adjusted = p_values[order] * len(tested) / np.arange(1, len(tested) + 1)
+    q_values[order] = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1.0)
+    return q_values
+
+
+def _proportion_tests(k1, n1, k2, n2):
+    """
+    One-sided tests that the proportion k1 / n1 is greater than k2 / n2, elementwise over features.
+
+    :return: Tuple of (pooled two-proportion z statistics, their p-values, Fisher exact p-values)
+    """
+    pooled = (k1 + k2) / (n1 + n2)
+    se = np.sqrt(pooled * (1 - pooled) * (1 / n1 + 1 / n2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.where(se > 0, (k1 / n1 - k2 / n2) / se, 0.0)
+    # P(X >= k1) for the hypergeometric count of the first sample, as fisher_exact(alternative="greater")
+    fisher_p = hypergeom.sf(k1 - 1, n1 + n2, k1 + k2, n1)
+    return z, norm.sf(z), fisher_p
+
+
+def _bootstrap_counts(pattern, n_bootstrap, rng, chunk_size=100):
+    """
+    Column counts of a binary CSR pattern over bootstrap resamples of its rows, as an
+    (n_bootstrap, n_features) array. Each resample is a vector of row multiplicities, so the counts of
+    a chunk of resamples are one sparse-dense product.
+    """
+    n_rows = pattern.shape[0]
+    counts = np.empty((n_bootstrap, pattern.shape[1]), dtype=np.float32)
+    pattern_T = pattern.T.tocsr()
+    for start in range(0, n_bootstrap, chunk_size):
+        size = min(chunk_size, n_bootstrap - start)
+        multiplicities = rng.multinomial(n_rows, np.full(n_rows, 1 / n_rows), size=size)
+        counts[start:start + size] = (pattern_T @ multiplicities.T.astype(np.float32)).T
+    return counts
+
+
+def diff_features_multi(target_activations, other_activations, feature_activation_type="max", min_coverage=0.0, max_coverage=1.0,
+                        significance=False, n_bootstrap=0, confidence=0.95, random_state=0):
     """
     Calculate the difference in feature activations between one target dataset and multiple other datasets.
     Computes the max activation across all other datasets for each feature.
 
-    :param target_activations: The target activations
-    :param other_activations: List of other activations to compare against
+    Row i of every dataset is compared with row i of the others. The activations are kept sparse: the
+    coverage of the other datasets comes from per-column counts over their stored entries, so no
+    [n_datasets, N, d_sae] array is built. Other datasets shorter than the longest one are treated as
+    having documents without activations past their end.
+
+    With `significance`, each of the two differences gets one-sided tests that it is positive, computed
+    for all features at once and treating the datasets as independent samples: '<difference>_z' and
+    '<difference>_z_p_value' (two-proportion z-test), '<difference>_p_value' (Fisher exact test) and
+    '<difference>_q_value' (Fisher p-values with Benjamini-Hochberg FDR correction). Features removed by
+    the coverage filters get NaN. With `n_bootstrap` > 0, '<difference>_ci_low' and '<difference>_ci_high'
+    bound a percentile bootstrap confidence interval of the difference, resampling the rows of the target
+    and (jointly) of the other datasets.
+
+    :param target_activations: The target activations (dense array or CSR matrix)
+    :param other_activations: List of other activations to compare against (dense arrays or CSR matrices)
     :param feature_activation_type: Type of feature activation ('max', 'mean', or 'sum')
     :param metric: Metric to use for calculating the difference ('absolute', 'relative')
     :param min_coverage: Minimum percentage of samples that must have a non-zero activation to consider a feature
     :param max_coverage: Maximum percentage of samples that must have a non-zero activation to consider a feature
+    :param significance: Whether to add the significance test columns
+    :param n_bootstrap: Number of bootstrap resamples for the confidence interval columns (0 for none)
+    :param confidence: Confidence level of the bootstrap intervals
+    :param random_state: Seed of the bootstrap resamples
     :return: DataFrame with feature_id and diff_activation columns
     """
+    target_activations = csr_matrix(target_activations)
+    other_activations = [csr_matrix(activations) for activations in other_activations]
+    n_others = max(activations.shape[0] for activations in other_activations)
+    other_activations = [_pad_rows(activations, n_others) for activations in other_activations]
+    n_target = target_activations.shape[0]
 
     # Get feature activations for target dataset
-    target_nonzero_F = np.count_nonzero(target_activations, axis=0) / target_activations.shape[0]
+    target_count_F = _nonzero_counts(target_activations)
+    target_nonzero_F = target_count_F / n_target
 
     # Initialize arrays to store max activations across other datasets
     n_features = target_activations.shape[1]
 
     # Compute max activation percentage across all other datasets
-    other_activations_max_DF = other_activations.max(axis = 0)
-    other_activations_all_DF = np.all(other_activations, axis = 0)
-    other_max_nonzero_F = np.count_nonzero(other_activations_max_DF, axis=0) / other_activations_max_DF.shape[0]
-    other_all_nonzero_F = np.count_nonzero(other_activations_all_DF, axis=0) / other_activations_all_DF.shape[0]
-
+    other_max_NF, other_all_NF = _max_and_all_nonzero(other_activations)
+    other_max_count_F = np.bincount(other_max_NF.indices, minlength=n_features)
+    other_all_count_F = np.bincount(other_all_NF.indices, minlength=n_features)
+    other_max_nonzero_F = other_max_count_F / n_others
+    other_all_nonzero_F = other_all_count_F / n_others
     # Apply coverage filters
     feature_mask = (np.minimum(target_nonzero_F, other_max_nonzero_F) < min_coverage) | \
                    (np.maximum(target_nonzero_F, other_max_nonzero_F) > max_coverage)
@@ -453,4 +644,93 @@ def diff_features_multi(target_activations, other_activations, feature_activatio
         "other_datasets_all_coverage": other_all_nonzero_F
     })
 
+    if significance:
+        comparisons = {
+            "target_diff_others": (target_count_F, n_target, other_max_count_F, n_others),
+            "others_diff_target": (other_all_count_F, n_others, target_count_F, n_target),
+        }
+        for name, counts in comparisons.items():
+            z, z_p, fisher_p = _proportion_tests(*counts)
+            z[feature_mask], z_p[feature_mask], fisher_p[feature_mask] = np.nan, np.nan, np.nan
+            diffs_df[f"{name}_z"] = z
+            diffs_df[f"{name}_z_p_value"] = z_p
+            diffs_df[f"{name}_p_value"] = fisher_p
+            diffs_df[f"{name}_q_value"] = _benjamini_hochberg(fisher_p)
+
+    if n_bootstrap > 0:
+        rng = np.random.default_rng(random_state)
+        target_pattern, _ = _max_and_all_nonzero([target_activations])
+        target_B = _bootstrap_counts(target_pattern, n_bootstrap, rng) / n_target
+        # The other datasets are resampled with the same rows, which are aligned across them
+        other_rng_state = rng.bit_generator.state
+        other_max_B = _bootstrap_counts(other_max_NF, n_bootstrap, rng) / n_others
+        rng.bit_generator.state = other_rng_state
+        other_all_B = _bootstrap_counts(other_all_NF, n_bootstrap, rng) / n_others
+        tail = (1 - confidence) / 2 * 100
+        for name, samples in [("target_diff_others", target_B - other_max_B), ("others_diff_target", other_all_B - target_B)]:
+            low, high = np.percentile(samples, [tail, 100 - tail], axis=0)
+            low[feature_mask], high[feature_mask] = np.nan, np.nan
+            diffs_df[f"{name}_ci_low"] = low
+            diffs_df[f"{name}_ci_high"] = high
+
     return diffs_df
+
+
+def select_feature_samples(target_activations, other_activations, feature_ids, n_samples=40, block_size=256, random_state=None):
+    """
+    Select the positive and negative samples of many features in one vectorized pass.
+
+    The positive samples of a feature are the target rows where its activation most exceeds the max
+    activation over the other datasets at the same row. The negative sample paired with each positive row
+    is the same row of the other dataset with the lowest activation, chosen at random among ties. Only the
+    rows present in every dataset are considered, and features are processed in blocks of `block_size`
+    dense columns.
+
+    :param target_activations: The target activations (dense array or CSR matrix)
+    :param other_activations: List of other activations (dense arrays or CSR matrices)
+    :param feature_ids: Features to select samples for
+    :param n_samples: Number of samples per feature
+    :param random_state: Seed or numpy Generator for the tie-breaking
+    :return: Dictionary mapping each feature id to a tuple of (positive row ids, negative dataset ids,
+        negative row ids), ordered by decreasing activation difference
+    """
+    rng = np.random.default_rng(random_state)
+    activations = [csr_matrix(target_activations)] + [csr_matrix(other) for other in other_activations]
+    n_common = min(matrix.shape[0] for matrix in activations)
+    target_columns, *other_columns = [matrix[:n_common].tocsc() for matrix in activations]
+    feature_ids = np.asarray(feature_ids, dtype=np.int64)
+    k = min(n_samples, n_common)
+
+    samples = {}
+    if k == 0:
+        empty = np.array([], dtype=np.int64)
+        return {feature_id: (empty, empty, empty) for feature_id in feature_ids.tolist()}
+    for start in range(0, len(feature_ids), block_size):
+        block = feature_ids[start:start + block_size]
+        target_NB = target_columns[:, block].toarray()
+        others_DNB = np.stack([columns[:, block].toarray() for columns in other_columns])
+        diff_NB = target_NB - others_DNB.max(axis=0)
+
+        # Top k rows per feature by decreasing difference (ties by decreasing row); NaN rows come last.
+        # The rows tied with the k-th value are cut from the bottom, so the selection is the same as
+        # sorting each column.
+        key_NB = np.nan_to_num(-diff_NB, nan=np.inf)
+        kth_B = np.partition(key_NB, k - 1, axis=0)[k - 1]
+        tied_NB = key_NB == kth_B
+        n_tied_B = k - (key_NB < kth_B).sum(axis=0)
+        tied_from_bottom_NB = np.cumsum(tied_NB[::-1], axis=0)[::-1]
+        selected_NB = (key_NB < kth_B) | (tied_NB & (tied_from_bottom_NB <= n_tied_B))
+        columns = np.arange(len(block))
+        top_kB = np.nonzero(selected_NB.T)[1].reshape(len(block), k).T
+        top_values_kB = diff_NB[top_kB, columns]
+        order_Bk = np.lexsort((-top_kB.T, np.nan_to_num(-top_values_kB.T, nan=np.inf)), axis=-1)
+        top_Bk = np.take_along_axis(top_kB.T, order_Bk, axis=-1)
+
+        # Dataset with the lowest activation at each selected row, ties broken by random keys
+        values_DBk = others_DNB[:, top_Bk, columns[:, None]]
+        lowest = values_DBk == np.fmin.reduce(values_DBk, axis=0)
+        negative_Bk = np.argmax(np.where(lowest, rng.random(values_DBk.shape), -1.0), axis=0)
+
+        for feature_id, positive_rows, negative_datasets in zip(block.tolist(), top_Bk, negative_Bk):
+            samples[feature_id] = (positive_rows, negative_datasets, positive_rows)
+    return samples
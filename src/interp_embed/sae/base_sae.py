@@ -1,16 +1,28 @@
+import numpy as np
 import torch
 from abc import ABC, abstractmethod
 from enum import Enum
-from .utils import ensure_loaded, process_device_config
+from ..storage import Vocabulary
+from .utils import ensure_loaded, process_device_config, prune_csr
 
 class BaseSAE(ABC):
-  def __init__(self, truncate = True, use_assistant_role: bool = True, device: str = "cpu"):
+  def __init__(self, truncate = True, use_assistant_role: bool = True, device: str = "cpu", top_k_per_token: int = None, min_activation: float = None):
+    """
+    :param truncate: Whether to truncate documents longer than the model's context window
+    :param use_assistant_role: Whether documents are formatted as assistant (instead of user) messages
+    :param device: Device string, or a dictionary with "model" and "sae" devices
+    :param top_k_per_token: If set, only the k largest feature activations of each token are kept
+    :param min_activation: If set, only feature activations above this value are kept
+    """
     self.loaded = False
     self.tokenizer = None
     self.truncate = truncate
     self._feature_labels = dict()
     self.use_assistant_role = use_assistant_role
     self.model_device, self.sae_device = process_device_config(device)
+    self.top_k_per_token = top_k_per_token
+    self.min_activation = min_activation
+    self._vocabulary = None
 
   @classmethod
   def from_metadata(cls, metadata):
@@ -22,7 +34,9 @@ class BaseSAE(ABC):
   def metadata(self):
     return {
       "truncate": self.truncate,
-      "use_assistant_role": self.use_assistant_role
+      "use_assistant_role": self.use_assistant_role,
+      "top_k_per_token": self.top_k_per_token,
+      "min_activation": self.min_activation
     }
 
   def load(self):
@@ -91,8 +105,73 @@ class BaseSAE(ABC):
     if not as_tokens:
       return inputs
 
-    # Return human-readable tokens by decoding each token individually
-    return [[self.tokenizer.decode([token_id]) for token_id in input_sequence] for input_sequence in input_ids]
+    return [self.decode_tokens(input_sequence) for input_sequence in input_ids]
+
+  @ensure_loaded
+  def vocabulary(self):
+    """
+    Vocabulary mapping every token id of the tokenizer to its string, decoded once with
+    `batch_decode` and cached for this tokenizer.
+    """
+    if self._vocabulary is None or self._vocabulary[0] is not self.tokenizer:
+      strings = self.tokenizer.batch_decode([[token_id] for token_id in range(len(self.tokenizer))])
+      self._vocabulary = (self.tokenizer, Vocabulary(strings=strings))
+    return self._vocabulary[1]
+
+  def token_ids(self, texts):
+    """
+    Token ids of each text as seen by `encode`, one int32 array per text. Passing them to
+    `prepare_batch` saves tokenizing the texts again.
+    """
+    return [np.asarray(input_ids, dtype=np.int32) for input_ids in self.tokenize(texts, as_tokens=False)["input_ids"]]
+
+  def token_lengths(self, texts):
+    """
+    Number of tokens of each text, as seen by `encode`. Used to group texts of similar length.
+    """
+    return [len(input_ids) for input_ids in self.token_ids(texts)]
+
+  def decode_tokens(self, token_ids):
+    """
+    Human-readable tokens of one sequence, looked up in the cached vocabulary table.
+    """
+    return self.vocabulary().decode(token_ids)
+
+  def prepare_batch(self, texts, token_ids = None):
+    """
+    First stage of the encode pipeline (CPU): tokenize a batch of texts. Returns a dictionary that
+    is passed to `forward_batch` and `postprocess_batch`. Its "token_ids" entry holds the token ids
+    of each text (indexing `vocabulary()`), one per activation row; SAEs without token ids provide
+    the human-readable "tokens" instead.
+
+    Subclasses that tokenize inside `encode` should override the three stages so each text is
+    tokenized only once.
+
+    :param token_ids: Optional output of `token_ids(texts)`, used instead of tokenizing the texts
+    """
+    if token_ids is not None:
+      return {"texts": texts, "tokens": [self.decode_tokens(input_ids) for input_ids in token_ids]}
+    return {"texts": texts, "tokens": self.tokenize(texts)}
+
+  def forward_batch(self, batch):
+    """
+    Second stage of the encode pipeline: run the model and the SAE on a prepared batch. Its output
+    waits in a queue (up to `queue_size` batches) before `postprocess_batch`, so SAEs running on
+    an accelerator should return compact tensors (see `sae.utils.compact_on_device`) rather than
+    dense batch x seq x d_sae activations.
+    """
+    return self.encode(batch["texts"])
+
+  def postprocess_batch(self, batch, outputs):
+    """
+    Last stage of the encode pipeline: convert the output of `forward_batch` into one
+    (num_tokens, d_sae) csr_matrix per text, or a (csr_matrix, aggregate dictionary) tuple when the
+    "max"/"sum" aggregates are computed along with it (e.g. on the device).
+    """
+    return [
+      prune_csr(activations, self.top_k_per_token, self.min_activation) if activations is not None else None
+      for activations in outputs
+    ]
 
   @abstractmethod
   def load_models(self):
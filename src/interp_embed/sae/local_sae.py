@@ -5,7 +5,6 @@ import time
 import numpy as np
 import torch
 from sae_lens import SAE as SAEModel
-from scipy.sparse import csr_matrix
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
@@ -19,6 +18,8 @@ from .utils import (
     ensure_loaded,
     get_goodfire_config,
     goodfire_sae_loader,
+    compact_on_device,
+    compact_to_host,
     store_activations_hook,
     try_to_load_feature_labels,
 )
@@ -26,6 +27,20 @@ from .utils import (
 CONTEXT_WINDOW_LIMIT = 2048  # Context window limit used in the paper
 
 
+def attach_token_ids(batch):
+    """
+    Add the token ids of each sequence of a padded batch, taken from the same input ids the model
+    sees, so documents do not need to be tokenized a second time.
+    """
+    batch["token_ids"] = [
+        input_ids[mask].astype(np.int32)
+        for input_ids, mask in zip(
+            batch["input_ids"].numpy(), batch["attention_mask"]
+        )
+    ]
+    return batch
+
+
 class LocalSAE(BaseSAE):
     def __init__(
         self,
@@ -75,15 +90,16 @@ class LocalSAE(BaseSAE):
         self.tokenizer = self.model.tokenizer
 
     @ensure_loaded
-    @torch.no_grad()
     def encode(self, texts):
         assert len(texts) > 0, "There must be more t.han one text to encode."
-        self.sae.eval()  # prevents error if we're expecting a dead neuron mask for who grads
-        
-        print(f"self.model exists: {self.model is not None}")
-        print(f"self.sae exists: {hasattr(self, 'sae') and self.sae is not None}")
-        print(f"self.tokenizer exists: {self.tokenizer is not None}")
+        batch = self.prepare_batch(texts)
+        return [
+            activations
+            for activations, _ in self.postprocess_batch(batch, self.forward_batch(batch))
+        ]
 
+    @ensure_loaded
+    def prepare_batch(self, texts, token_ids=None):
         # # Filter out texts that exceed the context window
         # max_length = self.tokenizer.model_max_length or CONTEXT_WINDOW_LIMIT
         # valid_texts = [text for text in texts if len(self.tokenizer.tokenize(text)) <= max_length]
@@ -92,29 +108,56 @@ class LocalSAE(BaseSAE):
         #     warnings.warn(f"{len(texts) - len(valid_texts)} texts were skipped because they exceed the context window of {max_length} tokens.")
 
         self.tokenizer.pad_token = self.tokenizer.eos_token
-        tokens = self.tokenizer(
-            # valid_texts,
-            texts,
-            padding="longest",
-            # truncation=True,
-            truncation=self.truncate,
-            # max_length=max_length,
-            return_tensors="pt",
+        if token_ids is not None:
+            tokens = self.tokenizer.pad(
+                {"input_ids": [input_ids.tolist() for input_ids in token_ids]},
+                padding="longest",
+                return_tensors="pt",
+            )
+        else:
+            tokens = self.tokenizer(
+                # valid_texts,
+                texts,
+                padding="longest",
+                # truncation=True,
+                truncation=self.truncate,
+                # max_length=max_length,
+                return_tensors="pt",
+            )
+        return attach_token_ids(
+            {
+                "input_ids": tokens["input_ids"],
+                "attention_mask": tokens["attention_mask"].numpy().astype(bool),
+            }
         )
 
-        _, cache = self.model.run_with_cache(tokens["input_ids"], prepend_bos=True)
+    @ensure_loaded
+    def token_ids(self, texts):
+        return [
+            np.asarray(input_ids, dtype=np.int32)
+            for input_ids in self.tokenizer(texts, truncation=self.truncate)["input_ids"]
+        ]
+
+    @ensure_loaded
+    @torch.no_grad()
+    def forward_batch(self, batch):
+        self.sae.eval()  # prevents error if we're expecting a dead neuron mask for who grads
+        _, cache = self.model.run_with_cache(batch["input_ids"], prepend_bos=True)
 
         # Use the SAE
         feature_acts = self.sae.encode(
             cache[self.sae.cfg.metadata.hook_name].to(self.sae_device)
         )
+        # Only compact tensors wait in the pipeline queues, not the dense activations
+        return compact_on_device(
+            feature_acts,
+            batch["attention_mask"],
+            top_k=self.top_k_per_token,
+            threshold=self.min_activation,
+        )
 
-        feature_acts_np = feature_acts.detach().cpu().numpy()
-        attn_mask = tokens["attention_mask"].numpy().astype(bool)
-        return [
-            csr_matrix(feature_acts_np[i][attn_mask[i]])
-            for i in range(feature_acts_np.shape[0])
-        ]
+    def postprocess_batch(self, batch, outputs):
+        return compact_to_host(outputs)
 
     @ensure_loaded
     def encode_chat(self, chat_conversations):
@@ -259,33 +302,59 @@ class GoodfireSAE(BaseSAE):
 
     @ensure_loaded
     def encode(self, texts):
+        batch = self.prepare_batch(texts)
+        return [
+            activations
+            for activations, _ in self.postprocess_batch(batch, self.forward_batch(batch))
+        ]
+
+    @ensure_loaded
+    def prepare_batch(self, texts, token_ids=None):
+        if token_ids is not None:
+            inputs = self.tokenizer.pad(
+                {"input_ids": [input_ids.tolist() for input_ids in token_ids]},
+                padding=True,
+            )
+        else:
+            inputs = self.tokenize(texts, padding=True, as_tokens=False)
+        return attach_token_ids(
+            {
+                "input_ids": torch.tensor(inputs["input_ids"]),
+                "attention_mask": np.array(inputs["attention_mask"]).astype(bool),
+            }
+        )
+
+    @ensure_loaded
+    def forward_batch(self, batch):
         input_device = next(self.model.parameters()).device
         # print(f"Model device: {input_device}, SAE device: {self.sae_device}")
-        # print("Starting encode()...")
-            
-        inputs = self.tokenize(texts, padding=True, as_tokens=False)
 
         with torch.no_grad():
             outputs = self.model(
-                input_ids=torch.tensor(inputs["input_ids"]).to(input_device),
-                attention_mask=torch.tensor(inputs["attention_mask"]).to(input_device),
+                input_ids=batch["input_ids"].to(input_device),
+                attention_mask=torch.from_numpy(batch["attention_mask"]).to(
+                    input_device
+                ),
             )
 
             feature_acts = self.sae.encode(
-                self.activations["internal"].to(self.sae.device)
+                self.activations.pop("internal").to(self.sae.device)
+            )
+            # Only compact tensors wait in the pipeline queues, not the dense activations
+            compact = compact_on_device(
+                feature_acts,
+                batch["attention_mask"],
+                top_k=self.top_k_per_token,
+                threshold=self.min_activation,
             )
-
-        feature_acts_np = feature_acts.float().detach().cpu().numpy()
-        attn_mask = np.array(inputs["attention_mask"]).astype(bool)
 
         # Clean up memory
-        del outputs, inputs
+        del outputs, feature_acts
         torch.cuda.empty_cache()
+        return compact
 
-        return [
-            csr_matrix(feature_acts_np[i][attn_mask[i]])
-            for i in range(feature_acts_np.shape[0])
-    ]
+    def postprocess_batch(self, batch, outputs):
+        return compact_to_host(outputs)
 
     def destroy_models(self):
         self.activations = dict()
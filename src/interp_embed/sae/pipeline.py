@@ -0,0 +1,329 @@
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from ..storage import AGGREGATE_NAMES, CheckpointLog, aggregate_row
+from .load_sae import load_sae_from_metadata
+
+PIPELINE_STAGES = ("tokenize", "forward", "postprocess")
+SHARD_START_METHOD = "spawn"  # Safe with CUDA, which cannot be used in forked processes
+_DONE = object()
+
+
+class _FeedError:
+    def __init__(self, error):
+        """
+        Sentinel passed down the pipeline queues, in place of `_DONE`, when iterating over the
+        input batches raised `error`.
+        """
+        self.error = error
+
+
+def token_budget_batches(lengths, max_tokens):
+    """
+    Group documents into batches whose padded size (number of documents times the longest
+    document) stays within `max_tokens`. Documents are sorted by decreasing length, so each batch
+    holds documents of similar length; a document longer than the budget gets a batch of its own.
+
+    :param lengths: Tokenized length of each document
+    :param max_tokens: Token budget of a padded batch
+    :return: List of batches, each a list of positions into `lengths`
+    """
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind="stable")
+    batches = []
+    for position in order.tolist():
+        # The first document of a batch is its longest, so it sets the padded length
+        if batches and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= max_tokens:
+            batches[-1].append(position)
+        else:
+            batches.append([position])
+    return batches
+
+
+def plan_batches(sae, texts, batch_size=8, max_tokens=None):
+    """
+    Split `texts` into batches of at most `batch_size` documents or, if `max_tokens` is set, into
+    token-budget batches (see `token_budget_batches`) using the token ids from `sae.token_ids`.
+    The token ids are returned so the pipeline does not tokenize the texts a second time.
+
+    :return: Tuple of the list of batches, each a list of positions into `texts`, and the token ids
+        of each text (None without `max_tokens`)
+    """
+    if max_tokens is None:
+        batches = [
+            list(range(start, min(start + batch_size, len(texts))))
+            for start in range(0, len(texts), batch_size)
+        ]
+        return batches, None
+    token_ids = sae.token_ids(texts)
+    return token_budget_batches([len(ids) for ids in token_ids], max_tokens), token_ids
+
+
+def encode_shard(
+    shard_id,
+    sae_metadata,
+    device,
+    indices,
+    texts,
+    log_directory,
+    progress,
+    batch_size=8,
+    max_tokens=None,
+    save_every_batch=5,
+    queue_size=2,
+):
+    """
+    Worker process encoding one shard of a dataset. The SAE is loaded from its metadata (on
+    `device`, if given) and the computed rows are appended to the shard's sub-log of the
+    `CheckpointLog` at `log_directory`, from which the parent process merges them.
+
+    After each batch, a tuple of (shard_id, number of documents, number of tokens computed, error
+    message or None) is put on the `progress` queue.
+
+    :param indices: Dataset indices of the rows of the shard
+    :param texts: Texts of the rows of the shard
+    """
+    sae = load_sae_from_metadata(sae_metadata)
+    if device is not None:
+        sae.set_device(device)
+    sae.load()
+
+    checkpoint_log = CheckpointLog(log_directory).shard(shard_id)
+    batch_positions, token_ids = plan_batches(sae, texts, batch_size, max_tokens)
+    batches = (
+        (
+            i,
+            [texts[position] for position in positions],
+            None if token_ids is None else [token_ids[position] for position in positions],
+        )
+        for i, positions in enumerate(batch_positions)
+    )
+    unsaved_indices, unsaved_parts = [], []
+    pipeline = EncodePipeline(sae, queue_size=queue_size)
+    for i, results, error in pipeline.run(batches):
+        num_tokens = 0
+        for position, result in zip(batch_positions[i], results or []):
+            if result is not None:
+                unsaved_indices.append(indices[position])
+                unsaved_parts.append(result)
+                num_tokens += result[0].shape[0]
+        if unsaved_indices and (
+            (i + 1) % save_every_batch == 0 or i + 1 == len(batch_positions)
+        ):
+            d_sae = unsaved_parts[0][0].shape[1]
+            checkpoint_log.append(unsaved_indices, unsaved_parts, d_sae)
+            unsaved_indices, unsaved_parts = [], []
+        progress.put(
+            (
+                shard_id,
+                len(batch_positions[i]),
+                num_tokens,
+                None if error is None else str(error),
+            )
+        )
+    sae.destroy()
+
+
+class PipelineStats:
+    def __init__(self):
+        """
+        Per-stage counters of an `EncodePipeline` run. Each stage records the batches, documents
+        and tokens it processed and the time it spent busy, so the throughput of each stage can be
+        compared to the wall-clock throughput of the whole pipeline.
+        """
+        self.stages = {
+            stage: {"batches": 0, "documents": 0, "tokens": 0, "seconds": 0.0}
+            for stage in PIPELINE_STAGES
+        }
+        self.wall_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, documents, tokens):
+        with self._lock:
+            counters = self.stages[stage]
+            counters["batches"] += 1
+            counters["documents"] += documents
+            counters["tokens"] += tokens
+            counters["seconds"] += seconds
+
+    def summary(self):
+        """
+        Dictionary mapping each stage (and "total", measured in wall-clock time) to its counters
+        and its documents/tokens per second.
+        """
+        summary = {}
+        for stage, counters in self.stages.items():
+            summary[stage] = dict(counters)
+        summary["total"] = dict(self.stages["postprocess"], seconds=self.wall_seconds)
+        for counters in summary.values():
+            seconds = counters["seconds"]
+            counters["documents_per_second"] = (
+                counters["documents"] / seconds if seconds > 0 else 0.0
+            )
+            counters["tokens_per_second"] = (
+                counters["tokens"] / seconds if seconds > 0 else 0.0
+            )
+        return summary
+
+    def __repr__(self):
+        parts = [
+            f"{stage}: {counters['tokens_per_second']:.0f} tok/s ({counters['seconds']:.1f}s)"
+            for stage, counters in self.summary().items()
+        ]
+        return "PipelineStats(" + ", ".join(parts) + ")"
+
+
+class EncodePipeline:
+    def __init__(self, sae, queue_size=2):
+        """
+        Encode batches of documents with overlapping stages. Tokenization (`sae.prepare_batch`),
+        the model and SAE forward pass (`sae.forward_batch`) and the sparse conversion and
+        aggregation (`sae.postprocess_batch`) each run in their own thread, connected by bounded
+        queues, so the model keeps running while previous batches are converted to CSR.
+
+        :param sae: Loaded SAE implementing the three stage methods of BaseSAE
+        :param queue_size: Maximum number of batches waiting between two stages
+        """
+        self.sae = sae
+        self.queue_size = queue_size
+        self.stats = PipelineStats()
+
+    def _tokenize(self, payload):
+        texts, token_ids = payload
+        if token_ids is None:
+            batch = self.sae.prepare_batch(texts)
+        else:
+            batch = self.sae.prepare_batch(texts, token_ids=token_ids)
+        if "token_ids" in batch:
+            # Built on first use; kept in this thread, the only one using the tokenizer
+            batch["vocabulary"] = self.sae.vocabulary()
+            tokens = [(ids, batch["vocabulary"]) for ids in batch["token_ids"]]
+        else:
+            tokens = batch["tokens"]
+        batch["row_tokens"] = tokens
+        return batch, sum(
+            len(part[0]) if isinstance(part, tuple) else len(part) for part in tokens
+        )
+
+    def _forward(self, batch):
+        return batch, self.sae.forward_batch(batch)
+
+    def _postprocess(self, prepared):
+        batch, outputs = prepared
+        results = []
+        activations_list = self.sae.postprocess_batch(batch, outputs)
+        for activations, tokens in zip(activations_list, batch["row_tokens"]):
+            if activations is None:
+                results.append(None)
+                continue
+            aggregates = dict()
+            if isinstance(activations, tuple):
+                activations, aggregates = activations
+            # Compute (sparsely) the aggregates the SAE did not return
+            for name in AGGREGATE_NAMES:
+                aggregates[name] = aggregate_row(activations, aggregates, name)
+            results.append((activations, aggregates, tokens))
+        return results
+
+    def _put(self, destination, item, stop):
+        while not stop.is_set():
+            try:
+                destination.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run_stage(self, stage, function, source, destination, stop):
+        while not stop.is_set():
+            try:
+                item = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE or isinstance(item, _FeedError):
+                self._put(destination, item, stop)
+                return
+            (batch_id, payload, size, error), item = item, None
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    payload = function(payload)
+                    if stage == "tokenize":
+                        payload, tokens = payload
+                        size = (size[0], tokens)
+                except Exception as e:
+                    # The frames of the traceback would keep the batch and its (device) tensors
+                    # alive for as long as the error is
+                    traceback.clear_frames(e.__traceback__)
+                    payload, error = None, e
+                self.stats.record(stage, time.perf_counter() - start, *size)
+            self._put(destination, (batch_id, payload, size, error), stop)
+
+    def _feed(self, batches, destination, stop):
+        try:
+            for batch_id, texts, *token_ids in batches:
+                if stop.is_set():
+                    return
+                payload = (texts, token_ids[0] if token_ids else None)
+                self._put(destination, (batch_id, payload, (len(texts), 0), None), stop)
+        except Exception as e:
+            # Batches already queued are still encoded; `run` raises once it reaches the error
+            self._put(destination, _FeedError(e), stop)
+            return
+        self._put(destination, _DONE, stop)
+
+    def run(self, batches):
+        """
+        Encode `batches`, an iterable of (batch_id, list of texts) or of (batch_id, list of texts,
+        token ids of the texts from `sae.token_ids` or None), and yield (batch_id, results, error)
+        in input order. `results` holds one entry per text: None if the SAE returned no
+        activations, otherwise a tuple of (token activations csr_matrix, aggregate dictionary,
+        tokens), where tokens is a tuple of (token ids, Vocabulary) for SAEs that provide token
+        ids and a list of token strings otherwise.
+
+        An exception raised by a stage for one batch is not raised here: `results` is None and
+        `error` is the exception (with the local variables of its traceback cleared, so it does
+        not keep the batch's tensors alive), and the following batches are still encoded. Callers
+        decide how to report it; `encode_shard`, for instance, only sends it through its
+        `progress` queue. If iterating over `batches` raises, the exception is raised here after
+        the batches taken before it are yielded.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+        stop = threading.Event()
+        functions = {
+            "tokenize": self._tokenize,
+            "forward": self._forward,
+            "postprocess": self._postprocess,
+        }
+        threads = [
+            threading.Thread(
+                target=self._feed, args=(batches, queues[0], stop), daemon=True
+            )
+        ] + [
+            threading.Thread(
+                target=self._run_stage,
+                args=(stage, functions[stage], queues[i], queues[i + 1], stop),
+                daemon=True,
+            )
+            for i, stage in enumerate(PIPELINE_STAGES)
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _FeedError):
+                    raise item.error
+                batch_id, results, _, error = item
+                yield batch_id, results, error
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.stats.wall_seconds += time.perf_counter() - start
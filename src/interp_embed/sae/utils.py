@@ -1,6 +1,8 @@
 import json
 from huggingface_hub import hf_hub_download
+import numpy as np
 import re
+from scipy.sparse import csr_matrix
 import torch
 
 
@@ -164,7 +166,156 @@ def get_goodfire_config(sae_id: str):
     raise ValueError(f"Invalid SAE ID: {sae_id}")
 
 def store_activations_hook(model, input, output, activations, name):
-    # Store the output activation
+    # Store the output activation on its device; the SAE moves it to its own device and pops it
+    # once encoded, so it is not held between batches
     activations[name] = (
-        output[0].detach().cpu() if isinstance(output, tuple) else output.detach().cpu()
+        output[0].detach() if isinstance(output, tuple) else output.detach()
+    )
+
+
+def prune_dense(activations, top_k=None, threshold=None):
+    """
+    Zero out all but the `top_k` largest activations of each row and all activations that are not
+    above `threshold`. Works on tensors of shape (..., d_sae) on any device.
+    """
+    if threshold is not None:
+        activations = activations * (activations > threshold)
+    if top_k is not None and top_k < activations.shape[-1]:
+        values, indices = activations.topk(top_k, dim=-1)
+        activations = torch.zeros_like(activations).scatter_(-1, indices, values)
+    return activations
+
+
+def prune_csr(activations, top_k=None, threshold=None):
+    """
+    `prune_dense` for a (num_tokens, d_sae) csr_matrix, without densifying it.
+    """
+    if top_k is None and threshold is None:
+        return activations
+    data = activations.data
+    rows = np.repeat(np.arange(activations.shape[0]), np.diff(activations.indptr))
+    keep = data > threshold if threshold is not None else np.ones(len(data), dtype=bool)
+    if top_k is not None:
+        # Rank each value within its row by decreasing activation
+        order = np.lexsort((-data, rows))
+        starts = np.repeat(activations.indptr[:-1], np.diff(activations.indptr))
+        rank = np.empty(len(data), dtype=np.int64)
+        rank[order] = np.arange(len(data)) - starts
+        keep &= rank < top_k
+    indptr = np.concatenate(
+        [[0], np.cumsum(np.bincount(rows[keep], minlength=activations.shape[0]))]
+    )
+    pruned = csr_matrix(
+        (data[keep], activations.indices[keep], indptr), shape=activations.shape
+    )
+    pruned.eliminate_zeros()
+    return pruned
+
+
+def _dense_to_device_csr(dense):
+    # nonzero() returns (row, column) pairs in row-major order, i.e. already in CSR order
+    nonzero = dense.nonzero()
+    rows, columns = nonzero[:, 0], nonzero[:, 1]
+    indptr = torch.zeros(dense.shape[0] + 1, dtype=torch.int64, device=dense.device)
+    indptr[1:] = torch.cumsum(torch.bincount(rows, minlength=dense.shape[0]), dim=0)
+    return (
+        dense[rows, columns],
+        columns.to(torch.int32),
+        indptr.to(torch.int32),
+        tuple(dense.shape),
+    )
+
+
+def _device_csr_to_host(parts):
+    values, columns, indptr, shape = parts
+    return csr_matrix(
+        (values.cpu().numpy(), columns.cpu().numpy(), indptr.cpu().numpy()),
+        shape=shape,
+    )
+
+
+def compact_on_device(feature_acts, attention_mask, top_k=None, threshold=None):
+    """
+    Device half of `sparsify_on_device`: remove padding, prune and aggregate the activations and
+    extract their nonzero values, all on the tensor's device. The result holds CSR values, column
+    indices and row pointers, whose size grows with the number of nonzero activations rather than
+    with batch x seq x d_sae, so SAEs call this in `forward_batch` and the dense activations are
+    freed before the batch waits in the encode pipeline's queues.
+
+    :param feature_acts: Tensor of shape (batch, seq, d_sae)
+    :param attention_mask: Boolean array or tensor of shape (batch, seq) marking real tokens
+    :param top_k: If set, only the k largest activations of each token are kept
+    :param threshold: If set, only activations above this value are kept
+    :return: Dictionary of device tensors to pass to `compact_to_host`
+    """
+    feature_acts = feature_acts.detach()
+    device = feature_acts.device
+    mask = torch.as_tensor(attention_mask, dtype=torch.bool, device=device)
+    lengths = mask.sum(dim=1)
+    # (total_tokens, d_sae), sequences one after another
+    tokens = feature_acts[mask]
+    if tokens.dtype == torch.bfloat16:
+        # numpy has no bfloat16, and aggregates are summed in float32
+        tokens = tokens.float()
+    tokens = prune_dense(tokens, top_k, threshold)
+
+    batch_size, d_sae = feature_acts.shape[0], feature_acts.shape[-1]
+    sequence_of_token = torch.repeat_interleave(
+        torch.arange(batch_size, device=device), lengths
+    )
+    index = sequence_of_token[:, None].expand_as(tokens)
+    zeros = lambda dtype: torch.zeros(batch_size, d_sae, dtype=dtype, device=device)
+    aggregates = {
+        "max": zeros(tokens.dtype).scatter_reduce_(
+            0, index, tokens, reduce="amax", include_self=False
+        ),
+        "sum": zeros(tokens.dtype).index_add_(0, sequence_of_token, tokens),
+        "count": zeros(torch.int32).index_add_(
+            0, sequence_of_token, (tokens > 0).to(torch.int32)
+        ),
+    }
+    return {
+        "tokens": _dense_to_device_csr(tokens),
+        "aggregates": {
+            name: _dense_to_device_csr(value) for name, value in aggregates.items()
+        },
+        "lengths": lengths,
+    }
+
+
+def compact_to_host(compact):
+    """
+    Host half of `sparsify_on_device`: copy the output of `compact_on_device` to host memory and
+    split it into one (csr_matrix of shape (num_tokens, d_sae), aggregate dictionary) tuple per
+    sequence.
+    """
+    token_csr = _device_csr_to_host(compact["tokens"])
+    aggregate_csrs = {
+        name: _device_csr_to_host(parts) for name, parts in compact["aggregates"].items()
+    }
+    offsets = np.concatenate([[0], np.cumsum(compact["lengths"].cpu().numpy())])
+    return [
+        (
+            token_csr[offsets[i] : offsets[i + 1]],
+            {name: aggregate[i : i + 1] for name, aggregate in aggregate_csrs.items()},
+        )
+        for i in range(len(offsets) - 1)
+    ]
+
+
+def sparsify_on_device(feature_acts, attention_mask, top_k=None, threshold=None):
+    """
+    Convert padded SAE activations into one CSR matrix per sequence along with its "max", "sum"
+    and "count" (number of tokens with a positive activation) aggregates. Padding removal, nonzero
+    extraction and aggregation run on the tensor's device, so only sparse values and indices are
+    copied to the host.
+
+    :param feature_acts: Tensor of shape (batch, seq, d_sae)
+    :param attention_mask: Boolean array or tensor of shape (batch, seq) marking real tokens
+    :param top_k: If set, only the k largest activations of each token are kept
+    :param threshold: If set, only activations above this value are kept
+    :return: List of (csr_matrix of shape (num_tokens, d_sae), aggregate dictionary) tuples
+    """
+    return compact_to_host(
+        compact_on_device(feature_acts, attention_mask, top_k, threshold)
     )
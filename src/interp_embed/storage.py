@@ -0,0 +1,584 @@
+import json
+import os
+import uuid
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+STORAGE_FORMAT_VERSION = 1
+STORE_HEADER_FILE = "store.json"
+AGGREGATE_NAMES = ("max", "sum")
+
+
+def _csr_paths(directory, name):
+    return {
+        part: os.path.join(directory, f"{name}_{part}.npy")
+        for part in ("data", "indices", "indptr")
+    }
+
+
+def save_csr(directory, name, matrix):
+    """
+    Save a CSR matrix as three .npy files (`{name}_data`, `{name}_indices`, `{name}_indptr`).
+
+    Indices and indptr share one dtype so scipy can wrap the memory-mapped arrays without copying.
+    """
+    index_dtype = (
+        np.int32
+        if max(matrix.nnz, matrix.shape[1]) < np.iinfo(np.int32).max
+        else np.int64
+    )
+    paths = _csr_paths(directory, name)
+    np.save(paths["data"], matrix.data)
+    np.save(paths["indices"], matrix.indices.astype(index_dtype, copy=False))
+    np.save(paths["indptr"], matrix.indptr.astype(index_dtype, copy=False))
+
+
+def load_csr(directory, name, shape, mmap_mode="r"):
+    """
+    Load a CSR matrix saved with `save_csr`. With `mmap_mode="r"`, the returned matrix is a view over
+    memory-mapped files and only the pages that are touched get read from disk.
+    """
+    paths = _csr_paths(directory, name)
+    arrays = {
+        part: np.load(path, mmap_mode=mmap_mode) for part, path in paths.items()
+    }
+    return csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]), shape=shape, copy=False
+    )
+
+
+def stack_csr_rows(matrices, n_cols, dtype=np.float32):
+    """
+    Concatenate CSR matrices with `n_cols` columns along the row axis in one pass over their buffers.
+    """
+    if len(matrices) == 0:
+        return csr_matrix((0, n_cols), dtype=dtype)
+    nnz = np.array([matrix.nnz for matrix in matrices], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(nnz)[:-1]])
+    indptr = np.concatenate(
+        [[0]]
+        + [matrix.indptr[1:] + offset for matrix, offset in zip(matrices, offsets)]
+    )
+    data = np.concatenate([matrix.data for matrix in matrices]).astype(
+        dtype, copy=False
+    )
+    indices = np.concatenate([matrix.indices for matrix in matrices])
+    n_rows = sum(matrix.shape[0] for matrix in matrices)
+    return csr_matrix((data, indices, indptr), shape=(n_rows, n_cols))
+
+
+def aggregate_row(activations, aggregate_activations, name):
+    """
+    Return the (1, d_sae) CSR aggregate `name` ("max" or "sum") of one row, computing it from the
+    token-level activations when it was not precomputed (e.g. for low-memory rows).
+    """
+    if aggregate_activations and name in aggregate_activations:
+        return csr_matrix(aggregate_activations[name])
+    elif name == "max":
+        return csr_matrix(activations.max(axis=0))
+    elif name == "sum":
+        return csr_matrix(activations.sum(axis=0))
+    raise ValueError(f"Unsupported aggregate: {name}")
+
+
+def token_group_matrix(row_offsets):
+    """
+    (num_rows, total_tokens) CSR indicator matrix with a one at [i, t] iff token t belongs to row i.
+    Multiplying it with a token-level matrix sums token rows per document.
+    """
+    row_offsets = np.asarray(row_offsets)
+    total_tokens = int(row_offsets[-1])
+    return csr_matrix(
+        (
+            np.ones(total_tokens, dtype=np.int32),
+            np.arange(total_tokens),
+            row_offsets,
+        ),
+        shape=(len(row_offsets) - 1, total_tokens),
+    )
+
+
+def count_active_tokens(token_activations, row_offsets, activated_threshold=0):
+    """
+    (num_rows, d_sae) CSR matrix counting, per row and feature, the tokens whose activation is above
+    `activated_threshold`. Only the values are thresholded; the index arrays are shared.
+    """
+    active = csr_matrix(
+        (
+            (np.asarray(token_activations.data) > activated_threshold).astype(np.int32),
+            token_activations.indices,
+            token_activations.indptr,
+        ),
+        shape=token_activations.shape,
+    )
+    return token_group_matrix(row_offsets) @ active
+
+
+def reorder_csr_rows(matrices, row_orders):
+    """
+    Stack CSR matrices and place their rows at the positions given by `row_orders` (one array per
+    matrix, together a permutation of the output rows).
+    """
+    stacked = stack_csr_rows(
+        matrices, matrices[0].shape[1], dtype=matrices[0].dtype
+    )
+    return stacked[np.argsort(np.concatenate(row_orders), kind="stable")]
+
+
+def _encode_strings(strings):
+    encoded = [string.encode("utf-8") for string in strings]
+    lengths = np.fromiter((len(string) for string in encoded), dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(string_bytes, offsets):
+    raw = bytes(string_bytes[offsets[0] : offsets[-1]])
+    relative = np.asarray(offsets) - offsets[0]
+    return [
+        raw[relative[i] : relative[i + 1]].decode("utf-8")
+        for i in range(len(relative) - 1)
+    ]
+
+
+class Vocabulary:
+    def __init__(self, strings=None, string_bytes=None, string_offsets=None):
+        """
+        Table mapping token ids to token strings. Documents store token ids, and strings are only
+        produced when they are needed.
+
+        The table is either given as a list of strings or as a UTF-8 byte buffer with per-token
+        offsets (as saved on disk), in which case it is decoded on first use.
+        """
+        self._strings = list(strings) if strings is not None else None
+        self._string_bytes = string_bytes
+        self._string_offsets = string_offsets
+        self._ids = None
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            self._strings = _decode_strings(self._string_bytes, self._string_offsets)
+        return self._strings
+
+    def __len__(self):
+        if self._strings is None:
+            return len(self._string_offsets) - 1
+        return len(self._strings)
+
+    def decode(self, token_ids):
+        strings = self.strings
+        return [strings[token_id] for token_id in np.asarray(token_ids).tolist()]
+
+    def encode(self, tokens):
+        """
+        Token ids of `tokens`, adding strings that are not in the table yet.
+        """
+        if self._ids is None:
+            self._ids = dict()
+            for token_id, string in enumerate(self.strings):
+                self._ids.setdefault(string, token_id)
+        token_ids = np.empty(len(tokens), dtype=np.int32)
+        for i, token in enumerate(tokens):
+            if token not in self._ids:
+                self._ids[token] = len(self.strings)
+                self.strings.append(token)
+            token_ids[i] = self._ids[token]
+        return token_ids
+
+    def copy(self):
+        return Vocabulary(strings=self.strings)
+
+    def same_table(self, other):
+        """
+        True if `other` maps every token id to the same string (e.g. the same tokenizer's table
+        loaded separately), so ids of one are valid ids of the other.
+        """
+        if other is self:
+            return True
+        if len(other) != len(self):
+            return False
+        return all(
+            np.array_equal(a, b) for a, b in zip(self.to_arrays(), other.to_arrays())
+        )
+
+    def to_arrays(self):
+        if self._strings is None:
+            return self._string_bytes, self._string_offsets
+        return _encode_strings(self._strings)
+
+
+def _encode_tokens(token_parts):
+    """
+    Concatenated token ids of all rows and the vocabulary they index. Each part is either a list of
+    token strings or a tuple of (token ids, Vocabulary). Ids from the first vocabulary (or from a
+    vocabulary with the same table) are kept as they are; other tokens are encoded into a copy of
+    it, made only when needed.
+    """
+    base = next(
+        (tokens[1] for tokens in token_parts if isinstance(tokens, tuple)), None
+    )
+    same_table = {id(base): True}
+    vocabulary = base
+    token_ids = []
+    for tokens in token_parts:
+        if isinstance(tokens, tuple) and id(tokens[1]) not in same_table:
+            same_table[id(tokens[1])] = base.same_table(tokens[1])
+        if isinstance(tokens, tuple) and same_table[id(tokens[1])]:
+            token_ids.append(np.asarray(tokens[0], dtype=np.int32))
+            continue
+        if vocabulary is base:
+            vocabulary = base.copy() if base is not None else Vocabulary(strings=[])
+        strings = tokens[1].decode(tokens[0]) if isinstance(tokens, tuple) else tokens
+        token_ids.append(vocabulary.encode(strings))
+    if vocabulary is None:
+        vocabulary = Vocabulary(strings=[])
+    token_ids = (
+        np.concatenate(token_ids) if token_ids else np.array([], dtype=np.int32)
+    )
+    return token_ids, vocabulary
+
+
+class ActivationStore:
+    def __init__(
+        self,
+        token_activations,
+        row_offsets,
+        aggregates,
+        valid,
+        token_ids,
+        vocabulary,
+        truncate_chat_template=None,
+    ):
+        """
+        Columnar representation of the SAE activations of a whole dataset.
+
+        Token-level activations of every row are concatenated into one (total_tokens, d_sae) CSR
+        matrix, and row i owns the token rows `row_offsets[i]:row_offsets[i + 1]`. Each aggregate
+        ("max", "sum") is a (num_rows, d_sae) CSR matrix. Tokens are stored as ids into a shared
+        Vocabulary. Rows without activations have an empty token range and `valid[i] == False`.
+
+        :param token_activations: csr_matrix of shape (total_tokens, d_sae)
+        :param row_offsets: Array of shape (num_rows + 1,) indexing into the token rows
+        :param aggregates: Dictionary mapping aggregate name to a (num_rows, d_sae) csr_matrix
+        :param valid: Boolean array of shape (num_rows,) marking rows with computed activations
+        :param token_ids: int32 array of shape (total_tokens,) with the id of every token
+        :param vocabulary: Vocabulary mapping token ids to strings
+        :param truncate_chat_template: Optional boolean array of shape (num_rows,) with the
+            `truncate_chat_template` setting of each row (all False if None)
+        """
+        self.token_activations = token_activations
+        self.row_offsets = row_offsets
+        self.aggregates = aggregates
+        self.valid = valid
+        self.token_ids = token_ids
+        self.vocabulary = vocabulary
+        self.truncate_chat_template = (
+            np.zeros(len(valid), dtype=bool)
+            if truncate_chat_template is None
+            else np.asarray(truncate_chat_template, dtype=bool)
+        )
+
+    @property
+    def num_rows(self):
+        return len(self.valid)
+
+    @property
+    def d_sae(self):
+        return self.token_activations.shape[1]
+
+    def num_tokens(self):
+        return np.diff(self.row_offsets)
+
+    def row_activations(self, index):
+        start, end = self.row_offsets[index], self.row_offsets[index + 1]
+        return self.token_activations[start:end]
+
+    def row_aggregates(self, index):
+        return {
+            name: aggregate[index : index + 1]
+            for name, aggregate in self.aggregates.items()
+        }
+
+    def row_token_ids(self, index):
+        start, end = self.row_offsets[index], self.row_offsets[index + 1]
+        return self.token_ids[start:end]
+
+    def row_tokens(self, index):
+        return self.vocabulary.decode(self.row_token_ids(index))
+
+    def aggregate(self, name):
+        return self.aggregates[name]
+
+    @classmethod
+    def from_rows(cls, rows, d_sae, dtype=np.float32, truncate_chat_template=None):
+        """
+        Build a store from per-row parts.
+
+        :param rows: List with one entry per row, either None or a tuple of
+            (token activations csr_matrix, aggregate dictionary, tokens), where tokens is a list of
+            strings or a tuple of (token ids, Vocabulary)
+        :param d_sae: Number of SAE features
+        :param dtype: Data type of the stored activation values
+        :param truncate_chat_template: Optional `truncate_chat_template` setting of each row
+        """
+        valid = np.array([row is not None for row in rows], dtype=bool)
+        present = [row for row in rows if row is not None]
+
+        num_tokens = np.zeros(len(rows), dtype=np.int64)
+        num_tokens[valid] = [activations.shape[0] for activations, _, _ in present]
+        row_offsets = np.concatenate([[0], np.cumsum(num_tokens)]).astype(np.int64)
+
+        token_activations = stack_csr_rows(
+            [activations for activations, _, _ in present], d_sae, dtype=dtype
+        )
+
+        aggregates = {}
+        for name in AGGREGATE_NAMES:
+            row_aggregates = [
+                aggregate_row(activations, aggregate_activations, name)
+                for activations, aggregate_activations, _ in present
+            ]
+            stacked = stack_csr_rows(row_aggregates, d_sae, dtype=dtype)
+            # Place the aggregates of valid rows; rows without activations stay empty
+            indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            indptr[1:][valid] = np.diff(stacked.indptr)
+            aggregates[name] = csr_matrix(
+                (stacked.data, stacked.indices, np.cumsum(indptr)),
+                shape=(len(rows), d_sae),
+            )
+
+        token_ids, vocabulary = _encode_tokens([tokens for _, _, tokens in present])
+        return cls(
+            token_activations=token_activations,
+            row_offsets=row_offsets,
+            aggregates=aggregates,
+            valid=valid,
+            token_ids=token_ids,
+            vocabulary=vocabulary,
+            truncate_chat_template=truncate_chat_template,
+        )
+
+    def save(self, directory):
+        """
+        Write the store into `directory` (which must already exist) as .npy files.
+        """
+        save_csr(directory, "activations", self.token_activations)
+        for name, aggregate in self.aggregates.items():
+            save_csr(directory, name, aggregate)
+        np.save(os.path.join(directory, "row_offsets.npy"), self.row_offsets)
+        np.save(os.path.join(directory, "valid.npy"), self.valid)
+        np.save(
+            os.path.join(directory, "truncate_chat_template.npy"),
+            self.truncate_chat_template,
+        )
+        np.save(os.path.join(directory, "token_ids.npy"), self.token_ids)
+        vocab_bytes, vocab_offsets = self.vocabulary.to_arrays()
+        np.save(os.path.join(directory, "vocab_bytes.npy"), vocab_bytes)
+        np.save(os.path.join(directory, "vocab_offsets.npy"), vocab_offsets)
+        with open(os.path.join(directory, STORE_HEADER_FILE), "w") as f:
+            json.dump(
+                {
+                    "format_version": STORAGE_FORMAT_VERSION,
+                    "d_sae": int(self.d_sae),
+                    "aggregates": list(self.aggregates.keys()),
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Open a store written with `save`. Arrays are memory-mapped unless `mmap_mode` is None.
+        """
+        with open(os.path.join(directory, STORE_HEADER_FILE), "r") as f:
+            header = json.load(f)
+        if header["format_version"] > STORAGE_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported activation store version {header['format_version']} in {directory}"
+            )
+
+        load = lambda name: np.load(
+            os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode
+        )
+        row_offsets = load("row_offsets")
+        valid = load("valid")
+        d_sae = header["d_sae"]
+        token_ids = load("token_ids")
+        vocabulary = Vocabulary(
+            string_bytes=load("vocab_bytes"), string_offsets=load("vocab_offsets")
+        )
+        truncate_chat_template = (
+            load("truncate_chat_template")
+            if os.path.exists(os.path.join(directory, "truncate_chat_template.npy"))
+            else None
+        )
+        return cls(
+            token_activations=load_csr(
+                directory, "activations", (int(row_offsets[-1]), d_sae), mmap_mode
+            ),
+            row_offsets=row_offsets,
+            aggregates={
+                name: load_csr(directory, name, (len(valid), d_sae), mmap_mode)
+                for name in header["aggregates"]
+            },
+            valid=valid,
+            token_ids=token_ids,
+            vocabulary=vocabulary,
+            truncate_chat_template=truncate_chat_template,
+        )
+
+
+CHECKPOINT_LOG_DIR = "checkpoint_log"
+
+
+def _atomic_savez(path, arrays):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointLog:
+    def __init__(self, directory):
+        """
+        Append-only log of rows computed since a dataset directory was last saved. Each segment is
+        one .npz file holding the dataset indices of its rows and their columnar activations, so
+        appending costs time proportional to the new rows only. A vocabulary table shared by the
+        rows (e.g. the SAE tokenizer's) is written once per process and referenced by name; a
+        vocabulary built from the segment's own token strings is stored inline.
+
+        Worker processes that encode shards of a dataset each write to their own sub-log (see
+        `shard`), which is replayed along with the segments of this log.
+
+        :param directory: Directory of the log (created on the first append)
+        """
+        self.directory = directory
+        self._saved_vocabularies = dict()  # id(vocabulary) -> (vocabulary, file name)
+        self._next_segment = len(self._segment_paths())
+
+    def _segment_paths(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith("segment_") and name.endswith(".npz")
+        )
+
+    def _shard_directories(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith("shard_")
+            and os.path.isdir(os.path.join(self.directory, name))
+        )
+
+    def shard(self, shard_id):
+        """
+        Sub-log written by the worker encoding shard `shard_id`.
+        """
+        return CheckpointLog(os.path.join(self.directory, f"shard_{shard_id:03d}"))
+
+    def _save_vocabulary(self, vocabulary):
+        if id(vocabulary) not in self._saved_vocabularies:
+            name = f"vocabulary_{uuid.uuid4().hex[:8]}.npz"
+            vocab_bytes, vocab_offsets = vocabulary.to_arrays()
+            _atomic_savez(
+                os.path.join(self.directory, name),
+                {"vocab_bytes": vocab_bytes, "vocab_offsets": vocab_offsets},
+            )
+            self._saved_vocabularies[id(vocabulary)] = (vocabulary, name)
+        return self._saved_vocabularies[id(vocabulary)][1]
+
+    def append(self, indices, row_parts, d_sae, dtype=np.float32):
+        """
+        Write one segment with the rows at dataset `indices`.
+
+        :param row_parts: One (activations, aggregates, tokens) tuple per row, as taken by
+            `ActivationStore.from_rows`
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        store = ActivationStore.from_rows(row_parts, d_sae, dtype=dtype)
+        arrays = {
+            "rows": np.asarray(indices, dtype=np.int64),
+            "d_sae": np.array(d_sae),
+            "row_offsets": store.row_offsets,
+            "token_ids": store.token_ids,
+        }
+        shared = any(
+            isinstance(tokens, tuple) and tokens[1] is store.vocabulary
+            for _, _, tokens in row_parts
+        )
+        if shared:
+            arrays["vocabulary"] = np.array(self._save_vocabulary(store.vocabulary))
+        else:
+            arrays["vocab_bytes"], arrays["vocab_offsets"] = store.vocabulary.to_arrays()
+        matrices = dict(store.aggregates, activations=store.token_activations)
+        for name, matrix in matrices.items():
+            arrays[f"{name}_data"] = matrix.data
+            arrays[f"{name}_indices"] = matrix.indices
+            arrays[f"{name}_indptr"] = matrix.indptr
+        path = os.path.join(self.directory, f"segment_{self._next_segment:08d}.npz")
+        _atomic_savez(path, arrays)
+        self._next_segment += 1
+
+    def segments(self, _vocabularies=None):
+        """
+        Yield (dataset indices, ActivationStore) for every segment, in the order they were written,
+        followed by the segments of each shard sub-log. Identical vocabulary tables written by
+        different processes are loaded as one Vocabulary, so their token ids stay compatible.
+        """
+        vocabularies = dict() if _vocabularies is None else _vocabularies
+        for path in self._segment_paths():
+            with np.load(path) as segment:
+                arrays = {name: segment[name] for name in segment.files}
+            if "vocabulary" in arrays:
+                vocabulary_name = str(arrays["vocabulary"])
+                if vocabulary_name not in vocabularies:
+                    path = os.path.join(self.directory, vocabulary_name)
+                    with np.load(path) as vocabulary:
+                        loaded = Vocabulary(
+                            string_bytes=vocabulary["vocab_bytes"],
+                            string_offsets=vocabulary["vocab_offsets"],
+                        )
+                    vocabularies[vocabulary_name] = next(
+                        (
+                            other
+                            for other in vocabularies.values()
+                            if other.same_table(loaded)
+                        ),
+                        loaded,
+                    )
+                vocabulary = vocabularies[vocabulary_name]
+            else:
+                vocabulary = Vocabulary(
+                    string_bytes=arrays["vocab_bytes"],
+                    string_offsets=arrays["vocab_offsets"],
+                )
+
+            num_rows, num_tokens = len(arrays["rows"]), int(arrays["row_offsets"][-1])
+            d_sae = int(arrays["d_sae"])
+            matrix = lambda matrix_name, n_rows: csr_matrix(
+                (
+                    arrays[f"{matrix_name}_data"],
+                    arrays[f"{matrix_name}_indices"],
+                    arrays[f"{matrix_name}_indptr"],
+                ),
+                shape=(n_rows, d_sae),
+            )
+            yield arrays["rows"], ActivationStore(
+                token_activations=matrix("activations", num_tokens),
+                row_offsets=arrays["row_offsets"],
+                aggregates={name: matrix(name, num_rows) for name in AGGREGATE_NAMES},
+                valid=np.ones(num_rows, dtype=bool),
+                token_ids=arrays["token_ids"],
+                vocabulary=vocabulary,
+            )
+        for directory in self._shard_directories():
+            yield from CheckpointLog(directory).segments(vocabularies)
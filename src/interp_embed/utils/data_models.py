@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseModel, Field
 
 
@@ -9,6 +11,16 @@ class SingleSampleScoringResponse(BaseModel):
     explanation: str = Field(..., description="Explanation for the score.")
 
 
+class BatchSampleScoringResponse(SingleSampleScoringResponse):
+    id: int = Field(..., description="Id of the scored sample in the batch.")
+
+
+class BatchScoringResponse(BaseModel):
+    scores: List[BatchSampleScoringResponse] = Field(
+        ..., description="One score per sample of the batch."
+    )
+
+
 class FeatureLabelResponse(BaseModel):
     label: str = Field(
         ...,
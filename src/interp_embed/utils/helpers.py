@@ -1,8 +1,11 @@
 from tqdm.auto import tqdm
 import time
-import os, pickle, tempfile
+import os, pickle, shutil, tempfile
 import asyncio
 import concurrent.futures
+import math
+from statistics import NormalDist
+from contextlib import contextmanager
 
 CHAT_TEMPLATE_END_POSITION_TOKENS = 30
 CHAT_TEMPLATE_END_POSITION_ACTIVATIONS = 29
@@ -109,6 +112,34 @@ def safe_save_pkl(data, path):
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
+@contextmanager
+def safe_save_dir(path):
+    """
+    Yields a temporary directory next to `path` to write into. On success, the directory atomically
+    replaces whatever file or directory was at `path`.
+    """
+    path = os.path.normpath(path)
+    dir_ = os.path.dirname(path) or "."
+    if not os.path.exists(dir_):
+        print(f"Creating directory since it doesn't exist: {dir_}")
+        os.makedirs(dir_, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=dir_)
+    old_dir = None
+    try:
+        yield tmp_path
+        if os.path.lexists(path):
+            # move the replaced data into a fresh directory, so its new name cannot be taken
+            old_dir = tempfile.mkdtemp(dir=dir_)
+            os.replace(path, os.path.join(old_dir, os.path.basename(path)))
+        os.replace(tmp_path, path)
+    finally:
+        # cleanup the replaced data, or the partial write if something went wrong
+        for leftover in (tmp_path, old_dir):
+            if leftover and os.path.isdir(leftover):
+                shutil.rmtree(leftover, ignore_errors=True)
+            elif leftover and os.path.lexists(leftover):
+                os.remove(leftover)
+
 def safe_load_pkl(path):
     with open(path, "rb") as f:
         return pickle.load(f)
@@ -144,5 +175,21 @@ def run_async_in_any_context(coro):
 
 
 def compute_token_count(rows):
-    token_lengths = [len(row.tokenized_document) for row in rows if row is not None]
-    return sum(token_lengths) if token_lengths else 0
\ No newline at end of file
+    token_lengths = [row.n_tokens for row in rows if row is not None]
+    return sum(token_lengths) if token_lengths else 0
+
+
+def wilson_interval(successes, total, confidence=0.95):
+    """
+    Wilson score interval of a binomial proportion, as (low, high). Unlike the normal
+    approximation it stays within [0, 1] and is usable for a handful of trials; (0, 1) when
+    `total` is 0.
+    """
+    if total == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    proportion = successes / total
+    denominator = 1 + z**2 / total
+    center = (proportion + z**2 / (2 * total)) / denominator
+    margin = z * math.sqrt(proportion * (1 - proportion) / total + z**2 / (4 * total**2)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
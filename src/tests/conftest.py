@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse import random as sparse_random
+
+from interp_embed import Dataset
+from interp_embed.dataset_analysis import DatasetRow
+from interp_embed.sae.base_sae import BaseSAE
+from interp_embed.sae.local_sae import LocalSAE
+
+
+class WordSAE(BaseSAE):
+    """
+    Deterministic stand-in for a real SAE: every whitespace-separated word is a token that
+    activates feature `sum(ord(c)) % d_sae` with its length. Texts containing "FAIL" raise.
+    """
+
+    def __init__(self, d_sae=32, **kwargs):
+        super().__init__(**kwargs)
+        self.d_sae = d_sae
+
+    def load_models(self):
+        pass
+
+    def destroy_models(self):
+        pass
+
+    def split(self, text):
+        return text.split()
+
+    def token_ids(self, texts):
+        return [self.split(text) for text in texts]
+
+    def prepare_batch(self, texts, token_ids=None):
+        if token_ids is None:
+            token_ids = self.token_ids(texts)
+        return {"texts": texts, "tokens": token_ids}
+
+    def encode(self, texts):
+        if any("FAIL" in text for text in texts):
+            raise ValueError("cannot encode")
+        encoded = []
+        for text in texts:
+            words = self.split(text)
+            activations = np.zeros((len(words), self.d_sae), dtype=np.float32)
+            for position, word in enumerate(words):
+                activations[position, sum(map(ord, word)) % self.d_sae] = len(word)
+            encoded.append(csr_matrix(activations))
+        return encoded
+
+
+class CharTokenizer:
+    """
+    Minimal tokenizer with one token per ASCII character.
+    """
+
+    def __len__(self):
+        return 128
+
+    def batch_decode(self, sequences):
+        return ["".join(map(chr, sequence)) for sequence in sequences]
+
+
+class CharSAE(WordSAE):
+    """
+    WordSAE variant that provides token ids: every character is a token.
+    """
+
+    def load_models(self):
+        self.tokenizer = CharTokenizer()
+
+    def token_ids(self, texts):
+        return [np.array([ord(c) for c in text], dtype=np.int32) for text in texts]
+
+    def prepare_batch(self, texts, token_ids=None):
+        if token_ids is None:
+            token_ids = self.token_ids(texts)
+        return {"texts": texts, "token_ids": token_ids}
+
+    def split(self, text):
+        return list(text)
+
+
+@pytest.fixture
+def make_dataset():
+    """
+    Factory for small in-memory datasets with random sparse activations. Every fifth row (starting
+    at index 2) has no activations.
+    """
+
+    def build(num_rows=20, d_sae=32):
+        data = [{"text": f"document {i}"} for i in range(num_rows)]
+        rows = []
+        for i in range(num_rows):
+            if i % 5 == 2:
+                rows.append(None)
+                continue
+            n_tokens = i % 4 + 1
+            activations = sparse_random(
+                n_tokens, d_sae, density=0.2, format="csr", random_state=i, dtype=np.float32
+            )
+            tokens = [f"tok{j}" for j in range(n_tokens)]
+            rows.append(
+                DatasetRow(row=data[i], tokenized_document=tokens, activations=activations)
+            )
+        return Dataset(data, LocalSAE(), rows=rows, compute_activations=False)
+
+    return build
+
+
+@pytest.fixture
+def word_sae():
+    return WordSAE()
+
+
+@pytest.fixture
+def char_sae():
+    return CharSAE()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from sklearn.cluster import SpectralClustering
+
+from interp_embed import Dataset
+from interp_embed.dataset_analysis import DatasetRow
+from interp_embed.paper.clustering import algorithms
+from interp_embed.sae.local_sae import LocalSAE
+
+
+def dataset_from_latents(latents):
+    """
+    Dataset whose documents have one token each, activating the features of a row of `latents`.
+    """
+    data = [{"text": f"document {i}"} for i in range(latents.shape[0])]
+    rows = [
+        DatasetRow(row=row, tokenized_document=["tok"], activations=latents[i])
+        for i, row in enumerate(data)
+    ]
+    return Dataset(data, LocalSAE(), rows=rows, compute_activations=False)
+
+
+def grouped_latents(n_groups=3, group_size=30, features_per_group=10, n_noise=10, seed=0):
+    """
+    Documents of each group activate 5 of the group's own features, plus one noise feature
+    shared by all groups.
+    """
+    rng = np.random.default_rng(seed)
+    n_features = n_groups * features_per_group + n_noise
+    dense = np.zeros((n_groups * group_size, n_features), dtype=np.float32)
+    groups = []
+    for g in range(n_groups):
+        members = np.arange(g * group_size, (g + 1) * group_size)
+        for document in members:
+            own = g * features_per_group + rng.choice(features_per_group, 5, replace=False)
+            dense[document, own] = rng.uniform(0.5, 2.0, size=5)
+            dense[document, n_groups * features_per_group + rng.integers(n_noise)] = 1.0
+        groups.append(frozenset(members.tolist()))
+    return csr_matrix(dense), set(groups)
+
+
+def clusters_of(results):
+    return {
+        frozenset(int(i) for i in cluster["top_examples"] + cluster["rest_examples"])
+        for cluster in results.values()
+    }
+
+
+@pytest.mark.parametrize("method", ["kmeans", "kmodes"])
+def test_streaming_clustering_recovers_groups_without_dense_documents(monkeypatch, method):
+    latents, groups = grouped_latents()
+    dataset = dataset_from_latents(latents)
+    n_features = latents.shape[1]
+
+    # Dense copies of documents (more rows than centroids) would defeat the streaming
+    dense_shapes = []
+    toarray = csr_matrix.toarray
+
+    def recording_toarray(self, *args, **kwargs):
+        dense_shapes.append(self.shape)
+        return toarray(self, *args, **kwargs)
+
+    monkeypatch.setattr(csr_matrix, "toarray", recording_toarray)
+    results = algorithms.compute_clusters_streaming(
+        dataset, 3, method=method, block_size=16, top_n=3
+    )
+    monkeypatch.undo()
+    assert clusters_of(results) == groups
+    assert all(rows <= 3 for rows, columns in dense_shapes if columns == n_features)
+
+    # Filtering out the noise features keeps the clusters and reports original feature ids
+    active_features = list(range(30))
+    filtered = algorithms.compute_clusters_streaming(
+        dataset, 3, active_features=active_features, method=method, block_size=16, top_n=3
+    )
+    assert clusters_of(filtered) == groups
+    for cluster in filtered.values():
+        members = cluster["top_examples"] + cluster["rest_examples"]
+        group = members[0] // 30
+        positive = [feature for feature, _, _ in cluster["distinctive_features"]["positive"]]
+        assert all(feature // 10 == group for feature in positive)
+
+
+def dense_baseline_clusters(latents, n_clusters):
+    """
+    Labels and in-cluster scores of compute_clusters' original dense implementation.
+    """
+    binary = csr_matrix(latents > 0, dtype=np.int32)
+    inter = binary @ binary.T
+    row_sz = inter.diagonal()
+    aff = np.array(np.nan_to_num(inter.toarray() / (row_sz[:, None] + row_sz - inter)))
+    labels = SpectralClustering(
+        n_clusters=n_clusters, affinity="precomputed", random_state=42
+    ).fit_predict(aff)
+    np.fill_diagonal(aff, 0)
+    probs = np.zeros(len(aff))
+    for c in np.unique(labels):
+        idx = np.where(labels == c)[0]
+        if idx.size > 1:
+            probs[idx] = aff[np.ix_(idx, idx)].sum(1) / (idx.size - 1)
+    return labels, probs
+
+
+def scores_of(results, n_documents):
+    probs = np.zeros(n_documents)
+    for cluster in results.values():
+        probs[cluster["top_examples"] + cluster["rest_examples"]] = (
+            cluster["top_scores"] + cluster["rest_scores"]
+        )
+    return probs
+
+
+def test_dense_clustering_matches_baseline():
+    latents, _ = grouped_latents(n_groups=4, group_size=12, features_per_group=6, n_noise=4)
+    latents = latents.toarray()
+    latents[[5, 30]] = 0  # Documents without features
+    latents = csr_matrix(latents)
+    labels, probs = dense_baseline_clusters(latents, 4)
+
+    results = algorithms.compute_clusters(dataset_from_latents(latents), 4, top_n=3)
+    assert clusters_of(results) == {
+        frozenset(np.flatnonzero(labels == c).tolist()) for c in np.unique(labels)
+    }
+    np.testing.assert_allclose(scores_of(results, latents.shape[0]), probs)
+
+    # With every other document as a neighbour, the sparse graph holds the dense affinities
+    binary = csr_matrix(latents > 0, dtype=np.int32)
+    knn = algorithms.knn_jaccard_graph(binary, latents.shape[0] - 1, block_size=7)
+    np.testing.assert_allclose(algorithms.in_cluster_affinity(knn, labels), probs)
+
+
+def test_distinctive_features_match_per_cluster_loop():
+    rng = np.random.default_rng(1)
+    # Few features and many documents, so differences are often tied
+    latents = csr_matrix(rng.random((80, 12)) * (rng.random((80, 12)) < 0.3))
+    labels = rng.integers(4, size=80)
+    labels[:3] = -1
+    active_features = np.arange(12) * 3
+    feature_labels = {int(feature): f"label {feature}" for feature in active_features[::2]}
+
+    sums, sizes = algorithms._cluster_sums(
+        algorithms._contrast_values(latents), labels, 4
+    )
+    clusters, diffs = algorithms._feature_contrasts(sums, sizes)
+    distinctive = algorithms._distinctive_features(
+        clusters, diffs, feature_labels, active_features, top_n=5
+    )
+
+    binary = latents.toarray() > 0
+    valid = labels != -1
+    for c in sorted(set(labels[valid])):
+        in_c = labels == c
+        expected_diffs = binary[in_c].mean(0) - binary[valid & ~in_c].mean(0)
+        order = np.argsort(expected_diffs)
+        for side, indices in [("positive", order[-5:][::-1]), ("negative", order[:5])]:
+            assert distinctive[c][side] == [
+                (
+                    int(active_features[i]),
+                    feature_labels.get(int(active_features[i]), f"feature_{active_features[i]}"),
+                    float(expected_diffs[i]),
+                )
+                for i in indices
+            ]
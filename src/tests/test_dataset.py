@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+from interp_embed import Dataset
+from interp_embed import dataset_analysis
+
+
+def per_row_latents(dataset, aggregation_method):
+    d_sae = dataset.d_sae()
+    return vstack(
+        [
+            row.latents(aggregation_method, compress=True)
+            if row is not None
+            else csr_matrix(np.full(d_sae, np.nan))
+            for row in dataset.rows
+        ]
+    ).toarray()
+
+
+def test_latents_match_per_row_aggregates(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+    loaded.rows[7] = dataset.rows[0]
+
+    for candidate in [dataset, loaded, loaded.filter_na_rows()[2:9]]:
+        for method in ["max", "sum", "mean", "binarize", "count"]:
+            np.testing.assert_allclose(
+                candidate.latents(method),
+                per_row_latents(candidate, method),
+                rtol=1e-6,
+                equal_nan=True,
+            )
+
+
+def test_latents_are_cached_until_rows_change(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+
+    for candidate in [dataset, loaded]:
+        latents = candidate.latents("max", compress=True)
+        assert candidate.latents("max", compress=True) is latents
+        index = candidate.feature_index("max")
+
+        candidate.rows[2] = candidate.rows[0]
+        assert not np.isnan(candidate.latents("max")[2]).any()
+        assert candidate.feature_index("max") is not index
+
+    # As with list slices, assignments into a subset do not reach the full dataset
+    latents = loaded.latents("max", compress=True)
+    loaded.rows[3:6][1] = None
+    assert loaded.latents("max", compress=True) is latents
+
+
+def test_feature_index_matches_dense_selection(make_dataset):
+    dataset = make_dataset(num_rows=60)
+    latents = dataset.latents("max")
+    index = dataset.feature_index("max")
+
+    for feature in range(latents.shape[1]):
+        column = latents[:, feature]
+        active = np.where(column > 0)[0]
+        inactive = np.where(column == 0)[0]
+
+        top = index.select(feature, 5, select_top=True)
+        expected_top = np.sort(column[active])[::-1][:5]
+        np.testing.assert_array_equal(column[top], expected_top)
+
+        bottom = index.select(
+            feature,
+            5,
+            select_top=False,
+            include_active_samples=False,
+            include_nonactive_samples=True,
+        )
+        np.testing.assert_array_equal(bottom, inactive[:5])
+
+
+def test_top_documents_for_features_matches_single_feature(make_dataset):
+    dataset = make_dataset(num_rows=60)
+    features = list(range(dataset.d_sae()))
+
+    for options in [
+        dict(select_top=True),
+        dict(select_top=True, include_nonactive_samples=True),
+        dict(select_top=False, include_nonactive_samples=True),
+        dict(select_top=False, include_active_samples=False, include_nonactive_samples=True),
+    ]:
+        batched = dataset.top_documents_for_features(features, k=7, **options)
+        for feature in features:
+            assert batched[feature] == dataset.top_documents_for_feature(
+                feature, k=7, **options
+            )
+
+
+def test_near_duplicates_and_similar_documents(word_sae):
+    data = [{"text": f"unique{i} words of document {i * 7}"} for i in range(20)]
+    data += [{"text": data[i]["text"] + " extra"} for i in range(0, 20, 5)]
+    dataset = Dataset(data, word_sae, batch_size=8)
+
+    binary = dataset.latents("binarize") > 0
+    jaccard = lambda i, j: (binary[i] & binary[j]).sum() / (binary[i] | binary[j]).sum()
+    expected = {
+        (i, j)
+        for i in range(len(data))
+        for j in range(i + 1, len(data))
+        if jaccard(i, j) >= 0.7
+    }
+
+    duplicates = dataset.near_duplicates(threshold=0.7)
+    assert {(i, j) for i, j, _ in duplicates} == expected
+    for i, j, similarity in duplicates:
+        assert similarity == jaccard(i, j)
+
+    document, similarity = dataset.similar_documents(20, k=1)[0]
+    assert document == 0 and similarity == jaccard(0, 20)
+
+
+def test_label_features_checkpoints_and_resumes(tmp_path, monkeypatch, make_dataset):
+    dataset = make_dataset()
+    calls = {"label": 0, "score": 0, "failures": 3}
+
+    async def fake_llm(client, model, messages, use_cache=True, **kwargs):
+        if "interpreting features" in messages[-1]["content"]:
+            calls["label"] += 1
+            if calls["failures"] > 0:
+                calls["failures"] -= 1
+                raise RuntimeError("rate limited")
+            content = {
+                "label": f"label {calls['label']}",
+                "brief_description": "brief",
+                "detailed_explanation": None,
+            }
+        else:
+            calls["score"] += 1
+            content = {"explanation": "matches", "score": 1}
+        message = SimpleNamespace(content=json.dumps(content))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(dataset_analysis, "call_async_llm", fake_llm)
+    monkeypatch.setattr(dataset_analysis, "get_llm_client", lambda **kwargs: None)
+    active = np.flatnonzero(np.diff(dataset.feature_index().indptr))
+    checkpoint_path = str(tmp_path / "labels.jsonl")
+
+    first = asyncio.run(
+        dataset.label_features(max_concurrency=4, checkpoint_path=checkpoint_path, score_k=2)
+    )
+    assert len(first) == len(active) - 3 and (first["score"] == 1.0).all()
+    with open(checkpoint_path) as f:
+        assert len(f.readlines()) == len(active) - 3
+
+    # A later run only labels the features that failed
+    calls["label"] = 0
+    resumed = make_dataset()
+    second = asyncio.run(
+        resumed.label_features(max_concurrency=4, checkpoint_path=checkpoint_path, score_k=2)
+    )
+    assert calls["label"] == 3
+    assert second["feature"].tolist() == active.tolist()
+    assert resumed.feature_labels() == dict(zip(second["feature"], second["label"]))
+
+
+def test_score_feature_sends_both_sides_at_once_and_streams(monkeypatch, make_dataset):
+    dataset = make_dataset()
+    calls = {"in_flight": 0, "max_in_flight": 0, "finished": 0}
+
+    async def fake_llm(client, model, messages, use_cache=True, **kwargs):
+        calls["in_flight"] += 1
+        calls["max_in_flight"] = max(calls["max_in_flight"], calls["in_flight"])
+        await asyncio.sleep(0.01 * calls["in_flight"])
+        calls["in_flight"] -= 1
+        calls["finished"] += 1
+        message = SimpleNamespace(content=json.dumps({"explanation": "matches", "score": 1}))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(dataset_analysis, "call_async_llm", fake_llm)
+    monkeypatch.setattr(dataset_analysis, "get_llm_client", lambda **kwargs: None)
+    feature = int(np.argmax(np.diff(dataset.feature_index().indptr)))
+
+    result = asyncio.run(dataset.score_feature(feature, "label", k=3))
+    assert result["score"] == 1.0 and result["total_count"] == 6
+    assert calls["max_in_flight"] == 6
+
+    async def stream(**kwargs):
+        return [
+            item
+            async for item in dataset.score_feature_stream(feature, "label", k=3, **kwargs)
+        ]
+
+    items = asyncio.run(stream())
+    assert [item["total_count"] for item in items] == list(range(1, 7))
+    assert {(item["sample_type"], item["index"]) for item in items} == {
+        (sample_type, index) for sample_type in ["positive", "negative"] for index in range(3)
+    }
+    assert not any(item["stopped_early"] for item in items)
+
+    # Four agreeing scores put the 95% interval above 0.5; the other requests are cancelled
+    calls["finished"] = 0
+    items = asyncio.run(stream(threshold=0.5))
+    assert len(items) == 4 and items[-1]["stopped_early"] and items[-1]["ci_low"] > 0.5
+    assert calls["finished"] == 4
+
+
+def test_score_feature_batches_samples_per_request(monkeypatch, make_dataset):
+    dataset = make_dataset()
+    prompts = []
+
+    async def fake_llm(client, model, messages, use_cache=True, **kwargs):
+        prompt = messages[-1]["content"]
+        prompts.append(prompt)
+        n_samples = len(re.findall(r"^SAMPLE \d+ \((?:POSITIVE|NEGATIVE)\):$", prompt, re.M))
+        if n_samples == 0:
+            content = {"explanation": "matches", "score": 1}
+        else:
+            # The last sample of a batch is left out of the response
+            content = {
+                "scores": [
+                    {"id": i, "explanation": "matches", "score": 1} for i in range(n_samples - 1)
+                ]
+            }
+        message = SimpleNamespace(content=json.dumps(content))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(dataset_analysis, "call_async_llm", fake_llm)
+    monkeypatch.setattr(dataset_analysis, "get_llm_client", lambda **kwargs: None)
+    feature = int(np.argmax(np.diff(dataset.feature_index().indptr)))
+
+    single = asyncio.run(dataset.score_feature(feature, "label", k=3))
+    assert len(prompts) == 6
+    prompts.clear()
+    batched = asyncio.run(dataset.score_feature(feature, "label", k=3, batch_size=4))
+
+    assert len(prompts) == 2 and "SAMPLE 3 (NEGATIVE)" in prompts[0]
+    assert len(batched["responses"]) == len(single["responses"]) == 6
+    # Batches of (+0, -0, +1, -1) and (+2, -2): the scores of -1 and -2 are missing
+    missing = [isinstance(response, KeyError) for response in batched["responses"]]
+    assert missing == [False, False, False, False, True, True]
+    assert all(
+        type(response) is type(single["responses"][0])
+        for response in batched["responses"]
+        if not isinstance(response, KeyError)
+    )
+    assert batched["total_count"] == 4 and batched["score"] == 1.0
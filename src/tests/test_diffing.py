@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.stats import chi2_contingency, false_discovery_control, fisher_exact
+
+from interp_embed.paper.diffing import sae_utils
+
+
+def dense_diff_features_multi(target_activations, other_activations, min_coverage=0.0, max_coverage=1.0):
+    """
+    diff_features_multi before the sparse rewrite, over dense arrays with the other datasets
+    stacked as one [n_datasets, N, d_sae] array.
+    """
+    target_nonzero_F = np.count_nonzero(target_activations, axis=0) / target_activations.shape[0]
+    other_activations_max_DF = other_activations.max(axis=0)
+    other_activations_all_DF = np.all(other_activations, axis=0)
+    other_max_nonzero_F = np.count_nonzero(other_activations_max_DF, axis=0) / other_activations_max_DF.shape[0]
+    other_all_nonzero_F = np.count_nonzero(other_activations_all_DF, axis=0) / other_activations_all_DF.shape[0]
+    feature_mask = (np.minimum(target_nonzero_F, other_max_nonzero_F) < min_coverage) | \
+                   (np.maximum(target_nonzero_F, other_max_nonzero_F) > max_coverage)
+    target_nonzero_F[feature_mask] = -1
+    other_max_nonzero_F[feature_mask] = -1
+    return pd.DataFrame({
+        "feature_id": list(range(target_activations.shape[1])),
+        "target_diff_others": target_nonzero_F - other_max_nonzero_F,
+        "others_diff_target": other_all_nonzero_F - target_nonzero_F,
+        "target_dataset_coverage": target_nonzero_F,
+        "other_datasets_max_coverage": other_max_nonzero_F,
+        "other_datasets_all_coverage": other_all_nonzero_F,
+    })
+
+
+def random_activations(rng, n_rows=40, n_features=16, density=0.3, nan_rows=()):
+    """
+    Dense activations with some negative entries and rows of NaN, as Dataset.latents returns for
+    documents without activations.
+    """
+    values = rng.integers(-1, 4, size=(n_rows, n_features)).astype(np.float32)
+    values[rng.random((n_rows, n_features)) > density] = 0
+    values[list(nan_rows)] = np.nan
+    return values
+
+
+@pytest.mark.parametrize("min_coverage, max_coverage", [(0.0, 1.0), (0.2, 0.7)])
+def test_diff_features_multi_matches_dense_reference(min_coverage, max_coverage):
+    rng = np.random.default_rng(0)
+    target = random_activations(rng, nan_rows=[3, 17])
+    others = [random_activations(rng, density=0.2 + 0.2 * i, nan_rows=[5 * i + 1]) for i in range(3)]
+    others[1][3] = np.nan  # A NaN row shared with the target
+
+    expected = dense_diff_features_multi(target, np.stack(others), min_coverage, max_coverage)
+    for convert in [np.asarray, csr_matrix]:
+        diffs = sae_utils.diff_features_multi(
+            convert(target), [convert(other) for other in others],
+            min_coverage=min_coverage, max_coverage=max_coverage,
+        )
+        pd.testing.assert_frame_equal(diffs, expected, check_exact=True)
+
+
+def test_proportion_tests_match_scipy():
+    k1 = np.array([0, 3, 10, 25, 40, 12])
+    k2 = np.array([0, 5, 2, 20, 60, 12])
+    n1, n2 = 40, 60
+    z, z_p, fisher_p = sae_utils._proportion_tests(k1, n1, k2, n2)
+
+    for i in range(len(k1)):
+        table = [[k1[i], n1 - k1[i]], [k2[i], n2 - k2[i]]]
+        assert fisher_p[i] == pytest.approx(fisher_exact(table, alternative="greater").pvalue)
+        if 0 < k1[i] + k2[i] < n1 + n2:
+            # The pooled z statistic squared is the uncorrected chi-square statistic
+            chi2, chi2_p, _, _ = chi2_contingency(table, correction=False)
+            assert z[i] ** 2 == pytest.approx(chi2)
+            assert z_p[i] == pytest.approx(chi2_p / 2 if z[i] > 0 else 1 - chi2_p / 2)
+        else:
+            assert z[i] == 0 and z_p[i] == 0.5
+
+
+def test_benjamini_hochberg_matches_scipy():
+    rng = np.random.default_rng(0)
+    p_values = np.concatenate([rng.random(30) ** 3, [0.01, 0.01, 1.0, np.nan, np.nan]])
+    q_values = sae_utils._benjamini_hochberg(p_values)
+
+    tested = ~np.isnan(p_values)
+    np.testing.assert_allclose(q_values[tested], false_discovery_control(p_values[tested]))
+    assert np.isnan(q_values[~tested]).all()
+
+
+def test_significance_columns_and_deterministic_bootstrap():
+    rng = np.random.default_rng(1)
+    target = random_activations(rng, nan_rows=[3])
+    others = [random_activations(rng, density=0.15) for _ in range(2)]
+
+    diffs = sae_utils.diff_features_multi(
+        target, others, min_coverage=0.2, significance=True, n_bootstrap=200, random_state=3
+    )
+    masked = (diffs["target_dataset_coverage"] == -1).to_numpy()
+    assert masked.any() and not masked.all()
+    n = target.shape[0]
+    for feature in np.flatnonzero(~masked):
+        row = diffs.iloc[feature]
+        k1 = round(row["target_dataset_coverage"] * n)
+        k2 = round(row["other_datasets_max_coverage"] * n)
+        table = [[k1, n - k1], [k2, n - k2]]
+        assert row["target_diff_others_p_value"] == pytest.approx(
+            fisher_exact(table, alternative="greater").pvalue
+        )
+        assert row["target_diff_others_ci_low"] <= row["target_diff_others_ci_high"]
+    np.testing.assert_allclose(
+        diffs["target_diff_others_q_value"][~masked],
+        false_discovery_control(diffs["target_diff_others_p_value"][~masked]),
+    )
+    assert diffs.loc[masked, "target_diff_others_q_value"].isna().all()
+    assert diffs.loc[masked, "others_diff_target_ci_low"].isna().all()
+
+    same_seed = sae_utils.diff_features_multi(
+        target, others, min_coverage=0.2, significance=True, n_bootstrap=200, random_state=3
+    )
+    pd.testing.assert_frame_equal(diffs, same_seed, check_exact=True)
+    other_seed = sae_utils.diff_features_multi(
+        target, others, min_coverage=0.2, significance=True, n_bootstrap=200, random_state=4
+    )
+    assert not other_seed["target_diff_others_ci_low"][~masked].equals(
+        diffs["target_diff_others_ci_low"][~masked]
+    )
+
+
+def per_feature_samples(target, others, feature, n_samples):
+    """
+    Per-feature selection replaced by select_feature_samples: the rows present in every dataset
+    with the largest difference between the target and the max of the others (ties by decreasing
+    row, NaN last), and the datasets allowed as the negative sample of each row (lowest activation).
+    """
+    n_common = min(len(matrix) for matrix in [target] + others)
+    values = np.stack([other[:n_common, feature] for other in others])
+    diff = target[:n_common, feature] - values.max(axis=0)
+    rows = sorted(
+        range(n_common),
+        key=lambda row: (np.isnan(diff[row]), 0 if np.isnan(diff[row]) else -diff[row], -row),
+    )[:n_samples]
+    lowest = [
+        set(np.flatnonzero(values[:, row] == np.nanmin(values[:, row])).tolist())
+        if not np.isnan(values[:, row]).all()
+        else {0}
+        for row in rows
+    ]
+    return rows, lowest
+
+
+def test_select_feature_samples_matches_per_feature_selection():
+    rng = np.random.default_rng(2)
+    # Integer activations, so differences and lowest activations are often tied
+    target = random_activations(rng, n_rows=50, n_features=20, density=0.5, nan_rows=[4])
+    others = [
+        random_activations(rng, n_rows=n_rows, n_features=20, density=0.3, nan_rows=nan_rows)
+        for n_rows, nan_rows in [(60, [4, 9]), (45, [9]), (55, [])]
+    ]
+    features = [3, 0, 19, 7, 12, 5, 11, 2, 18]
+
+    samples = sae_utils.select_feature_samples(
+        csr_matrix(target), [csr_matrix(other) for other in others], features,
+        n_samples=12, block_size=4, random_state=0,
+    )
+    assert list(samples) == features
+    chosen = []
+    for feature in features:
+        positive_rows, negative_datasets, negative_rows = samples[feature]
+        rows, lowest = per_feature_samples(target, others, feature, 12)
+        assert positive_rows.tolist() == rows
+        assert negative_rows.tolist() == rows
+        assert all(dataset in allowed for dataset, allowed in zip(negative_datasets.tolist(), lowest))
+        chosen += [dataset for dataset, allowed in zip(negative_datasets.tolist(), lowest) if len(allowed) == 3]
+
+    # Ties among all three datasets are broken at random, and the same way for a fixed seed
+    counts = np.bincount(chosen, minlength=3)
+    assert len(chosen) > 30 and (counts > len(chosen) / 6).all()
+    again = sae_utils.select_feature_samples(
+        target, others, features, n_samples=12, block_size=4, random_state=0
+    )
+    for feature in features:
+        np.testing.assert_array_equal(again[feature][1], samples[feature][1])
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import gc
+import os
+import threading
+import weakref
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+
+from interp_embed import Dataset, dataset_analysis
+from interp_embed.sae import pipeline as encode_pipeline
+from interp_embed.sae.local_sae import LocalSAE
+from interp_embed.sae.pipeline import (
+    PIPELINE_STAGES,
+    EncodePipeline,
+    token_budget_batches,
+)
+from interp_embed.sae.utils import (
+    compact_on_device,
+    compact_to_host,
+    prune_csr,
+    prune_dense,
+    sparsify_on_device,
+)
+
+
+def test_pipeline_preserves_batch_order(word_sae):
+    word_sae.load()
+    batches = [(i, [f"doc {i} " + "word " * i]) for i in range(12)]
+    results = list(EncodePipeline(word_sae, queue_size=1).run(iter(batches)))
+
+    assert [batch_id for batch_id, _, _ in results] == list(range(12))
+    for batch_id, batch_results, error in results:
+        assert error is None
+        activations, aggregates, tokens = batch_results[0]
+        assert activations.shape[0] == len(tokens) == batch_id + 2
+        np.testing.assert_array_equal(
+            aggregates["max"].toarray(), activations.toarray().max(axis=0, keepdims=True)
+        )
+
+
+def test_pipeline_raises_errors_of_the_batch_iterator(word_sae):
+    word_sae.load()
+
+    def batches():
+        for i in range(3):
+            yield i, [f"doc {i}"]
+        raise RuntimeError("cannot read batch 3")
+
+    yielded, raised = [], []
+
+    def consume():
+        try:
+            for batch_id, _, _ in EncodePipeline(word_sae, queue_size=1).run(batches()):
+                yielded.append(batch_id)
+        except RuntimeError as e:
+            raised.append(e)
+
+    # Run in a thread, so a pipeline waiting forever fails the test instead of hanging it
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert yielded == [0, 1, 2]
+    assert [str(e) for e in raised] == ["cannot read batch 3"]
+
+
+def test_pipeline_errors_do_not_keep_batch_tensors_alive(word_sae):
+    failed_tensors = []
+
+    class DeviceSAE(type(word_sae)):
+        # Stand-in for an SAE keeping its batches in (device) tensors
+        def prepare_batch(self, texts, token_ids=None):
+            batch = super().prepare_batch(texts, token_ids)
+            batch["input_ids"] = torch.zeros(len(texts), 8)
+            if "FAIL" in texts[0]:
+                failed_tensors.append(weakref.ref(batch["input_ids"]))
+            return batch
+
+        def forward_batch(self, batch):
+            if "FAIL" in batch["texts"][0]:
+                feature_acts = torch.ones(len(batch["texts"]), 8, self.d_sae)
+                failed_tensors.append(weakref.ref(feature_acts))
+                raise RuntimeError("out of memory")
+            return super().forward_batch(batch)
+
+    sae = DeviceSAE()
+    sae.load()
+    batches = [(0, ["FAIL doc"]), (1, ["doc one"]), (2, ["doc two"])]
+    errors = []
+    for batch_id, results, error in EncodePipeline(sae, queue_size=1).run(iter(batches)):
+        if error is not None:
+            errors.append(error)
+            gc.collect()
+            assert len(failed_tensors) == 2
+            assert all(tensor() is None for tensor in failed_tensors)
+        else:
+            assert results[0][0].shape[0] == 2
+    assert [str(error) for error in errors] == ["out of memory"]
+
+
+def test_compute_latents_with_pipeline(word_sae):
+    data = [{"text": f"document number {i} " + "x" * (i + 1)} for i in range(10)]
+    data[3]["text"] = "FAIL here"
+    dataset = Dataset(data, word_sae, batch_size=2)
+
+    # The batch holding the failing document is skipped as a whole
+    assert dataset.rows[2] is None and dataset.rows[3] is None
+    assert sum(row is not None for row in dataset.rows) == 8
+    assert dataset.token_count == 8 * 4
+
+    row = dataset.rows[5]
+    assert row.tokenized_document == data[5]["text"].split()
+    np.testing.assert_array_equal(
+        row.latents("sum"), row.activations.toarray().sum(axis=0, keepdims=True)
+    )
+
+    stats = dataset.encode_stats.summary()
+    assert all(stats[stage]["batches"] >= 4 for stage in PIPELINE_STAGES)
+    assert stats["postprocess"]["tokens"] == 8 * 4
+
+
+def test_token_budget_batches():
+    lengths = [3, 10, 1, 4, 4, 2, 12]
+    batches = token_budget_batches(lengths, max_tokens=10)
+
+    assert sorted(position for batch in batches for position in batch) == list(range(7))
+    assert batches[0] == [6]  # Longer than the budget: a batch of its own
+    for batch in batches[1:]:
+        assert len(batch) * max(lengths[position] for position in batch) <= 10
+
+
+def test_compute_latents_with_token_budget(monkeypatch, word_sae):
+    data = [{"text": " ".join(["word"] * (i % 7 + 1))} for i in range(30)]
+    tokenized = []
+    token_ids = word_sae.token_ids
+    monkeypatch.setattr(
+        word_sae, "token_ids", lambda texts: tokenized.extend(texts) or token_ids(texts)
+    )
+    dataset = Dataset(data, word_sae, max_tokens=12)
+
+    # The token ids used to plan the batches are not computed again by the pipeline
+    assert len(tokenized) == len(data)
+
+    assert all(row is not None for row in dataset.rows)
+    for document, row in zip(data, dataset.rows):
+        assert row.tokenized_document == document["text"].split()
+    assert dataset.encode_stats.summary()["forward"]["tokens"] == dataset.token_count
+
+
+def test_sparsify_on_device_matches_dense():
+    generator = torch.Generator().manual_seed(0)
+    feature_acts = torch.relu(torch.randn(3, 6, 40, generator=generator) - 1.0)
+    attention_mask = np.array(
+        [[1, 1, 1, 1, 1, 1], [1, 1, 0, 0, 0, 0], [0, 0, 1, 1, 1, 1]], dtype=bool
+    )
+
+    results = sparsify_on_device(feature_acts, attention_mask)
+    for i, (activations, aggregates) in enumerate(results):
+        expected = feature_acts[i][torch.from_numpy(attention_mask[i])].numpy()
+        np.testing.assert_array_equal(activations.toarray(), expected)
+        np.testing.assert_array_equal(aggregates["max"].toarray()[0], expected.max(axis=0))
+        np.testing.assert_allclose(
+            aggregates["sum"].toarray()[0], expected.sum(axis=0), rtol=1e-6
+        )
+        np.testing.assert_array_equal(
+            aggregates["count"].toarray()[0], (expected > 0).sum(axis=0)
+        )
+
+
+def test_compact_activations_scale_with_nonzeros():
+    generator = torch.Generator().manual_seed(0)
+    feature_acts = torch.relu(torch.randn(2, 5, 400, generator=generator) - 2.5)
+    attention_mask = np.ones((2, 5), dtype=bool)
+
+    compact = compact_on_device(feature_acts.to(torch.bfloat16), attention_mask)
+    values, columns, _, shape = compact["tokens"]
+    assert shape == (10, 400) and len(values) == len(columns) < 10 * 400 / 10
+    results = compact_to_host(compact)
+    expected = sparsify_on_device(feature_acts.to(torch.bfloat16).float(), attention_mask)
+    for (activations, _), (expected_activations, _) in zip(results, expected):
+        assert activations.dtype == np.float32
+        assert (activations != expected_activations).nnz == 0
+
+
+def test_pruning_matches_on_device_and_on_host():
+    generator = torch.Generator().manual_seed(1)
+    activations = torch.relu(torch.randn(50, 64, generator=generator))
+
+    for top_k, threshold in [(5, None), (None, 0.8), (3, 1.5)]:
+        expected = prune_dense(activations, top_k, threshold).numpy()
+        pruned = prune_csr(csr_matrix(activations.numpy()), top_k, threshold)
+        np.testing.assert_array_equal(pruned.toarray(), expected)
+        assert pruned.has_sorted_indices
+        if top_k is not None:
+            assert np.diff(pruned.indptr).max() <= top_k
+
+
+def test_pruning_is_recorded_in_metadata(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.sae = LocalSAE(top_k_per_token=8, min_activation=0.1)
+    dataset.save_to_file(tmp_path / "dataset")
+
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+    assert loaded.sae.top_k_per_token == 8
+    assert loaded.sae.min_activation == 0.1
+
+
+def test_sharded_encoding_merges_rows_and_resumes_a_crashed_shard(
+    tmp_path, monkeypatch, word_sae
+):
+    marker = tmp_path / "crashed"
+
+    class CrashingSAE(type(word_sae)):
+        def encode(self, texts):
+            if any("CRASH" in text for text in texts) and not marker.exists():
+                marker.touch()
+                os._exit(1)
+            return super().encode(texts)
+
+    # Forked workers see the patched loader, which spawned ones would re-import
+    monkeypatch.setattr(encode_pipeline, "SHARD_START_METHOD", "fork")
+    for module in (encode_pipeline, dataset_analysis):
+        monkeypatch.setattr(module, "load_sae_from_metadata", lambda metadata: CrashingSAE())
+    monkeypatch.setattr(type(word_sae), "metadata", lambda self: LocalSAE().metadata())
+
+    data = [{"text": f"document {i} " + "x" * (i + 1)} for i in range(30)]
+    data[27]["text"] = "CRASH document"
+    path = str(tmp_path / "dataset")
+    expected = Dataset(data, word_sae, batch_size=4)
+
+    # Shard 0 holds rows 0, 3, ..., 27: its worker dies on row 27, losing the rows it had not
+    # logged yet, while the other shards finish
+    dataset = Dataset(data, CrashingSAE(), batch_size=1, save_path=path, num_workers=3)
+    missing = np.where(~dataset._valid_row_mask())[0]
+    assert 27 in missing and np.all(missing % 3 == 0)
+
+    resumed = Dataset.load_from_file(path, resume=True, num_workers=3, device="cpu")
+    assert resumed._valid_row_mask().all()
+    assert resumed.token_count == expected.token_count
+    np.testing.assert_allclose(resumed.latents("sum"), expected.latents("sum"))
+    assert [row.tokenized_document for row in resumed.rows] == [
+        row.tokenized_document for row in expected.rows
+    ]
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from openai import AsyncOpenAI
+
+from interp_embed.cache import LLMResponseCache
+from interp_embed.llm import utils as llm_utils
+from interp_embed.llm.rate_limit import TokenBucket, get_rate_limiter, set_rate_limits
+from interp_embed.llm.utils import call_async_llm, set_llm_cache
+
+
+@pytest.fixture
+def fake_llm_server():
+    """
+    Local OpenAI-compatible chat completions endpoint that echoes the last message and records the
+    requests it receives. The first `rate_limited[0]` requests are answered with a 429.
+    """
+    requests = []
+    rate_limited = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if rate_limited[0] > 0:
+                rate_limited[0] -= 1
+                payload = b'{"error": {"message": "rate limited"}}'
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            requests.append(body)
+            content = f"echo {len(requests)}: {body['messages'][-1]['content']}"
+            payload = json.dumps(
+                {
+                    "id": f"chatcmpl-{len(requests)}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", requests, rate_limited
+    server.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_utils, "_llm_cache", llm_utils._UNSET)
+    cache = LLMResponseCache(str(tmp_path / "llm.sqlite"))
+    set_llm_cache(cache)
+    return cache
+
+
+def test_llm_responses_are_cached(fake_llm_server, llm_cache):
+    base_url, requests, _ = fake_llm_server
+    client = AsyncOpenAI(base_url=base_url, api_key="test", max_retries=0)
+
+    def ask(content, **kwargs):
+        response = asyncio.run(
+            call_async_llm(client, "test/model", [{"role": "user", "content": content}], **kwargs)
+        )
+        return response.choices[0].message.content
+
+    first = ask("hello")
+    assert ask("hello") == first == "echo 1: hello"
+    assert len(requests) == 1 and (llm_cache.hits, llm_cache.misses) == (1, 1)
+
+    # Other messages or decoding parameters are separate entries
+    assert ask("hello", temperature=0.5) == "echo 2: hello"
+    assert ask("bye") == "echo 3: bye"
+    assert ask("hello", use_cache=False) == "echo 4: hello"
+    assert len(requests) == 4
+
+    # A new instance on the same file, as in a later run; stale entries are requested again
+    set_llm_cache(LLMResponseCache(llm_cache.blobs.path))
+    assert ask("bye") == "echo 3: bye" and len(requests) == 4
+    set_llm_cache(LLMResponseCache(llm_cache.blobs.path, ttl=0))
+    time.sleep(0.01)
+    assert ask("bye") == "echo 5: bye"
+
+    set_llm_cache(None)
+    assert ask("bye") == "echo 6: bye"
+
+
+def test_unparseable_llm_responses_are_not_cached(fake_llm_server, llm_cache):
+    base_url, requests, _ = fake_llm_server
+    client = AsyncOpenAI(base_url=base_url, api_key="test", max_retries=0)
+
+    def parse(response):
+        # Only the responses to even-numbered requests parse
+        number = int(response.choices[0].message.content.split(":")[0].split()[1])
+        if number % 2:
+            raise ValueError(f"bad response {number}")
+        return number
+
+    def ask(content, **kwargs):
+        response = asyncio.run(
+            call_async_llm(client, "test/model", [{"role": "user", "content": content}], **kwargs)
+        )
+        return response.choices[0].message.content
+
+    # The bad response is returned, but a retry sends the request again
+    assert ask("hello", validate=parse) == "echo 1: hello"
+    assert ask("hello", validate=parse) == "echo 2: hello"
+    assert ask("hello", validate=parse) == "echo 2: hello" and len(requests) == 2
+
+    # Bad responses cached without a validator are requested again by callers that validate
+    assert ask("bye") == "echo 3: bye"
+    assert ask("bye", validate=parse) == "echo 4: bye"
+    assert ask("bye") == "echo 4: bye" and len(requests) == 4
+
+
+def test_rate_limited_requests_back_off_and_retry(fake_llm_server):
+    base_url, requests, rate_limited = fake_llm_server
+    client = AsyncOpenAI(base_url=base_url, api_key="test", max_retries=0)
+    set_rate_limits(str(client.base_url), initial_concurrency=8)
+    rate_limited[0] = 3
+
+    async def ask_all():
+        return await asyncio.gather(
+            *[
+                call_async_llm(
+                    client, "test/model", [{"role": "user", "content": str(i)}], use_cache=False
+                )
+                for i in range(6)
+            ]
+        )
+
+    responses = asyncio.run(ask_all())
+    limiter = get_rate_limiter(str(client.base_url))
+    assert [response.choices[0].message.content.split(": ")[1] for response in responses] == [
+        str(i) for i in range(6)
+    ]
+    assert len(requests) == 6 and limiter.rate_limited == 3
+    # One decrease for the burst of rate-limit errors, then additive increases
+    assert 4 < limiter.concurrency.limit < 6 and limiter.concurrency.in_flight == 0
+
+
+def test_token_bucket_delays_overdrawn_reservations():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(30) == pytest.approx(30, abs=0.1)
+    bucket.adjust(30)  # The reservation used fewer tokens than estimated
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.1)
+
+
+def test_pooled_clients_and_limiter_across_event_loops(fake_llm_server, monkeypatch):
+    base_url, requests, _ = fake_llm_server
+    created = []
+
+    def new_client(is_openai_model, is_async):
+        created.append(AsyncOpenAI(base_url=base_url, api_key="test", max_retries=0))
+        return created[-1]
+
+    monkeypatch.setattr(llm_utils, "_new_llm_client", new_client)
+    # Built outside of an event loop, as components do in their constructors
+    client = llm_utils.get_llm_client(is_async=True)
+    limiter = set_rate_limits(str(client.base_url))
+    # Without configured limits, the limiter starts at its maximum
+    assert limiter.concurrency.limit == limiter.concurrency.maximum == 256
+
+    in_flight = []
+    acquire = limiter.concurrency.acquire
+
+    async def recording_acquire():
+        await acquire()
+        in_flight.append(limiter.concurrency.in_flight)
+
+    monkeypatch.setattr(limiter.concurrency, "acquire", recording_acquire)
+
+    def ask(i):
+        return call_async_llm(
+            client, "test/model", [{"role": "user", "content": str(i)}], use_cache=False,
+            max_concurrency=2,
+        )
+
+    async def ask_all():
+        return await asyncio.gather(*[ask(i) for i in range(6)])
+
+    async def abandon():
+        # The loop exits while the requests wait for a slot or a response
+        for i in range(6):
+            asyncio.ensure_future(ask(i))
+        await asyncio.sleep(0)
+
+    for run in [ask_all, abandon, ask_all]:
+        responses = asyncio.run(run())
+        assert limiter.concurrency.in_flight == 0 and not limiter.concurrency._waiters
+        if responses is not None:
+            assert [r.choices[0].message.content.split(": ")[1] for r in responses] == [
+                str(i) for i in range(6)
+            ]
+    # The callers' concurrency caps the shared limiter
+    assert limiter.concurrency.maximum == 2 and max(in_flight) <= 2
+    # One client for the proxy itself, then one pooled client per event loop
+    assert len(created) == 4
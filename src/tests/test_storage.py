@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import os
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from interp_embed import Dataset
+from interp_embed.cache import ActivationCache, BlobCache
+from interp_embed.dataset_analysis import DatasetRow, StoredRows
+from interp_embed.sae.local_sae import LocalSAE
+from interp_embed.storage import CHECKPOINT_LOG_DIR
+
+
+def test_columnar_round_trip(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+
+    assert isinstance(loaded.rows, StoredRows)
+    assert loaded.token_count == dataset.token_count
+    assert len(loaded.filter_na_rows()) == len(dataset.filter_na_rows())
+    for original, stored in zip(dataset.rows, loaded.rows):
+        if original is None:
+            assert stored is None
+            continue
+        assert stored.tokenized_document == original.tokenized_document
+        assert (stored.latents("all", compress=True) != original.latents("all", compress=True)).nnz == 0
+        np.testing.assert_array_equal(stored.latents("max"), original.latents("max"))
+        np.testing.assert_array_equal(stored.latents("sum"), original.latents("sum"))
+
+
+def test_resume_assignment_is_saved(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+
+    loaded.rows[2] = dataset.rows[0]
+    loaded.save_to_file(tmp_path / "dataset")
+    reloaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+
+    assert reloaded.rows[2].tokenized_document == dataset.rows[0].tokenized_document
+    assert len(reloaded.filter_na_rows()) == len(dataset.filter_na_rows()) + 1
+
+
+def test_low_memory_rows_share_the_store(tmp_path, word_sae):
+    data = [{"text": f"document number {i} " + "x" * (i + 1)} for i in range(12)]
+    dataset = Dataset(data, word_sae, batch_size=4)
+    compact = Dataset(
+        data, word_sae, batch_size=4, save_path=str(tmp_path / "dataset"), low_memory=True
+    )
+
+    assert isinstance(compact.rows, StoredRows)
+    assert not hasattr(compact.rows[0], "__dict__")
+    for original, stored in zip(dataset.rows, compact.rows):
+        assert stored.data == original.data
+        assert stored.tokenized_document == original.tokenized_document
+        assert stored.token_activations(3) == original.token_activations(3)
+        for method in ["max", "sum", "mean", "count"]:
+            np.testing.assert_allclose(stored.latents(method), original.latents(method))
+
+
+def test_low_memory_row_computes_aggregates_lazily():
+    activations = csr_matrix(np.array([[0.0, 2.0, 0.0], [1.0, 3.0, 0.0]], dtype=np.float32))
+    row = DatasetRow(
+        row={"text": "a b"},
+        tokenized_document=["a", "b"],
+        activations=activations,
+        low_memory=True,
+    )
+
+    assert row.aggregate_activations == dict()
+    np.testing.assert_array_equal(row.latents("max"), [[1.0, 3.0, 0.0]])
+    np.testing.assert_array_equal(row.latents("sum"), [[1.0, 5.0, 0.0]])
+
+
+def test_token_ids_are_decoded_through_the_vocabulary(tmp_path, char_sae):
+    data = [{"text": f"doc {i}!"} for i in range(6)]
+    dataset = Dataset(data, char_sae, batch_size=4)
+
+    row = dataset.rows[3]
+    assert row.tokenized_document == list("doc 3!")
+    assert row.token_activations(0).replace("<<", "").replace(">>", "") == "doc 3!"
+
+    dataset.sae = LocalSAE()  # Saved metadata must describe a loadable SAE
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+    assert len(loaded.rows.store.vocabulary) == 128
+    assert loaded.rows.store.token_ids.dtype == np.int32
+    assert [row.tokenized_document for row in loaded.rows] == [
+        list(document["text"]) for document in data
+    ]
+
+
+def test_checkpoint_log_is_replayed_and_compacted(tmp_path, monkeypatch, word_sae):
+    data = [{"text": f"document number {i} " + "x" * (i + 1)} for i in range(12)]
+    path = str(tmp_path / "dataset")
+    monkeypatch.setattr(type(word_sae), "metadata", lambda self: LocalSAE().metadata())
+
+    # Crash when the log is compacted at the end: the first checkpoint saved the dataset and
+    # every later batch went to the log
+    save_to_file = Dataset.save_to_file
+    saves = []
+
+    def crashing_save(self, *args, **kwargs):
+        saves.append(args)
+        if len(saves) > 1:
+            raise RuntimeError("crash")
+        save_to_file(self, *args, **kwargs)
+
+    monkeypatch.setattr(Dataset, "save_to_file", crashing_save)
+    with pytest.raises(RuntimeError):
+        Dataset(data, word_sae, batch_size=2, save_path=path, save_every_batch=1)
+    monkeypatch.setattr(Dataset, "save_to_file", save_to_file)
+    assert len(os.listdir(os.path.join(path, CHECKPOINT_LOG_DIR))) == 5
+
+    expected = Dataset(data, word_sae, batch_size=2)
+    loaded = Dataset.load_from_file(path, device="cpu")
+    assert len(loaded.filter_na_rows()) == 12
+    np.testing.assert_allclose(loaded.latents("sum"), expected.latents("sum"))
+    assert [row.tokenized_document for row in loaded.rows] == [
+        row.tokenized_document for row in expected.rows
+    ]
+
+    Dataset.load_from_file(path, resume=True, device="cpu")
+    assert not os.path.exists(os.path.join(path, CHECKPOINT_LOG_DIR))
+    compacted = Dataset.load_from_file(path, device="cpu")
+    assert compacted.rows.is_unmodified_store() and compacted.rows.store.valid.all()
+
+
+def test_activation_cache_skips_encoding_seen_documents(
+    tmp_path, monkeypatch, word_sae, char_sae
+):
+    data = [{"text": f"document number {i} " + "x" * (i + 1)} for i in range(8)]
+    encoded = []
+
+    def recording_encode(self, texts):
+        encoded.extend(texts)
+        return [None] * len(texts)
+
+    for sae in [word_sae, char_sae]:
+        cache = ActivationCache(str(tmp_path / f"{type(sae).__name__}.sqlite"))
+        first = Dataset(data[:5], sae, batch_size=2, activation_cache=cache)
+        assert (cache.hits, cache.misses) == (0, 5)
+
+        encoded.clear()
+        monkeypatch.setattr(type(sae), "encode", recording_encode)
+        # A new cache instance on the same file, as in a later run
+        cache = ActivationCache(str(tmp_path / f"{type(sae).__name__}.sqlite"))
+        second = Dataset(data, sae, batch_size=2, activation_cache=cache)
+        monkeypatch.undo()
+
+        assert (cache.hits, cache.misses) == (5, 3)
+        assert encoded == [document["text"] for document in data[5:]]
+        np.testing.assert_allclose(second.latents("sum")[:5], first.latents("sum"))
+        assert [row.tokenized_document for row in second.rows[:5]] == [
+            row.tokenized_document for row in first.rows
+        ]
+
+
+def test_blob_cache_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path / "cache.sqlite"), max_bytes=250)
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    assert cache.get("a") == b"a" * 100  # "b" is now the least recently used
+    cache.put("c", b"c" * 100)
+
+    assert cache.get("b") is None and "a" in cache and "c" in cache
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.size() == 200
+
+
+def test_blob_cache_hits_do_not_write_until_flushed(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = BlobCache(path, max_bytes=250)
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    changes = cache._connection.total_changes
+    for _ in range(10):
+        assert cache.get("a") == b"a" * 100
+    assert cache._connection.total_changes == changes
+
+    # Written on close, so a later instance evicts "b" first
+    cache.close()
+    cache = BlobCache(path, max_bytes=250)
+    cache.put("c", b"c" * 100)
+    assert "a" in cache and "b" not in cache and "c" in cache
+
+
+def test_sort_by_features_annotates_stored_rows(tmp_path, make_dataset):
+    dataset = make_dataset().filter_na_rows()
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+    assert isinstance(loaded.rows, StoredRows)
+
+    features = [3, 7]
+    expected = dataset.sort_by_features(features)
+    sorted_dataset = loaded.sort_by_features(features)
+
+    annotations = ["feature_activation", "top_feature_label", "top_feature_index"]
+    for original, stored in zip(expected.rows, sorted_dataset.rows):
+        assert stored.data == original.data
+        assert {key: stored.row[key] for key in annotations} == {
+            key: original.row[key] for key in annotations
+        }
+
+
+def test_assigning_into_a_slice_leaves_the_parent_unchanged(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+
+    subset = loaded.rows[0:5]
+    subset[2] = dataset.rows[0]
+    assert subset[2].tokenized_document == dataset.rows[0].tokenized_document
+    assert loaded.rows[2] is None
+
+    loaded.rows[3] = dataset.rows[0]
+    assert subset[3].tokenized_document == dataset.rows[3].tokenized_document
+    assert subset[2].tokenized_document == dataset.rows[0].tokenized_document
+
+
+def test_stored_row_records_keep_changes(tmp_path, make_dataset):
+    dataset = make_dataset()
+    dataset.rows[1].truncate_chat_template = True
+    dataset.save_to_file(tmp_path / "dataset")
+    loaded = Dataset.load_from_file(str(tmp_path / "dataset"), device="cpu")
+
+    loaded.rows[1].row["note"] = "seen"
+    assert loaded.rows[1].row["note"] == "seen"
+    assert loaded.rows[0:3][1].row["note"] == "seen"
+    assert "note" not in loaded.rows[0].row
+    assert loaded.rows[1].truncate_chat_template
+    assert not loaded.rows[0].truncate_chat_template